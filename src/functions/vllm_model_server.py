@@ -1,12 +1,2271 @@
+import atexit
+import copy
+import fcntl
+import fnmatch
+import gc
+import hashlib
+import json
+import math
+import multiprocessing
 import os
+import queue
 import shutil
+import sqlite3
+import subprocess
+import sys
 import tempfile
-from typing import Dict, List, Optional, Union
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import IO, TYPE_CHECKING, Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import mlrun
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 from mlrun.projects.project import MlrunProject
-from huggingface_hub import snapshot_download
-from vllm import LLM, RequestOutput, SamplingParams
+
+if TYPE_CHECKING:
+    from vllm import LLM, RequestOutput, SamplingParams
+
+# region Lazy Imports
+# seconds spent importing each lazily imported module, filled on first use
+LAZY_IMPORT_SECONDS: Dict[str, float] = {}
+
+_lazy_import_lock = threading.Lock()
+
+
+class _LazyCallable:
+    """
+    A module level stand-in for a callable of a heavy dependency (vllm, huggingface_hub).
+    The dependency is imported on the first call, so importing this module, running
+    store_model or planning with the tokenizer does not pay for vllm and torch.
+    """
+
+    def __init__(self, module_name: str, attribute: str):
+        """
+        Initialize the stand-in.
+
+        :param module_name: The module to import on first use.
+        :param attribute: The callable of the module.
+        """
+        self.module_name = module_name
+        self.attribute = attribute
+        self._target = None
+
+    def resolve(self) -> Callable:
+        """
+        Import the module if needed and return the real callable.
+
+        :return: The callable.
+        """
+        if self._target is None:
+            with _lazy_import_lock:
+                if self._target is None:
+                    start = time.perf_counter()
+                    module = __import__(self.module_name, fromlist=[self.attribute])
+                    LAZY_IMPORT_SECONDS.setdefault(
+                        self.module_name, time.perf_counter() - start)
+                    self._target = getattr(module, self.attribute)
+        return self._target
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        # attributes of the real object, like the members of an enum
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.resolve(), name)
+
+    def __repr__(self) -> str:
+        return f"<lazy {self.module_name}.{self.attribute}>"
+
+
+HfApi = _LazyCallable("huggingface_hub", "HfApi")
+hf_hub_download = _LazyCallable("huggingface_hub", "hf_hub_download")
+snapshot_download = _LazyCallable("huggingface_hub", "snapshot_download")
+LLM = _LazyCallable("vllm", "LLM")
+SamplingParams = _LazyCallable("vllm", "SamplingParams")
+RequestOutputKind = _LazyCallable("vllm.sampling_params", "RequestOutputKind")
+
+
+def import_profile_report(module_name: str = __name__, top: int = 15) -> Dict[str, Any]:
+    """
+    Profile the import of a module in a fresh interpreter with python -X importtime, and
+    report the top level packages that cost the most, plus the lazy imports this process
+    has paid for so far.
+
+    :param module_name: The module to import.
+    :param top: The number of packages to report.
+    :return: The total import seconds, the cumulative seconds of the top packages and the
+             lazy import seconds of this process.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module_name}"],
+        capture_output=True, text=True, env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)})
+    if result.returncode != 0:
+        raise RuntimeError(f"Failed to import {module_name}: {result.stderr[-2000:]}")
+
+    # lines are "import time: self [us] | cumulative | imported package", nested names indented
+    packages = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = (part.strip() for part in line[len("import time:"):].split("|"))
+        package = name.split(".")[0]
+        packages[package] = max(packages.get(package, 0.0), int(cumulative) / 1e6)
+
+    return {
+        "module": module_name,
+        "total_seconds": packages.get(module_name.split(".")[0], max(packages.values(), default=0.0)),
+        "packages": dict(sorted(packages.items(), key=lambda item: -item[1])[:top]),
+        "lazy_imports": dict(LAZY_IMPORT_SECONDS),
+    }
+# endregion Lazy Imports
+
+
+# tokenizer cache location and size cap, shared by all processes on the node
+TOKENIZER_CACHE_DIR = os.environ.get(
+    "VLLM_TOKENIZER_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "mlrun-vllm", "tokenizers"))
+TOKENIZER_CACHE_MAX_BYTES = int(os.environ.get(
+    "VLLM_TOKENIZER_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+
+# node-local model weight cache location and size cap, a cap of 0 disables the cache
+WEIGHT_CACHE_DIR = os.environ.get(
+    "VLLM_WEIGHT_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "mlrun-vllm", "weights"))
+WEIGHT_CACHE_MAX_BYTES = int(os.environ.get("VLLM_WEIGHT_CACHE_MAX_BYTES", 0))
+
+# concurrency and retry policy for fetching artifact files from the object store
+ARTIFACT_FETCH_MAX_WORKERS = 8
+ARTIFACT_FETCH_RETRIES = 3
+ARTIFACT_FETCH_BACKOFF_SECONDS = 0.5
+
+# chunk size used when the prompts are read from a dataset and no chunk size is given
+DEFAULT_CHUNK_SIZE = 1024
+
+# chunks each queue of the streaming pipeline holds between its prefetch, generate and write stages
+PIPELINE_QUEUE_SIZE = 2
+
+# files a vLLM load needs besides the weights: configs, tokenizer files and remote code
+MODEL_SUPPORT_PATTERNS = ["*.json", "*.model", "*.txt", "*.tiktoken", "*.py"]
+
+# weight files of each format, "auto" picks the first format the repository has
+WEIGHT_FORMAT_PATTERNS = {
+    "safetensors": ["*.safetensors"],
+    "bin": ["*.bin"],
+    "pt": ["*.pt", "*.pth"],
+}
+
+# memory an engine holds per byte of weights when no engine_memory_gb is declared,
+# covering the activations and a minimal KV cache
+ENGINE_MEMORY_OVERHEAD = 1.2
+
+# manifest of per-file content hashes and sizes, stored in the model artifact directory
+MODEL_MANIFEST_FILE = "model_manifest.json"
+
+# minimum number of leading characters prompts must share to be scheduled as a prefix group
+SCHEDULE_MIN_PREFIX_CHARS = 32
+
+# token budget of a suggested chunk: prompt plus generated tokens of every request in it
+PLAN_CHUNK_TOKENS = 1 << 20
+
+# the suggested max_model_len is rounded up to a multiple of this
+PLAN_MODEL_LEN_MULTIPLE = 256
+
+# synthetic prompts the serving path is warmed up with before it reports ready
+DEFAULT_WARMUP_PROMPTS = [
+    "Hello, how are you?",
+    "Summarize the following text in one sentence: The quick brown fox jumps over the lazy dog.",
+    "Write a short poem about the sea.",
+    "Explain what a large language model is to a ten year old.",
+]
+
+# seconds a project or artifact lookup is reused before the MLRun API is called again
+METADATA_CACHE_TTL_SECONDS = float(os.environ.get("VLLM_METADATA_CACHE_TTL_SECONDS", 60))
+
+
+# region Artifact Fetch
+def _download_with_retry(
+    url: str,
+    target_path: str,
+    retries: int = ARTIFACT_FETCH_RETRIES,
+    backoff: float = ARTIFACT_FETCH_BACKOFF_SECONDS
+) -> Dict[str, Any]:
+    """
+    Download a single data item, retrying with exponential backoff.
+
+    :param url: The data item url.
+    :param target_path: The local path to download to.
+    :param retries: The number of retries after the first attempt.
+    :param backoff: The delay before the first retry, doubled on every retry.
+    :return: The download timing, attempts and size.
+    """
+    start = time.perf_counter()
+    for attempt in range(retries + 1):
+        try:
+            mlrun.get_dataitem(url).download(target_path=target_path)
+            break
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+    return {
+        "seconds": time.perf_counter() - start,
+        "attempts": attempt + 1,
+        "bytes": os.path.getsize(target_path),
+    }
+
+
+def _fetch_files(
+    files: Dict[str, str],
+    max_workers: int = ARTIFACT_FETCH_MAX_WORKERS,
+    retries: int = ARTIFACT_FETCH_RETRIES,
+    backoff: float = ARTIFACT_FETCH_BACKOFF_SECONDS
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Download data items concurrently with a bounded thread pool.
+
+    :param files: Mapping of data item url to the local path to download to.
+    :param max_workers: The maximum number of concurrent downloads.
+    :param retries: The number of retries per file.
+    :param backoff: The delay before the first retry of a file.
+    :return: Mapping of data item url to its download timing, attempts and size.
+    """
+    if not files:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(files))) as executor:
+        futures = {
+            url: executor.submit(_download_with_retry, url, target_path, retries, backoff)
+            for url, target_path in files.items()
+        }
+        return {url: future.result() for url, future in futures.items()}
+
+
+def _copy_artifact_file(source_url: str, target_url: str):
+    """
+    Copy a file within the artifact store, server-side when the store's filesystem
+    supports it (an object copy on S3, GCS or Azure), otherwise through a local
+    temporary file.
+
+    :param source_url: The url of the file to copy.
+    :param target_url: The url to copy the file to.
+    """
+    source = mlrun.get_dataitem(source_url)
+    filesystem = source.store.filesystem
+    if filesystem is not None and source.store is mlrun.get_dataitem(target_url).store:
+        # object stores have no directories, a local store needs the parent directory
+        if source.kind == "file":
+            os.makedirs(os.path.dirname(target_url), exist_ok=True)
+        filesystem.copy(source_url, target_url)
+        return
+
+    temp_dir = tempfile.mkdtemp(prefix="vllm_copy_")
+    try:
+        local_path = os.path.join(temp_dir, os.path.basename(source_url))
+        source.download(target_path=local_path)
+        mlrun.get_dataitem(target_url).upload(local_path)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+# endregion Artifact Fetch
+
+
+# region Weight Selection
+def _matches(filename: str, patterns: List[str]) -> bool:
+    return any(fnmatch.fnmatch(filename, pattern) for pattern in patterns)
+
+
+def _select_model_files(files: Dict[str, int], weight_format: str) -> Dict[str, int]:
+    """
+    Select the minimal set of repository files a vLLM load needs for a weight format:
+    the weights of that format plus the top level config and tokenizer files.
+
+    :param files: Mapping of the repository file names to their sizes.
+    :param weight_format: "auto" or one of WEIGHT_FORMAT_PATTERNS.
+    :return: Mapping of the selected file names to their sizes.
+    """
+    # variants in subfolders (onnx/, openvino/, ...) are never needed by vLLM
+    top_level = {name: size for name, size in files.items() if "/" not in name}
+
+    if weight_format == "auto":
+        weight_format = next(
+            (name for name, patterns in WEIGHT_FORMAT_PATTERNS.items()
+             if any(_matches(filename, patterns) for filename in top_level)),
+            None)
+        if weight_format is None:
+            raise ValueError("The repository has no safetensors, bin or pt weights")
+    elif weight_format not in WEIGHT_FORMAT_PATTERNS:
+        raise ValueError(
+            f"Unsupported weight format {weight_format}, expected auto or one of "
+            f"{list(WEIGHT_FORMAT_PATTERNS)}")
+
+    weight_patterns = WEIGHT_FORMAT_PATTERNS[weight_format]
+
+    def is_needed(name: str) -> bool:
+        # only the shard index of the selected weights, e.g. model.safetensors.index.json
+        if name.endswith(".index.json"):
+            return _matches(name[:-len(".index.json")], weight_patterns)
+        return _matches(name, weight_patterns) or _matches(name, MODEL_SUPPORT_PATTERNS)
+
+    return {name: size for name, size in top_level.items() if is_needed(name)}
+# endregion Weight Selection
+
+
+# region Local Cache
+def _get_artifact_version(artifact) -> str:
+    """
+    Get a string identifying the version of an artifact.
+
+    :param artifact: The MLRun artifact.
+    :return: The artifact uid, tree or hash, whichever is set first.
+    """
+    metadata = artifact.metadata
+    return str(metadata.uid or metadata.tree or metadata.hash or "")
+
+
+def _dir_size(path: str) -> int:
+    """
+    Get the total size of the files under a directory.
+
+    :param path: The directory.
+    :return: The size in bytes.
+    """
+    return sum(
+        os.path.getsize(os.path.join(dir_path, filename))
+        for dir_path, _, filenames in os.walk(path)
+        for filename in filenames)
+
+
+class CacheLease:
+    """
+    A shared lock on a LocalArtifactCache entry, held while the entry files are read.
+    Eviction skips entries with a lease in any process of the node, and the lock is
+    released when the lease is released or the process exits.
+    """
+
+    def __init__(self, path: str, lock_file: IO):
+        """
+        Initialize the lease.
+
+        :param path: The entry directory.
+        :param lock_file: The open lock file holding the shared lock.
+        """
+        self.path = path
+        self._lock_file = lock_file
+
+    def release(self):
+        """
+        Release the shared lock, the entry may be evicted afterwards.
+        """
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def __enter__(self) -> "CacheLease":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class LocalArtifactCache:
+    """
+    An on-disk cache of artifact files, shared safely between processes.
+
+    Each entry is a directory named after a content address of its key, guarded by a
+    lock file of the same name. Entries are filled in a temporary directory under an
+    exclusive lock and renamed into place, so readers only ever see complete entries,
+    and they are read under a shared lock (a lease). Least-recently-used entries without
+    a lease are evicted, together with their lock files, once the cache grows beyond
+    max_bytes. An entry larger than max_bytes is never stored.
+    """
+
+    # temporary fill directories older than this are left over from crashed fills
+    STALE_FILL_SECONDS = 3600
+
+    # the lock serializing eviction, it never guards an entry
+    EVICT_LOCK = "evict"
+
+    def __init__(self, root: str, max_bytes: int):
+        """
+        Initialize the cache.
+
+        :param root: Directory holding the cache entries.
+        :param max_bytes: Size cap of the cache, LRU entries are evicted beyond it.
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def entry_key(*parts: str) -> str:
+        """
+        Build the content address of an entry from its identifying parts.
+
+        :param parts: The parts identifying the entry, for example artifact URI and version.
+        :return: The entry key.
+        """
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def _lock_path(self, name: str) -> str:
+        return os.path.join(self.root, f".{name}.lock")
+
+    def _acquire(self, name: str, shared: bool = False, blocking: bool = True) -> Optional[IO]:
+        """
+        Take a cross-process file lock.
+
+        :param name: Name of the lock.
+        :param shared: Take a shared lock instead of an exclusive one.
+        :param blocking: Wait for the lock instead of giving up when it is held elsewhere.
+        :return: The open lock file holding the lock, closing it releases the lock. None
+                 when the lock is held elsewhere and blocking is False.
+        """
+        path = self._lock_path(name)
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+        while True:
+            lock_file = open(path, "a")
+            try:
+                fcntl.flock(lock_file, operation)
+            except BlockingIOError:
+                lock_file.close()
+                return None
+
+            # eviction removes the lock file with its entry, a lock on a removed file
+            # guards nothing, so lock the new file instead
+            try:
+                if os.stat(path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                    return lock_file
+            except FileNotFoundError:
+                pass
+            lock_file.close()
+
+    @contextmanager
+    def _lock(self, name: str) -> Iterator[None]:
+        """
+        Hold an exclusive, cross-process file lock.
+
+        :param name: Name of the lock.
+        """
+        lock_file = self._acquire(name)
+        try:
+            yield
+        finally:
+            lock_file.close()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Get the path of a complete entry and mark it as recently used. The entry may be
+        evicted once this returns, take a lease to read its files.
+
+        :param key: The entry key.
+        :return: The entry directory, or None on a miss.
+        """
+        path = self._entry_path(key)
+        if not os.path.isdir(path):
+            return None
+
+        # the directory mtime records the last use for LRU eviction
+        os.utime(path)
+        return path
+
+    def lease(self, key: str, blocking: bool = True) -> Optional[CacheLease]:
+        """
+        Lease a complete entry, it is not evicted until the lease is released.
+
+        :param key: The entry key.
+        :param blocking: Wait for a fill or eviction of the entry in progress instead of
+                         returning None.
+        :return: The lease, or None on a miss.
+        """
+        lock_file = self._acquire(key, shared=True, blocking=blocking)
+        if lock_file is None:
+            return None
+        path = self.get(key)
+        if path is None:
+            lock_file.close()
+            return None
+        return CacheLease(path, lock_file)
+
+    def get_or_fill(self, key: str, fill: Callable[[str], None]) -> Tuple[CacheLease, bool]:
+        """
+        Lease an entry, filling it on a miss. Concurrent fills of the same key wait for
+        the first one instead of fetching the files again.
+
+        :param key: The entry key.
+        :param fill: Callable writing the entry files into the directory it is given.
+        :return: The lease of the entry, release it once its files are read, and whether
+                 it was a cache hit.
+        :raises ValueError: When the filled entry is larger than max_bytes.
+        """
+        filled = False
+        while True:
+            lease = self.lease(key)
+            if lease is not None:
+                break
+
+            with self._lock(key):
+                # another process may have filled the entry while we waited
+                if self.get(key) is not None:
+                    continue
+
+                # fill a temporary directory and rename it into place
+                temp_dir = tempfile.mkdtemp(prefix=f".tmp-{key}-", dir=self.root)
+                try:
+                    fill(temp_dir)
+                    size = _dir_size(temp_dir)
+                    if size > self.max_bytes:
+                        raise ValueError(
+                            f"The cache entry is {size} bytes, more than the cache size cap "
+                            f"of {self.max_bytes} bytes")
+                    os.rename(temp_dir, self._entry_path(key))
+                except BaseException:
+                    shutil.rmtree(temp_dir, ignore_errors=True)
+                    raise
+                filled = True
+
+        self.evict(keep=key)
+        return lease, not filled
+
+    def _entries(self) -> List[Tuple[str, float, int]]:
+        """
+        List the complete entries.
+
+        :return: Tuples of (key, last used time, size in bytes).
+        """
+        entries = []
+        for name in os.listdir(self.root):
+            path = self._entry_path(name)
+            if name.startswith(".") or not os.path.isdir(path):
+                continue
+            entries.append((name, os.path.getmtime(path), _dir_size(path)))
+        return entries
+
+    def _remove(self, key: str, orphan_only: bool = False) -> bool:
+        """
+        Remove an entry and its lock file, unless it is leased or being filled.
+
+        :param key: The entry key.
+        :param orphan_only: Only remove the lock file of an entry that does not exist.
+        :return: Whether the entry was removed.
+        """
+        lock_file = self._acquire(key, blocking=False)
+        if lock_file is None:
+            return False
+        try:
+            if orphan_only and os.path.isdir(self._entry_path(key)):
+                return False
+            shutil.rmtree(self._entry_path(key), ignore_errors=True)
+            # removed while it is still held, waiters lock the new lock file instead
+            os.remove(self._lock_path(key))
+        finally:
+            lock_file.close()
+        return True
+
+    def evict(self, keep: Optional[str] = None) -> int:
+        """
+        Evict least-recently-used entries until the cache fits in max_bytes, and remove
+        temporary directories and lock files left over from crashed or failed fills.
+        Leased entries are never evicted.
+
+        :param keep: An entry key that must not be evicted.
+        :return: The number of bytes evicted.
+        """
+        evicted_bytes = 0
+        with self._lock(self.EVICT_LOCK):
+            now = time.time()
+            for name in os.listdir(self.root):
+                path = self._entry_path(name)
+                if name.startswith(".tmp-") and now - os.path.getmtime(path) > self.STALE_FILL_SECONDS:
+                    shutil.rmtree(path, ignore_errors=True)
+
+            entries = sorted(self._entries(), key=lambda entry: entry[1])
+            total_bytes = sum(size for _, _, size in entries)
+            for name, _, size in entries:
+                if total_bytes <= self.max_bytes:
+                    break
+                if name == keep or not self._remove(name):
+                    continue
+                total_bytes -= size
+                evicted_bytes += size
+
+            # lock files whose entry is gone, the entry of a held lock is being filled
+            for name in os.listdir(self.root):
+                key = name[1:-len(".lock")]
+                if name.startswith(".") and name.endswith(".lock") and key != self.EVICT_LOCK \
+                        and not os.path.isdir(self._entry_path(key)):
+                    self._remove(key, orphan_only=True)
+
+        return evicted_bytes
+
+
+class MetadataCache:
+    """
+    A thread safe in-process cache with a time to live, used to reuse project objects
+    and artifact metadata between calls instead of a round trip to the MLRun API.
+    Failed lookups are not cached.
+    """
+
+    def __init__(self, ttl: float = METADATA_CACHE_TTL_SECONDS):
+        """
+        Initialize the cache.
+
+        :param ttl: The seconds an entry is reused, 0 disables the cache.
+        """
+        self.ttl = ttl
+        self._entries: Dict[Tuple, Tuple[float, Any]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_fill(self, key: Tuple, fill: Callable[[], Any]) -> Any:
+        """
+        Get a cached value, filling it when it is missing or expired.
+
+        :param key: The entry key.
+        :param fill: Callable returning the value to cache.
+        :return: The cached value.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        value = fill()
+        if self.ttl > 0:
+            with self._lock:
+                self._entries[key] = (time.monotonic(), value)
+        return value
+
+    def invalidate(self, key: Optional[Tuple] = None):
+        """
+        Drop a cached entry.
+
+        :param key: The entry key, None drops every entry.
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+# endregion Local Cache
+
+
+# region Inference Output
+# schema of the enriched inference output, the first sample is flattened into the row and
+# the additional samples of n > 1 requests are kept in the samples column
+OUTPUT_SCHEMA = pa.schema([
+    ("prompt", pa.string()),
+    ("response", pa.string()),
+    ("finish_reason", pa.string()),
+    ("prompt_tokens", pa.int32()),
+    ("generated_tokens", pa.int32()),
+    ("latency_ms", pa.float64()),
+    ("ttft_ms", pa.float64()),
+    ("samples", pa.list_(pa.struct([
+        ("text", pa.string()),
+        ("finish_reason", pa.string()),
+        ("generated_tokens", pa.int32()),
+    ]))),
+])
+
+# parquet compression codec of the inference output
+OUTPUT_COMPRESSION = "zstd"
+
+
+def _outputs_to_table(outputs: List["RequestOutput"]) -> pa.Table:
+    """
+    Convert request outputs to a typed Arrow table, built column by column.
+
+    :param outputs: The request outputs returned by the engine.
+    :return: A table with a row per request output, in the OUTPUT_SCHEMA.
+    """
+    columns = {name: [] for name in OUTPUT_SCHEMA.names}
+    for output in outputs:
+        completions = output.outputs or []
+        first = completions[0] if completions else None
+        columns["prompt"].append(str(output.prompt) if output.prompt is not None else "")
+        columns["response"].append(
+            str(first.text) if first is not None and first.text is not None else "")
+        columns["finish_reason"].append(first.finish_reason if first is not None else None)
+        columns["prompt_tokens"].append(len(output.prompt_token_ids or []))
+        columns["generated_tokens"].append(len(first.token_ids) if first is not None else 0)
+        columns["samples"].append([
+            {"text": completion.text, "finish_reason": completion.finish_reason,
+             "generated_tokens": len(completion.token_ids)}
+            for completion in completions[1:]])
+
+        # timed by _generate_timed when the engine does not report them (cache hits have none)
+        metrics = getattr(output, "metrics", None)
+        finished_time = getattr(metrics, "finished_time", None)
+        first_token_time = getattr(metrics, "first_token_time", None)
+        columns["latency_ms"].append(
+            (finished_time - metrics.arrival_time) * 1000 if finished_time else None)
+        columns["ttft_ms"].append(
+            (first_token_time - metrics.arrival_time) * 1000 if first_token_time else None)
+
+    return pa.Table.from_pydict(columns, schema=OUTPUT_SCHEMA)
+
+
+class InferenceResultWriter:
+    """
+    Append inference results chunk by chunk to a local Parquet or JSONL file, so only
+    the current chunk is held in memory.
+    """
+
+    FORMATS = ("parquet", "jsonl")
+
+    def __init__(self, path: str, output_format: str = "parquet"):
+        """
+        Initialize the writer.
+
+        :param path: The local file to write the results to.
+        :param output_format: The file format, "parquet" or "jsonl".
+        """
+        if output_format not in self.FORMATS:
+            raise ValueError(
+                f"Unsupported output format {output_format}, expected one of {self.FORMATS}")
+
+        self.path = path
+        self.output_format = output_format
+        self.num_rows = 0
+        self._parquet_writer: Optional[pq.ParquetWriter] = None
+
+    def write(self, results: Union[pa.Table, List[Dict[str, Any]]]):
+        """
+        Append a chunk of results to the file.
+
+        :param results: The results of the chunk, a table in the OUTPUT_SCHEMA or its records.
+        """
+        if not isinstance(results, pa.Table):
+            results = pa.Table.from_pylist(results, schema=OUTPUT_SCHEMA)
+        if results.num_rows == 0:
+            return
+
+        if self.output_format == "parquet":
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(
+                    self.path, results.schema, compression=OUTPUT_COMPRESSION)
+            self._parquet_writer.write_table(results)
+        else:
+            with open(self.path, "a", encoding="utf-8") as f:
+                for record in results.to_pylist():
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+        self.num_rows += results.num_rows
+
+    def close(self):
+        """
+        Flush and close the file.
+        """
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+# endregion Inference Output
+
+
+# region Checkpointing
+class InferenceCheckpoint:
+    """
+    Periodic checkpoints of a chunked offline inference run on the artifact store.
+
+    The results of every completed chunk are stored as a Parquet part file, in the
+    OUTPUT_SCHEMA of the outputs dataset, next to a checkpoint.json recording how many leading chunks (and so which prompt indices)
+    are done. The part files are uploaded before the checkpoint file, so the
+    checkpoint never refers to a part that does not exist.
+
+    The checkpoint also records a fingerprint of the run (model version, sampling and
+    engine parameters) and a hash of the prompts of every completed chunk, so a rerun
+    with other prompts or parameters is refused instead of splicing in stale results.
+    """
+
+    CHECKPOINT_FILE = "checkpoint.json"
+    PART_FORMAT = "parquet"
+
+    def __init__(self, path: str, chunk_size: int, interval: int = 1, fingerprint: str = ""):
+        """
+        Initialize the checkpoint.
+
+        :param path: The artifact store directory (url) holding the checkpoint.
+        :param chunk_size: The chunk size of the run, a checkpoint with another chunk size is ignored.
+        :param interval: The number of chunks between checkpoint uploads.
+        :param fingerprint: The fingerprint of the run's model and parameters, a checkpoint
+                            with another fingerprint is refused.
+        """
+        self.path = path.rstrip("/")
+        self.chunk_size = chunk_size
+        self.interval = max(1, interval)
+        self.fingerprint = fingerprint
+        self.completed_chunks = 0
+        self.num_prompts = 0
+        self.chunk_hashes: List[str] = []
+        self._pending: List[Tuple[int, str, int]] = []
+        self._local_dir = tempfile.mkdtemp(prefix="vllm_checkpoint_")
+
+    def _part_url(self, chunk_index: int) -> str:
+        return f"{self.path}/part-{chunk_index:06d}.{self.PART_FORMAT}"
+
+    def load(self, logger) -> int:
+        """
+        Load the checkpoint of a previous run with the same run key.
+
+        :param logger: Logger to report the recovered state to.
+        :return: The number of leading chunks that are already completed.
+        """
+        try:
+            state = json.loads(mlrun.get_dataitem(
+                f"{self.path}/{self.CHECKPOINT_FILE}").get())
+        except FileNotFoundError:
+            return 0
+
+        if state["chunk_size"] != self.chunk_size:
+            logger.warning(
+                f"Ignoring checkpoint at {self.path}, it was written with chunk size "
+                f"{state['chunk_size']} instead of {self.chunk_size}")
+            return 0
+
+        if state.get("part_format", "jsonl") != self.PART_FORMAT:
+            logger.warning(
+                f"Ignoring checkpoint at {self.path}, its parts are stored as "
+                f"{state.get('part_format', 'jsonl')} instead of {self.PART_FORMAT}")
+            return 0
+
+        if state.get("fingerprint") != self.fingerprint:
+            raise ValueError(
+                f"The checkpoint at {self.path} was written by a run with another model "
+                f"version or other parameters, use a new run key or remove the checkpoint")
+
+        self.completed_chunks = state["completed_chunks"]
+        self.num_prompts = state["num_prompts"]
+        self.chunk_hashes = state["chunk_hashes"]
+        logger.info(
+            f"Resuming from checkpoint at {self.path}: {self.completed_chunks} chunks "
+            f"({state['num_prompts']} prompts) already completed")
+        return self.completed_chunks
+
+    @staticmethod
+    def prompts_hash(prompts: List[str]) -> str:
+        """
+        Hash the prompts of a chunk.
+
+        :param prompts: The prompts of the chunk.
+        :return: The hex digest.
+        """
+        return hashlib.sha256(json.dumps(prompts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def read_chunk(self, chunk_index: int, prompts: List[str]) -> pa.Table:
+        """
+        Read the results of a completed chunk.
+
+        :param chunk_index: The index of the chunk.
+        :param prompts: The prompts of the chunk in this run, they must be the prompts the
+                        results were generated for.
+        :return: The results table of the chunk.
+        """
+        if self.chunk_hashes[chunk_index] != self.prompts_hash(prompts):
+            raise ValueError(
+                f"The prompts of chunk {chunk_index} differ from the prompts checkpointed at "
+                f"{self.path}, use a new run key or remove the checkpoint")
+
+        body = mlrun.get_dataitem(self._part_url(chunk_index)).get()
+        return pq.read_table(pa.BufferReader(body)).cast(OUTPUT_SCHEMA)
+
+    def add_chunk(self, chunk_index: int, prompts: List[str], table: pa.Table):
+        """
+        Add the results of a newly completed chunk, uploading the checkpoint every
+        interval chunks.
+
+        :param chunk_index: The index of the chunk.
+        :param prompts: The prompts of the chunk.
+        :param table: The results table of the chunk.
+        """
+        self.chunk_hashes.append(self.prompts_hash(prompts))
+        local_path = os.path.join(self._local_dir, f"part-{chunk_index:06d}.{self.PART_FORMAT}")
+        pq.write_table(table, local_path, compression=OUTPUT_COMPRESSION)
+        self._pending.append((chunk_index, local_path, table.num_rows))
+
+        if len(self._pending) >= self.interval:
+            self.commit()
+
+    def commit(self):
+        """
+        Upload the pending part files and then the checkpoint file.
+        """
+        if not self._pending:
+            return
+
+        for chunk_index, local_path, num_records in self._pending:
+            mlrun.get_dataitem(self._part_url(chunk_index)).upload(local_path)
+            os.remove(local_path)
+            self.completed_chunks = chunk_index + 1
+            self.num_prompts += num_records
+        self._pending = []
+
+        mlrun.get_dataitem(f"{self.path}/{self.CHECKPOINT_FILE}").put(json.dumps({
+            "chunk_size": self.chunk_size,
+            "completed_chunks": self.completed_chunks,
+            "num_prompts": self.num_prompts,
+            "fingerprint": self.fingerprint,
+            "part_format": self.PART_FORMAT,
+            "chunk_hashes": self.chunk_hashes[:self.completed_chunks],
+        }))
+
+    def close(self):
+        """
+        Remove the local part files.
+        """
+        shutil.rmtree(self._local_dir, ignore_errors=True)
+
+
+def _default_checkpoint_path(context: mlrun.MLClientCtx, run_key: str) -> str:
+    """
+    Get the default checkpoint location of a run key. It is under the project artifact
+    path rather than the run artifact path, so a rerun with a new run uid finds it.
+
+    :param context: MLRun context.
+    :param run_key: The run key identifying the batch.
+    :return: The checkpoint directory url.
+    """
+    artifact_path = mlrun.utils.helpers.template_artifact_path(
+        mlrun.mlconf.artifact_path, context.project) or context.artifact_path
+    return f"{artifact_path.rstrip('/')}/checkpoints/{run_key}"
+# endregion Checkpointing
+
+
+# region Response Cache
+def _normalize_sampling_params(sampling_params: "SamplingParams") -> Dict[str, Any]:
+    """
+    Get the sampling parameters as a plain dict including the defaults, so equal
+    parameters always produce the same cache key.
+
+    :param sampling_params: The sampling parameters.
+    :return: The sampling parameters as a dict.
+    """
+    fields = getattr(sampling_params, "__struct_fields__", None)
+    if fields is None:
+        return dict(vars(sampling_params))
+    return {field: getattr(sampling_params, field) for field in fields}
+
+
+def _is_deterministic(sampling_params: "SamplingParams") -> bool:
+    """
+    Check whether the sampling parameters always produce the same output for a prompt.
+
+    :param sampling_params: The sampling parameters.
+    :return: True for greedy sampling or seeded random sampling.
+    """
+    return (getattr(sampling_params, "temperature", 1.0) or 0.0) < 1e-5 \
+        or getattr(sampling_params, "seed", None) is not None
+
+
+def _output_to_json(output: "RequestOutput") -> str:
+    """
+    Serialize the fields of a request output the inference results use. Only plain
+    values are stored, so a cache file never runs code when it is loaded and it stays
+    readable across vllm versions.
+
+    :param output: The request output.
+    :return: The JSON document.
+    """
+    return json.dumps({
+        "prompt": output.prompt,
+        "prompt_token_ids": list(output.prompt_token_ids or []),
+        "outputs": [{
+            "index": getattr(completion, "index", index),
+            "text": completion.text,
+            "token_ids": list(completion.token_ids),
+            "finish_reason": completion.finish_reason,
+        } for index, completion in enumerate(output.outputs)],
+    }, ensure_ascii=False)
+
+
+def _output_from_json(document: str) -> SimpleNamespace:
+    """
+    Rebuild a request output from its serialized fields.
+
+    :param document: The JSON document written by _output_to_json.
+    :return: An object with the prompt, prompt_token_ids and outputs of a RequestOutput,
+             the request metrics are not cached.
+    """
+    data = json.loads(document)
+    return SimpleNamespace(
+        prompt=data["prompt"],
+        prompt_token_ids=data["prompt_token_ids"],
+        outputs=[SimpleNamespace(**completion) for completion in data["outputs"]],
+        metrics=None,
+        finished=True)
+
+
+class ResponseCache:
+    """
+    A cache of request outputs in a local SQLite file, keyed by a hash of the prompt,
+    the normalized sampling parameters and the model artifact URI and version. The
+    file can be synced to the artifact store to be reused by later runs.
+
+    The outputs are stored as JSON documents of their plain fields, a cache file is
+    data only and is safe to load from a shared location.
+    """
+
+    # SQLite limits the number of variables in a single statement
+    QUERY_BATCH_SIZE = 500
+
+    def __init__(self, path: Optional[str] = None, remote_url: Optional[str] = None):
+        """
+        Initialize the cache, downloading the remote copy when there is no local file.
+
+        :param path: The local SQLite file, defaults to a temporary file.
+        :param remote_url: Optional artifact store url to load the cache from and sync it to.
+        """
+        self.path = path or os.path.join(
+            tempfile.mkdtemp(prefix="vllm_response_cache_"), "responses.sqlite")
+        self.remote_url = remote_url
+        self.hits = 0
+        self.misses = 0
+
+        if remote_url and not os.path.exists(self.path):
+            try:
+                mlrun.get_dataitem(remote_url).download(target_path=self.path)
+            except FileNotFoundError:
+                pass
+
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS response_documents (key TEXT PRIMARY KEY, output TEXT)")
+
+    @staticmethod
+    def key(prompt: str, sampling_key: str, model_key: str) -> str:
+        """
+        Build the cache key of a request.
+
+        :param prompt: The prompt.
+        :param sampling_key: The normalized sampling parameters, serialized.
+        :param model_key: The model artifact URI and version.
+        :return: The cache key.
+        """
+        return hashlib.sha256(
+            "\0".join((prompt, sampling_key, model_key)).encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, SimpleNamespace]:
+        """
+        Get the cached outputs of the given keys.
+
+        :param keys: The cache keys.
+        :return: Mapping of the cached keys to their outputs.
+        """
+        found = {}
+        for start in range(0, len(keys), self.QUERY_BATCH_SIZE):
+            batch = keys[start:start + self.QUERY_BATCH_SIZE]
+            rows = self._connection.execute(
+                f"SELECT key, output FROM response_documents WHERE key IN ({','.join('?' * len(batch))})",
+                batch)
+            found.update({key: _output_from_json(output) for key, output in rows})
+        return found
+
+    def put_many(self, outputs: Dict[str, "RequestOutput"]):
+        """
+        Store outputs in the cache.
+
+        :param outputs: Mapping of cache keys to their outputs.
+        """
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO response_documents (key, output) VALUES (?, ?)",
+                [(key, _output_to_json(output)) for key, output in outputs.items()])
+
+    def sync(self):
+        """
+        Upload the cache file to the remote url, if one is configured.
+        """
+        self._connection.commit()
+        if self.remote_url:
+            mlrun.get_dataitem(self.remote_url).upload(self.path)
+
+    def close(self):
+        """
+        Close the cache file.
+        """
+        self._connection.close()
+# endregion Response Cache
+
+
+# region Prompt Scheduling
+def _common_prefix_length(first: str, second: str) -> int:
+    """
+    Get the length of the longest common prefix of two strings.
+
+    :param first: The first string.
+    :param second: The second string.
+    :return: The number of leading characters the strings share.
+    """
+    return len(os.path.commonprefix([first, second]))
+
+
+def _schedule_prompts(
+    prompts: List[str],
+    token_lengths: List[int],
+    min_prefix_chars: int = SCHEDULE_MIN_PREFIX_CHARS
+) -> List[int]:
+    """
+    Order prompts so that prompts sharing a prefix are submitted together, and prompts
+    of similar tokenized length are adjacent.
+
+    The prompts are sorted by text, which places every shared prefix (of any length) in
+    one run, and the runs whose prompts share at least min_prefix_chars leading
+    characters with the first prompt of the run become prefix groups. Prompts of a group
+    are bucketed by length, the prompts that share no prefix are bucketed by length
+    across the whole batch.
+
+    :param prompts: The prompts in the caller's order.
+    :param token_lengths: The tokenized length of each prompt.
+    :param min_prefix_chars: The number of leading characters prompts must share to be
+                             grouped.
+    :return: The prompt indices in submission order.
+    """
+    # split the text order into runs sharing a prefix with their first prompt
+    runs = []
+    for index in sorted(range(len(prompts)), key=lambda index: prompts[index]):
+        if runs and _common_prefix_length(prompts[runs[-1][0]], prompts[index]) >= min_prefix_chars:
+            runs[-1].append(index)
+        else:
+            runs.append([index])
+    groups = [run for run in runs if len(run) > 1]
+    ungrouped = [run[0] for run in runs if len(run) == 1]
+
+    # power of two length buckets, then text order to keep longer shared prefixes adjacent
+    def bucketed(indices: List[int]) -> List[int]:
+        return sorted(
+            indices, key=lambda index: (token_lengths[index].bit_length(), prompts[index]))
+
+    order = []
+    # the largest groups first, they benefit the most from prefix caching
+    for group in sorted(groups, key=lambda group: -len(group)):
+        order.extend(bucketed(group))
+    order.extend(bucketed(ungrouped))
+    return order
+
+
+def _prefix_sharing_ratio(
+    prompts: List[str],
+    order: List[int],
+    min_prefix_chars: int = SCHEDULE_MIN_PREFIX_CHARS
+) -> float:
+    """
+    Get the fraction of adjacent prompts that share a prefix in the given order.
+
+    :param prompts: The prompts.
+    :param order: The submission order of the prompt indices.
+    :param min_prefix_chars: The number of leading characters adjacent prompts must share.
+    :return: The fraction of adjacent pairs sharing a prefix.
+    """
+    if len(order) < 2:
+        return 0.0
+    shared = sum(
+        1 for previous, current in zip(order, order[1:])
+        if _common_prefix_length(prompts[previous], prompts[current]) >= min_prefix_chars)
+    return shared / (len(order) - 1)
+# endregion Prompt Scheduling
+
+
+# region Token Planning
+def _length_histogram(token_lengths: List[int]) -> Dict[str, int]:
+    """
+    Count the token lengths in power of two buckets.
+
+    :param token_lengths: The tokenized length of each prompt.
+    :return: The number of prompts per bucket, keyed by the bucket's upper bound ("<=64").
+    """
+    counts = defaultdict(int)
+    for length in token_lengths:
+        counts[1 << max(length - 1, 0).bit_length()] += 1
+    return {f"<={bound}": counts[bound] for bound in sorted(counts)}
+
+
+def _plan_batches(
+    token_lengths: List[int],
+    max_tokens: int = 16,
+    max_model_len: Optional[int] = None,
+    chunk_tokens: int = PLAN_CHUNK_TOKENS
+) -> Dict[str, Any]:
+    """
+    Suggest an engine context length and a chunk size for a prompt set.
+
+    :param token_lengths: The tokenized length of each prompt.
+    :param max_tokens: The number of tokens generated per prompt.
+    :param max_model_len: The context length the engine will run with, prompts that do not
+                          fit it with max_tokens are counted as too long.
+    :param chunk_tokens: The token budget of a chunk.
+    :return: The suggested max_model_len and chunk_size, the resulting number of chunks,
+             the estimated total tokens and the number of prompts that are too long.
+    """
+    if not token_lengths:
+        return {"max_model_len": None, "chunk_size": None, "num_chunks": 0,
+                "estimated_total_tokens": 0, "num_too_long": 0}
+
+    longest = max(token_lengths) + max_tokens
+    mean_request_tokens = sum(token_lengths) / len(token_lengths) + max_tokens
+    chunk_size = max(1, int(chunk_tokens // mean_request_tokens))
+    return {
+        "max_model_len": -(-longest // PLAN_MODEL_LEN_MULTIPLE) * PLAN_MODEL_LEN_MULTIPLE,
+        "chunk_size": chunk_size,
+        "num_chunks": -(-len(token_lengths) // chunk_size),
+        "estimated_total_tokens": sum(token_lengths) + max_tokens * len(token_lengths),
+        "num_too_long": sum(
+            1 for length in token_lengths if length + max_tokens > max_model_len)
+        if max_model_len else 0,
+    }
+# endregion Token Planning
+
+
+# region Inference Metrics
+def _percentile(sorted_values: List[float], q: float) -> Optional[float]:
+    """
+    Get a percentile of sorted values with the nearest-rank method.
+
+    :param sorted_values: The values in ascending order.
+    :param q: The percentile, between 0 and 100.
+    :return: The percentile, None when there are no values.
+    """
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(q / 100 * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+
+class InferenceMetrics:
+    """
+    Phase timings and token throughput of offline inference runs. The phases are
+    accumulated over every call of the model server, so a chunked run reports its
+    totals.
+    """
+
+    def __init__(self):
+        self.phase_seconds: Dict[str, float] = defaultdict(float)
+        self.phase_calls: Dict[str, int] = defaultdict(int)
+        self.num_requests = 0
+        self.prompt_tokens = 0
+        self.generated_tokens = 0
+        self.latencies: List[float] = []
+        self.scheduled_prompts = 0
+        self._prefix_sharing_before = 0.0
+        self._prefix_sharing_after = 0.0
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """
+        Time a phase of the run.
+
+        :param name: The name of the phase.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phase_seconds[name] += time.perf_counter() - start
+            self.phase_calls[name] += 1
+
+    def record_outputs(self, outputs: List["RequestOutput"]):
+        """
+        Record the token counts and latencies of generated request outputs.
+
+        :param outputs: The request outputs.
+        """
+        for output in outputs:
+            self.num_requests += 1
+            self.prompt_tokens += len(output.prompt_token_ids or [])
+            self.generated_tokens += sum(
+                len(completion.token_ids) for completion in output.outputs)
+
+            # timed by _generate_timed when the engine does not report them
+            metrics = getattr(output, "metrics", None)
+            if metrics is not None and getattr(metrics, "finished_time", None):
+                self.latencies.append(metrics.finished_time - metrics.arrival_time)
+
+    def record_schedule(self, num_prompts: int, before: float, after: float):
+        """
+        Record the adjacent prefix sharing of a scheduled batch before and after scheduling.
+
+        :param num_prompts: The number of prompts of the batch.
+        :param before: The prefix sharing ratio in the caller's order.
+        :param after: The prefix sharing ratio in the scheduled order.
+        """
+        self.scheduled_prompts += num_prompts
+        self._prefix_sharing_before += before * num_prompts
+        self._prefix_sharing_after += after * num_prompts
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Summarize the run.
+
+        :return: The phase timings, token counts, throughput and latency percentiles.
+        """
+        generate_seconds = self.phase_seconds.get("generate", 0.0)
+        latencies = sorted(self.latencies)
+        summary = {
+            f"phase_{name}_seconds": round(seconds, 4)
+            for name, seconds in self.phase_seconds.items()
+        }
+        summary.update({
+            "num_requests": self.num_requests,
+            "prompt_tokens": self.prompt_tokens,
+            "generated_tokens": self.generated_tokens,
+            "tokens_per_second":
+                (self.prompt_tokens + self.generated_tokens) / generate_seconds
+                if generate_seconds else None,
+            "generated_tokens_per_second":
+                self.generated_tokens / generate_seconds if generate_seconds else None,
+        })
+        # the sharing and throughput of runs with and without scheduling can be compared
+        summary["scheduled_prompts"] = self.scheduled_prompts
+        summary["prefix_sharing_before"] = (
+            self._prefix_sharing_before / self.scheduled_prompts if self.scheduled_prompts else None)
+        summary["prefix_sharing_after"] = (
+            self._prefix_sharing_after / self.scheduled_prompts if self.scheduled_prompts else None)
+        for q in (50, 90, 99):
+            latency = _percentile(latencies, q)
+            summary[f"latency_p{q}_ms"] = latency * 1000 if latency is not None else None
+        return summary
+
+def _final_only(sampling_params: "SamplingParams") -> "SamplingParams":
+    """
+    Copy sampling parameters so the engine returns the output of a request only once it
+    finishes, as LLM.generate does, instead of rebuilding the cumulative output of every
+    running request on each step.
+
+    :param sampling_params: The sampling parameters, they are not modified.
+    :return: The FINAL_ONLY copy.
+    """
+    sampling_params = sampling_params.clone() if hasattr(sampling_params, "clone") \
+        else copy.copy(sampling_params)
+    sampling_params.output_kind = RequestOutputKind.FINAL_ONLY
+    return sampling_params
+
+
+def _generate_timed(
+    llm: "LLM",
+    prompts: List[str],
+    sampling_params: Union["SamplingParams", List["SamplingParams"], None]
+) -> List["RequestOutput"]:
+    """
+    Generate the prompts by stepping the engine, timing every request on the way. The
+    requests are added with FINAL_ONLY outputs like LLM.generate adds them, so the steps
+    cost no more than in LLM.generate. The engine leaves RequestOutput.metrics unset
+    unless stats logging is enabled, so the arrival and finish times measured here are
+    filled in where it is missing, for the latency percentiles and the latency_ms output
+    column. The first token time, and so the ttft_ms column, comes from the engine only.
+
+    :param llm: The LLM engine.
+    :param prompts: List of prompts to process.
+    :param sampling_params: Sampling parameters for all the prompts, or one per prompt.
+    :return: List of RequestOutput in the order of the prompts.
+    """
+    if isinstance(sampling_params, list):
+        sampling_params = [_final_only(params) for params in sampling_params]
+    else:
+        sampling_params = [_final_only(sampling_params or SamplingParams())] * len(prompts)
+    engine = llm.llm_engine
+    request_ids = {}
+    arrival_times = {}
+    outputs = [None] * len(prompts)
+    # one unique prefix per call, the request ids only need to be unique in the engine
+    prefix = f"offline-{uuid.uuid4().hex}"
+    for index, (prompt, params) in enumerate(zip(prompts, sampling_params)):
+        request_id = f"{prefix}-{index}"
+        request_ids[request_id] = index
+        arrival_times[index] = time.time()
+        engine.add_request(request_id, prompt, params)
+
+    while engine.has_unfinished_requests():
+        for output in engine.step():
+            index = request_ids.get(output.request_id)
+            if index is None or not output.finished:
+                continue
+            if getattr(output, "metrics", None) is None:
+                output.metrics = SimpleNamespace(
+                    arrival_time=arrival_times[index],
+                    first_token_time=None,
+                    finished_time=time.time())
+            outputs[index] = output
+
+    return outputs
+# endregion Inference Metrics
+
+
+# region Data Parallel
+def _build_worker_engine(engine_args: Dict[str, Any]) -> "LLM":
+    """
+    Build the LLM engine of a data-parallel worker process.
+
+    :param engine_args: Keyword arguments passed to LLM().
+    :return: The LLM engine.
+    """
+    return LLM(**engine_args)
+
+
+def _engine_worker(
+    worker_id: int,
+    engine_factory: Callable[[Dict[str, Any]], Any],
+    engine_args: Dict[str, Any],
+    env: Dict[str, str],
+    tasks: "multiprocessing.Queue",
+    results: "multiprocessing.Queue"
+):
+    """
+    The loop of a data-parallel worker process: build an engine, then generate the
+    shards pulled from the shared task queue until the None sentinel is received.
+
+    :param worker_id: The index of the worker.
+    :param engine_factory: Callable building the engine from engine_args.
+    :param engine_args: Keyword arguments passed to the engine factory.
+    :param env: Environment variables pinning the worker to its devices or cores.
+    :param tasks: Queue of (shard_index, prompts, sampling_params) tasks.
+    :param results: Queue of (worker_id, shard_index, outputs, seconds, error) results.
+    """
+    os.environ.update(env)
+    try:
+        llm = engine_factory(engine_args)
+    except Exception as exc:
+        results.put((worker_id, None, None, 0.0, repr(exc)))
+        return
+    results.put((worker_id, None, None, 0.0, None))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        shard_index, prompts, sampling_params = task
+        start = time.perf_counter()
+        try:
+            outputs = _generate_timed(llm, prompts, sampling_params)
+        except Exception as exc:
+            results.put((worker_id, shard_index, None, 0.0, repr(exc)))
+            continue
+        results.put((worker_id, shard_index, outputs, time.perf_counter() - start, None))
+
+
+def _worker_envs(num_workers: int, devices_per_worker: int = 1) -> List[Dict[str, str]]:
+    """
+    Split the visible accelerators, or the CPU cores when there are none, between the
+    data-parallel workers.
+
+    :param num_workers: The number of workers.
+    :param devices_per_worker: The number of accelerators each worker uses (the tensor
+                               parallel size).
+    :return: The environment variables of each worker.
+    """
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible is not None:
+        devices = [device for device in visible.split(",") if device]
+    else:
+        try:
+            import torch
+            devices = [str(device) for device in range(torch.cuda.device_count())]
+        except ImportError:
+            devices = []
+
+    if len(devices) >= num_workers * devices_per_worker:
+        return [
+            {"CUDA_VISIBLE_DEVICES": ",".join(
+                devices[worker * devices_per_worker:(worker + 1) * devices_per_worker])}
+            for worker in range(num_workers)
+        ]
+
+    # the CPU backend binds its OpenMP threads to a core range per worker
+    cores = sorted(os.sched_getaffinity(0))
+    per_worker = len(cores) // num_workers
+    if per_worker == 0:
+        return [{} for _ in range(num_workers)]
+    return [
+        {"VLLM_CPU_OMP_THREADS_BIND":
+            f"{cores[worker * per_worker]}-{cores[(worker + 1) * per_worker - 1]}"}
+        for worker in range(num_workers)
+    ]
+
+
+class EngineWorkerPool:
+    """
+    A pool of engine worker processes for data-parallel offline inference. Prompts are
+    split into small shards pulled from a shared queue, so a worker that finishes its
+    shard early takes the next one and uneven prompt lengths do not leave workers idle.
+    A worker process that dies (e.g. killed for running out of memory) fails the pool
+    instead of leaving the parent waiting for its results.
+    """
+
+    # number of shards per worker, more shards balance better but cost more messages
+    SHARDS_PER_WORKER = 8
+
+    # seconds between the liveness checks of the workers while waiting for results
+    RESULT_POLL_SECONDS = 1.0
+
+    def __init__(
+        self,
+        num_workers: int,
+        engine_args: Dict[str, Any],
+        worker_envs: Optional[List[Dict[str, str]]] = None,
+        engine_factory: Callable[[Dict[str, Any]], Any] = _build_worker_engine,
+        start_method: str = "spawn",
+        result_timeout: Optional[float] = None
+    ):
+        """
+        Start the worker processes and wait until every engine is built.
+
+        :param num_workers: The number of worker processes.
+        :param engine_args: Keyword arguments passed to LLM() in each worker.
+        :param worker_envs: Environment variables of each worker, split from the visible
+                            devices by default.
+        :param engine_factory: Module level callable building the engine in a worker.
+        :param start_method: The multiprocessing start method, spawn keeps the workers
+                             clear of the parent's device state.
+        :param result_timeout: Seconds to wait for the next result of a live worker before
+                               failing, None waits as long as the workers are alive.
+        """
+        self.num_workers = num_workers
+        self.result_timeout = result_timeout
+        mp_context = multiprocessing.get_context(start_method)
+        self._tasks = mp_context.Queue()
+        self._results = mp_context.Queue()
+        worker_envs = worker_envs or _worker_envs(
+            num_workers, engine_args.get("tensor_parallel_size", 1))
+        self._processes = [
+            mp_context.Process(
+                target=_engine_worker,
+                args=(worker, engine_factory, engine_args, worker_envs[worker],
+                      self._tasks, self._results),
+                daemon=False)
+            for worker in range(num_workers)
+        ]
+        # the workers are not daemonic since the engine starts processes of its own (the V1
+        # engine core, tensor parallel workers), so they are stopped at exit instead
+        self._closed = False
+        atexit.register(self.close)
+        for process in self._processes:
+            process.start()
+
+        # wait for the engines, a failed worker fails the pool
+        errors = []
+        for _ in range(num_workers):
+            worker, _, _, _, error = self._get_result()
+            if error is not None:
+                errors.append(f"worker {worker}: {error}")
+        if errors:
+            self.close()
+            raise RuntimeError(f"Failed to start engine workers: {'; '.join(errors)}")
+
+    def generate(
+        self,
+        prompts: List[str],
+        sampling_params: "SamplingParams",
+        shard_size: Optional[int] = None
+    ) -> Tuple[List["RequestOutput"], Dict[int, Dict[str, float]]]:
+        """
+        Generate the prompts across the workers. The shards are queued longest first, by
+        the total character length of their prompts.
+
+        :param prompts: List of prompts to process.
+        :param sampling_params: Sampling parameters for the model.
+        :param shard_size: The number of prompts per shard, by default each worker gets
+                           about SHARDS_PER_WORKER shards.
+        :return: The outputs in the order of the prompts, and the prompts, generated
+                 tokens, busy seconds and throughput of each worker.
+        """
+        shard_size = shard_size or max(
+            1, math.ceil(len(prompts) / (self.num_workers * self.SHARDS_PER_WORKER)))
+        shards = list(range(0, len(prompts), shard_size))
+
+        # the shards are ranked by their length in characters, a cheap stand-in for the
+        # token count, and the longest go first so no long shard is left for the end
+        for shard_index in sorted(
+                range(len(shards)),
+                key=lambda index: -sum(
+                    len(prompt) for prompt in prompts[shards[index]:shards[index] + shard_size])):
+            start = shards[shard_index]
+            self._tasks.put((shard_index, prompts[start:start + shard_size], sampling_params))
+
+        outputs = [None] * len(prompts)
+        stats = {
+            worker: {"prompts": 0, "generated_tokens": 0, "seconds": 0.0}
+            for worker in range(self.num_workers)
+        }
+        errors = []
+        for _ in shards:
+            worker, shard_index, shard_outputs, seconds, error = self._get_result()
+            if error is not None:
+                errors.append(f"worker {worker}: {error}")
+                continue
+            start = shards[shard_index]
+            outputs[start:start + len(shard_outputs)] = shard_outputs
+            stats[worker]["prompts"] += len(shard_outputs)
+            stats[worker]["generated_tokens"] += sum(
+                len(completion.token_ids)
+                for output in shard_outputs for completion in output.outputs)
+            stats[worker]["seconds"] += seconds
+        if errors:
+            raise RuntimeError(f"Data-parallel generation failed: {'; '.join(errors)}")
+
+        for worker_stats in stats.values():
+            worker_stats["generated_tokens_per_second"] = (
+                worker_stats["generated_tokens"] / worker_stats["seconds"]
+                if worker_stats["seconds"] else 0.0)
+        return outputs, stats
+
+    def _get_result(self) -> Tuple[int, Optional[int], Any, float, Optional[str]]:
+        """
+        Wait for the next worker result, checking between polls that the workers are alive.
+        A dead worker takes the shard it was generating with it, so the pool is closed and
+        the call fails.
+
+        :return: The (worker_id, shard_index, outputs, seconds, error) result.
+        """
+        waited = 0.0
+        while True:
+            try:
+                return self._results.get(timeout=self.RESULT_POLL_SECONDS)
+            except queue.Empty:
+                waited += self.RESULT_POLL_SECONDS
+
+            dead = [
+                f"worker {worker} exited with code {process.exitcode}"
+                for worker, process in enumerate(self._processes) if not process.is_alive()]
+            if dead:
+                self.close()
+                raise RuntimeError(f"Engine workers died: {'; '.join(dead)}")
+            if self.result_timeout is not None and waited >= self.result_timeout:
+                self.close()
+                raise RuntimeError(
+                    f"No result from the engine workers in {self.result_timeout} seconds")
+
+    def close(self):
+        """
+        Stop the worker processes, terminating the ones that do not exit in time.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        for _ in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+                process.join(timeout=5)
+            if process.is_alive():
+                process.kill()
+                process.join()
+# endregion Data Parallel
+
+
+# region Micro Batching
+# the priority class of requests that do not name one
+DEFAULT_PRIORITY = "default"
+
+
+class QueueFullError(RuntimeError):
+    """
+    Raised when the queue of a priority class is full, with a hint of when to retry.
+    """
+
+    def __init__(self, priority: str, retry_after: int):
+        """
+        Initialize the error.
+
+        :param priority: The priority class whose queue is full.
+        :param retry_after: Seconds after which the queue is expected to have room.
+        """
+        super().__init__(f"The {priority} queue is full, retry after {retry_after} seconds")
+        self.priority = priority
+        self.retry_after = retry_after
+
+
+def _wait_bucket(wait_ms: float) -> int:
+    """
+    Get the power of two bucket of a queue wait time.
+
+    :param wait_ms: The wait time in ms.
+    :return: The bucket's upper bound in ms.
+    """
+    return 1 << max(math.ceil(wait_ms) - 1, 0).bit_length()
+
+
+class _PendingRequest:
+    """
+    A request waiting in the micro-batcher queue.
+    """
+
+    def __init__(
+        self,
+        prompt: str,
+        sampling_params: "SamplingParams",
+        queue_depth: int,
+        stream: bool = False,
+        priority: str = DEFAULT_PRIORITY
+    ):
+        self.prompt = prompt
+        self.sampling_params = sampling_params
+        self.queue_depth = queue_depth
+        self.priority = priority
+        self.enqueued_at = time.perf_counter()
+        self.future = Future()
+
+        # text deltas of a streaming request, None marks the end of the stream
+        self.deltas: Optional["queue.Queue[Optional[str]]"] = queue.Queue() if stream else None
+        self.text = ""
+        self.token_times: List[float] = []
+
+    def add_update(self, text: str):
+        """
+        Record a cumulative text update of the request and publish its delta.
+
+        :param text: The text generated so far.
+        """
+        delta = text[len(self.text):]
+        if not delta:
+            return
+        self.text = text
+        self.token_times.append(time.perf_counter())
+        if self.deltas is not None:
+            self.deltas.put(delta)
+
+    def latency_stats(self) -> Dict[str, Optional[float]]:
+        """
+        Get the time-to-first-token and inter-token latencies of a streamed request.
+
+        :return: The latency stats in ms, None when no tokens were streamed.
+        """
+        if not self.token_times:
+            return {"ttft_ms": None, "mean_itl_ms": None, "max_itl_ms": None}
+        gaps = [
+            (current - previous) * 1000
+            for previous, current in zip(self.token_times, self.token_times[1:])]
+        return {
+            "ttft_ms": (self.token_times[0] - self.enqueued_at) * 1000,
+            "mean_itl_ms": sum(gaps) / len(gaps) if gaps else None,
+            "max_itl_ms": max(gaps) if gaps else None,
+        }
+
+
+class RequestMicroBatcher:
+    """
+    Collect concurrent requests into micro-batches and run each batch as a single
+    generate call on a background thread. A batch is dispatched once it holds
+    max_batch_size requests or its first request has waited max_wait_ms. Batches
+    holding a streaming request are run incrementally and publish text deltas.
+
+    Requests are queued per priority class and the slots of a batch are shared between
+    the waiting classes by their weights (smooth weighted round robin), so a class with
+    weight 4 gets four slots for every slot of a class with weight 1 under load. A full
+    class queue rejects new requests at once with a retry-after hint.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[List[str], List["SamplingParams"]], List["RequestOutput"]],
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5.0,
+        run_stream_batch: Optional[Callable[
+            [List[str], List["SamplingParams"]], Iterator[Tuple[int, "RequestOutput"]]]] = None,
+        priority_weights: Optional[Dict[str, int]] = None,
+        max_queue_size: int = 0,
+        default_priority: Optional[str] = None
+    ):
+        """
+        Initialize the micro-batcher.
+
+        :param run_batch: Callable generating the outputs of a batch of prompts, with
+                          one SamplingParams per prompt.
+        :param max_batch_size: The maximum number of requests in a batch.
+        :param max_wait_ms: The maximum time the first request of a batch waits for more requests.
+        :param run_stream_batch: Callable generating a batch incrementally, yielding the prompt
+                                 index and its cumulative output after every engine step.
+        :param priority_weights: The scheduling weight of each priority class, a single
+                                 "default" class by default.
+        :param max_queue_size: The maximum number of queued requests per priority class, 0 for
+                               unbounded queues.
+        :param default_priority: The class of requests that do not name one, "default" when it
+                                 is a class, otherwise the first class.
+        """
+        self.run_batch = run_batch
+        self.run_stream_batch = run_stream_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.priority_weights = dict(priority_weights or {DEFAULT_PRIORITY: 1})
+        if any(weight <= 0 for weight in self.priority_weights.values()):
+            raise ValueError("The priority weights must be positive")
+        self.max_queue_size = max_queue_size
+        self.default_priority = default_priority or (
+            DEFAULT_PRIORITY if DEFAULT_PRIORITY in self.priority_weights
+            else next(iter(self.priority_weights)))
+        if self.default_priority not in self.priority_weights:
+            raise ValueError(f"The default priority {self.default_priority} is not a priority class")
+
+        self._queues: Dict[str, Deque[_PendingRequest]] = {
+            priority: deque() for priority in self.priority_weights}
+        self._credits = {priority: 0 for priority in self.priority_weights}
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+        # recent batch duration for the retry-after hint, and the per-class counters
+        self._batch_seconds: Optional[float] = None
+        self._submitted = defaultdict(int)
+        self._rejected = defaultdict(int)
+        self._wait_histograms: Dict[str, Dict[int, int]] = {
+            priority: defaultdict(int) for priority in self.priority_weights}
+
+    def close(self):
+        """
+        Stop the dispatch thread once the queued requests are dispatched.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def submit(
+        self,
+        prompt: str,
+        sampling_params: "SamplingParams",
+        stream: bool = False,
+        priority: Optional[str] = None
+    ) -> _PendingRequest:
+        """
+        Queue a request for the next micro-batch.
+
+        :param prompt: The prompt.
+        :param sampling_params: Sampling parameters for the prompt.
+        :param stream: Publish the text deltas of the request while it is generated.
+        :param priority: The priority class of the request, the default class when not given.
+        :return: The pending request, its future resolves to the request output and its
+                 batching stats and its deltas queue yields the streamed text.
+        """
+        return self.submit_many([prompt], sampling_params, stream=stream, priority=priority)[0]
+
+    def submit_many(
+        self,
+        prompts: List[str],
+        sampling_params: "SamplingParams",
+        stream: bool = False,
+        priority: Optional[str] = None
+    ) -> List[_PendingRequest]:
+        """
+        Queue the prompts of one request for the next micro-batches, all or none of them.
+
+        :param prompts: The prompts.
+        :param sampling_params: Sampling parameters for the prompts.
+        :param stream: Publish the text deltas of the requests while they are generated.
+        :param priority: The priority class of the request, the default class when not given.
+        :return: The pending request of each prompt.
+
+        :raise QueueFullError: When the queue of the priority class has no room for the prompts.
+        """
+        if stream and self.run_stream_batch is None:
+            raise ValueError("Streaming requires a run_stream_batch callable")
+        priority = priority or self.default_priority
+        if priority not in self._queues:
+            raise ValueError(
+                f"Unknown priority class {priority}, expected one of {list(self._queues)}")
+
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The micro-batcher is closed")
+            # the dispatch thread is started on first use
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="vllm-micro-batcher", daemon=True)
+                self._thread.start()
+
+            pending = self._queues[priority]
+            if self.max_queue_size and len(pending) + len(prompts) > self.max_queue_size:
+                self._rejected[priority] += len(prompts)
+                raise QueueFullError(priority, self._retry_after(len(pending)))
+
+            requests = []
+            for prompt in prompts:
+                request = _PendingRequest(
+                    prompt, sampling_params, queue_depth=len(pending), stream=stream,
+                    priority=priority)
+                pending.append(request)
+                requests.append(request)
+            self._submitted[priority] += len(prompts)
+            self._condition.notify()
+        return requests
+
+    def _retry_after(self, queue_depth: int) -> int:
+        """
+        Estimate when a full queue has room again, from the recent batch duration.
+
+        :param queue_depth: The number of queued requests of the class.
+        :return: The seconds to wait, at least 1.
+        """
+        batches = math.ceil(queue_depth / self.max_batch_size)
+        return max(1, math.ceil(batches * (self._batch_seconds or 1.0)))
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Get the queue state and counters of every priority class.
+
+        :return: The weight, queue depth, queue size limit, submitted and rejected requests and
+                 the queue wait histogram (power of two ms buckets, "<=8") of each class.
+        """
+        with self._condition:
+            return {
+                priority: {
+                    "weight": weight,
+                    "queue_depth": len(self._queues[priority]),
+                    "max_queue_size": self.max_queue_size,
+                    "submitted": self._submitted[priority],
+                    "rejected": self._rejected[priority],
+                    "wait_ms_histogram": {
+                        f"<={bound}": count
+                        for bound, count in sorted(self._wait_histograms[priority].items())},
+                }
+                for priority, weight in self.priority_weights.items()
+            }
+
+    def _pop(self) -> _PendingRequest:
+        """
+        Take the next request by smooth weighted round robin over the classes with
+        queued requests, called with the condition held.
+
+        :return: The request.
+        """
+        waiting = [priority for priority, pending in self._queues.items() if pending]
+        for priority in waiting:
+            self._credits[priority] += self.priority_weights[priority]
+        priority = max(waiting, key=lambda name: self._credits[name])
+        self._credits[priority] -= sum(self.priority_weights[name] for name in waiting)
+
+        request = self._queues[priority].popleft()
+        wait_ms = (time.perf_counter() - request.enqueued_at) * 1000
+        self._wait_histograms[priority][_wait_bucket(wait_ms)] += 1
+        return request
+
+    def _next_batch(self) -> List[_PendingRequest]:
+        """
+        Wait for the next batch of requests.
+
+        :return: The requests of the batch, empty once the batcher is closed and drained.
+        """
+        with self._condition:
+            while not self._closed and not any(self._queues.values()):
+                self._condition.wait()
+            if not any(self._queues.values()):
+                return []
+
+            batch = [self._pop()]
+            deadline = batch[0].enqueued_at + self.max_wait_ms / 1000
+            while len(batch) < self.max_batch_size:
+                if any(self._queues.values()):
+                    batch.append(self._pop())
+                    continue
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0 or self._closed:
+                    break
+                self._condition.wait(timeout=remaining)
+        return batch
+
+    def _generate(self, batch: List[_PendingRequest]) -> List["RequestOutput"]:
+        """
+        Generate the outputs of a batch, incrementally when a request streams.
+
+        :param batch: The requests of the batch.
+        :return: The request outputs in the order of the batch.
+        """
+        prompts = [request.prompt for request in batch]
+        sampling_params = [request.sampling_params for request in batch]
+        if all(request.deltas is None for request in batch):
+            return self.run_batch(prompts, sampling_params)
+
+        outputs: List[Optional["RequestOutput"]] = [None] * len(batch)
+        for index, output in self.run_stream_batch(prompts, sampling_params):
+            batch[index].add_update(output.outputs[0].text)
+            outputs[index] = output
+        return outputs
+
+    def _dispatch(self, batch: List[_PendingRequest]):
+        """
+        Generate a batch and resolve the future of every request in it.
+
+        :param batch: The requests of the batch.
+        """
+        dispatched_at = time.perf_counter()
+        outputs = list(self._generate(batch))
+        if len(outputs) != len(batch) or any(output is None for output in outputs):
+            raise RuntimeError(
+                f"The engine returned {sum(output is not None for output in outputs)} outputs "
+                f"for a batch of {len(batch)} requests")
+
+        for request, output in zip(batch, outputs):
+            request.future.set_result({
+                "output": output,
+                "batch_size": len(batch),
+                "queue_depth": request.queue_depth,
+                "queue_wait_ms": (dispatched_at - request.enqueued_at) * 1000,
+                "priority": request.priority,
+                **(request.latency_stats() if request.deltas is not None else {}),
+            })
+
+    def _run(self):
+        """
+        Dispatch micro-batches until the batcher is closed. A failing batch fails the
+        requests it did not resolve and never stops the dispatch thread.
+        """
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            start = time.perf_counter()
+            try:
+                self._dispatch(batch)
+            except Exception as exc:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(exc)
+
+            # close the delta streams, the consumers stop at the None sentinel
+            for request in batch:
+                if request.deltas is not None:
+                    request.deltas.put(None)
+
+            elapsed = time.perf_counter() - start
+            self._batch_seconds = elapsed if self._batch_seconds is None \
+                else 0.8 * self._batch_seconds + 0.2 * elapsed
+# endregion Micro Batching
+
+
+# region Pipelined Execution
+# marks the end of the items flowing through a pipeline queue
+_PIPELINE_END = object()
+
+
+class PipelineStage:
+    """
+    Busy and idle time of a stage of a pipelined run. A stage is idle while it waits for
+    an item from the stage before it or for room in the queue of the stage after it, so
+    the stage with the most busy time is the bottleneck of the run.
+    """
+
+    def __init__(self, name: str):
+        """
+        Initialize the stage timings.
+
+        :param name: The name of the stage.
+        """
+        self.name = name
+        self.busy_seconds = 0.0
+        self.idle_seconds = 0.0
+        self.num_items = 0
+
+    @contextmanager
+    def busy(self) -> Iterator[None]:
+        """
+        Time work on an item.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.busy_seconds += time.perf_counter() - start
+
+    @contextmanager
+    def idle(self) -> Iterator[None]:
+        """
+        Time a wait on a neighbouring stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.idle_seconds += time.perf_counter() - start
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Summarize the stage.
+
+        :return: The busy and idle seconds, the number of items and the busy share of the
+                 stage's time.
+        """
+        total = self.busy_seconds + self.idle_seconds
+        return {
+            f"stage_{self.name}_busy_seconds": round(self.busy_seconds, 4),
+            f"stage_{self.name}_idle_seconds": round(self.idle_seconds, 4),
+            f"stage_{self.name}_items": self.num_items,
+            f"stage_{self.name}_utilization": round(self.busy_seconds / total, 4) if total else None,
+        }
+
+
+class PipelinedExecutor:
+    """
+    Run items through a prefetch, a generate and a write stage that overlap, with bounded
+    queues between them, so the engine generates a chunk while the next chunk is read and
+    the previous one is written.
+
+    The generate stage runs on the calling thread, which keeps the engine on the thread
+    that built it, the prefetch and write stages run on their own threads. Items are written
+    in the order they are read. An error in the prefetch or generate stage is raised once the
+    items before it are written, an error in the write stage stops the pipeline at once.
+    At most 2 * queue_size + 3 items are in flight.
+    """
+
+    STAGES = ("prefetch", "generate", "write")
+    POLL_SECONDS = 0.1
+
+    def __init__(self, queue_size: int = PIPELINE_QUEUE_SIZE):
+        """
+        Initialize the executor.
+
+        :param queue_size: The number of items each queue between two stages holds.
+        """
+        self.queue_size = max(1, queue_size)
+        self.stages = {name: PipelineStage(name) for name in self.STAGES}
+        self._stop = threading.Event()
+        self._write_error: Optional[BaseException] = None
+
+    def _put(self, items: queue.Queue, item: Any, stage: PipelineStage) -> bool:
+        """
+        Put an item on a queue, waiting for room while the pipeline runs.
+
+        :return: False when the pipeline stopped before the item was queued.
+        """
+        with stage.idle():
+            while not self._stop.is_set():
+                try:
+                    items.put(item, timeout=self.POLL_SECONDS)
+                    return True
+                except queue.Full:
+                    continue
+        return False
+
+    def _get(self, items: queue.Queue, stage: PipelineStage) -> Tuple[Any, Optional[BaseException]]:
+        """
+        Get the next item and the error of the stage before, waiting while the pipeline runs.
+        """
+        with stage.idle():
+            while True:
+                try:
+                    return items.get(timeout=self.POLL_SECONDS)
+                except queue.Empty:
+                    if self._stop.is_set():
+                        return _PIPELINE_END, None
+
+    def _prefetch(self, source: Iterator[Any], prefetch: Callable[[Any], Any], prefetch_queue: queue.Queue):
+        """
+        The prefetch stage: load the items of the source until it is exhausted or fails.
+        """
+        stage = self.stages["prefetch"]
+        error = None
+        while not self._stop.is_set():
+            try:
+                with stage.busy():
+                    item = prefetch(next(source))
+            except StopIteration:
+                break
+            except Exception as exc:
+                # the items read before the error still go through the pipeline
+                error = exc
+                break
+            stage.num_items += 1
+            if not self._put(prefetch_queue, (item, None), stage):
+                return
+        self._put(prefetch_queue, (_PIPELINE_END, error), stage)
+
+    def _write(self, write: Callable[[Any], None], write_queue: queue.Queue):
+        """
+        The write stage: write the generated items until the end of the pipeline.
+        """
+        stage = self.stages["write"]
+        while True:
+            item, _ = self._get(write_queue, stage)
+            if item is _PIPELINE_END:
+                return
+            try:
+                with stage.busy():
+                    write(item)
+            except BaseException as exc:
+                self._write_error = exc
+                self._stop.set()
+                return
+            stage.num_items += 1
+
+    def run(
+        self,
+        source: Iterator[Any],
+        prefetch: Callable[[Any], Any],
+        generate: Callable[[Any], Any],
+        write: Callable[[Any], None]
+    ):
+        """
+        Run the items of the source through the stages.
+
+        :param source: The items, iterated by the prefetch stage.
+        :param prefetch: Loads an item of the source, runs on the prefetch thread.
+        :param generate: Generates the results of a read item, runs on the calling thread.
+        :param write: Writes the results of an item, runs on the write thread.
+        """
+        prefetch_queue = queue.Queue(maxsize=self.queue_size)
+        write_queue = queue.Queue(maxsize=self.queue_size)
+        prefetcher = threading.Thread(
+            target=self._prefetch, args=(source, prefetch, prefetch_queue), name="pipeline-prefetch",
+            daemon=True)
+        writer = threading.Thread(
+            target=self._write, args=(write, write_queue), name="pipeline-write", daemon=True)
+        prefetcher.start()
+        writer.start()
+
+        stage = self.stages["generate"]
+        error = None
+        try:
+            while True:
+                item, error = self._get(prefetch_queue, stage)
+                if item is _PIPELINE_END:
+                    break
+                with stage.busy():
+                    results = generate(item)
+                stage.num_items += 1
+                if not self._put(write_queue, (results, None), stage):
+                    break
+        except BaseException as exc:
+            error = exc
+
+        # the writer finishes the generated items before the pipeline stops
+        self._put(write_queue, (_PIPELINE_END, None), stage)
+        writer.join()
+        self._stop.set()
+        prefetcher.join()
+
+        if self._write_error is not None:
+            raise self._write_error
+        if error is not None:
+            raise error
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Summarize the stages of the run.
+
+        :return: The busy and idle time of every stage and the bottleneck, the stage that
+                 was busy the longest.
+        """
+        summary = {}
+        for stage in self.stages.values():
+            summary.update(stage.summary())
+        summary["pipeline_bottleneck"] = max(
+            self.stages.values(), key=lambda stage: stage.busy_seconds).name
+        return summary
+# endregion Pipelined Execution
 
 
 class VLLMModelServer(mlrun.serving.v2_serving.V2ModelServer):
@@ -16,211 +2275,1837 @@ class VLLMModelServer(mlrun.serving.v2_serving.V2ModelServer):
     loading, serving, and managing their lifecycle.
     """
 
-    def __init__(
+    # per-process cache of project and artifact metadata lookups
+    _metadata_cache = MetadataCache()
+
+    # background fills of the node-local weight cache, by cache entry key
+    _weight_fills: Dict[str, threading.Thread] = {}
+    _weight_fills_lock = threading.Lock()
+
+    def __init__(
+        self,
+        context: mlrun.MLClientCtx,
+        name: str,
+        model_path: str,
+        model_name: str,
+        engine_kwargs: Optional[Dict[str, Any]] = None,
+        **class_args
+    ):
+        """
+        Initialize the VLLMModelServer with the given context, name, model path, and model name.
+
+        :param context: MLRun context for the server.
+        :param name: Name of the model server.
+        :param model_path: Path to the VLLM model.
+        :param model_name: Name of the VLLM model.
+        :param engine_kwargs: Keyword arguments passed to LLM() when the engine is built in load().
+        :param class_args: Additional arguments for the model server.
+        """
+        super().__init__(
+            context=context,
+            name=name,
+            model_path=model_path,
+            **class_args
+        )
+
+        # Save hub loading parameters:
+        self.model_name = model_name
+
+        # Warm engine state, the engine is reused while the key does not change:
+        self.engine_kwargs = engine_kwargs or {}
+        self.engine_warm = False
+        self._llm = None
+        self._llm_key = None
+
+        # Data-parallel engine worker processes, used when data_parallel_size > 1:
+        self.data_parallel_size = 1
+        self._worker_pool: Optional[EngineWorkerPool] = None
+        self._worker_pool_key = None
+        self.worker_stats: Dict[int, Dict[str, float]] = {}
+
+        # Micro-batcher of the real-time serving path, created and warmed up in load():
+        self._batcher: Optional[RequestMicroBatcher] = None
+        self._load_lock = threading.Lock()
+        self.warmup_stats: Dict[str, Any] = {}
+
+        # Project and artifact metadata lookups are shared by every server of the process:
+        self.metadata_cache = VLLMModelServer._metadata_cache
+
+        # Tokenizer of the token planning API, loaded on first use:
+        self._tokenizer = None
+
+        # Leases on the node cache entries the engine reads, released with the engine:
+        self._cache_leases: Dict[str, CacheLease] = {}
+
+        # Phase timings and token throughput of offline inference:
+        self.inference_metrics = InferenceMetrics()
+
+        # Optional response cache and prompt scheduling used by offline_inference:
+        self.response_cache: Optional[ResponseCache] = None
+        self.schedule_prompts = False
+
+    # region Model Management
+    def _download_model(self, allow_patterns: Optional[List[str]] = None):
+        """
+        Download the model from Hugging Face Hub if it is not already present.
+
+        :param allow_patterns: Optional file names or patterns to download, defaults to all files.
+        """
+        self.context.logger.info(
+            f"Downloading model {self.model_name} to {self.model_path}")
+
+        # only restrict the snapshot when a file selection is given
+        download_kwargs = {}
+        if allow_patterns is not None:
+            download_kwargs["allow_patterns"] = allow_patterns
+
+        snapshot_download(
+            repo_id=self.model_name,
+            local_dir=self.model_path,
+            **download_kwargs)
+
+        # delete the .cache directory if it exists
+        cache_dir = os.path.join(self.model_path, ".cache")
+        if os.path.exists(cache_dir):
+            self.context.logger.info(f"Deleting cache directory: {cache_dir}")
+            shutil.rmtree(cache_dir)
+
+        self.context.logger.info(
+            f"Model {self.model_name} downloaded successfully to: {self.model_path}")
+
+    def _log_model(self):
+        """
+        Log the model to the MLRun project.
+
+        :param project: The MLRun project to log the model to.
+        """
+        # get the project from the context
+        project = self._get_project()
+
+        self.context.logger.info(
+            f"Logging model {self.model_name} to project {project.name}")
+
+        # Assuming the model is saved in the model_path
+        model_artifact = project.log_artifact(
+            item=self.name,
+            local_path=self.model_path,
+            upload=True,
+            labels={"framework": "vllm", "source": "huggingface"}
+        )
+        # model_artifact = project.log_model(
+        #     key=self.name,
+        #      model_dir=self.model_path,
+        #     labels={"framework": "vllm", "source": "huggingface"}
+        # )
+
+        self._invalidate_model_artifact()
+
+        self.context.logger.info(
+            f"Model {self.model_name} logged successfully to: {model_artifact.uri}")
+
+    def _list_repo_manifest(self) -> Dict[str, Dict[str, Any]]:
+        """
+        List the files of the model repository on the Hugging Face Hub with their
+        content hashes: the LFS sha256 for large files, the git blob id otherwise.
+
+        :return: Mapping of the repository file names to their size and hash.
+        """
+        info = HfApi().model_info(self.model_name, files_metadata=True)
+        return {
+            sibling.rfilename: {
+                "size": sibling.size or 0,
+                "hash": f"sha256:{sibling.lfs.sha256}" if sibling.lfs else f"git:{sibling.blob_id}",
+            }
+            for sibling in info.siblings
+        }
+
+    def _list_repo_files(self) -> Dict[str, int]:
+        """
+        List the files of the model repository on the Hugging Face Hub.
+
+        :return: Mapping of the repository file names to their sizes in bytes.
+        """
+        return {name: entry["size"] for name, entry in self._list_repo_manifest().items()}
+
+    def _model_target_path(self, project: MlrunProject) -> str:
+        """
+        Get a new artifact store directory for a version of the model, under the location
+        a directory artifact logged with upload=True is written to. Every pipelined store
+        writes to its own directory, so a logged version is never modified.
+
+        :param project: The MLRun project the model is logged to.
+        :return: The target directory url, ending with a slash.
+        """
+        artifact_path = mlrun.utils.helpers.template_artifact_path(
+            project.artifact_path or mlrun.mlconf.artifact_path, project.name)
+        version = f"{time.strftime('%Y%m%d-%H%M%S', time.gmtime())}-{uuid.uuid4().hex[:8]}"
+        return f"{artifact_path.rstrip('/')}/{self.name}/{version}/"
+
+    def _transfer_pipelined(
+        self,
+        files: Dict[str, int],
+        target_path: str,
+        max_concurrent_uploads: int
+    ) -> Dict[str, float]:
+        """
+        Download the repository files one by one and upload each to the artifact store
+        as soon as it is downloaded, deleting it locally once uploaded. At most
+        max_concurrent_uploads files are on local disk at any time. The first failed
+        upload stops the downloads and cancels the uploads that have not started.
+
+        :param files: Mapping of the repository file names to their sizes.
+        :param target_path: The artifact store directory to upload to.
+        :param max_concurrent_uploads: The maximum number of concurrent uploads.
+        :return: The transfer stats: bytes, seconds and peak local bytes.
+        """
+        # a slot is taken before a download and released after its upload
+        slots = threading.BoundedSemaphore(max_concurrent_uploads)
+        lock = threading.Lock()
+        stats = {"bytes": 0, "peak_local_bytes": 0}
+        local_bytes = {"current": 0}
+
+        def upload(filename: str, local_file: str, size: int):
+            mlrun.get_dataitem(f"{target_path}{filename}").upload(local_file)
+            os.remove(local_file)
+            with lock:
+                local_bytes["current"] -= size
+
+        def raise_failed_upload(futures: List[Future]):
+            for future in futures:
+                if future.done() and not future.cancelled() and future.exception() is not None:
+                    for pending in futures:
+                        pending.cancel()
+                    raise future.exception()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_concurrent_uploads) as executor:
+            futures = []
+            for filename in files:
+                slots.acquire()
+                # a failed upload releases its slot, stop before downloading another file
+                raise_failed_upload(futures)
+                local_file = hf_hub_download(
+                    repo_id=self.model_name,
+                    filename=filename,
+                    local_dir=self.model_path)
+                size = os.path.getsize(local_file)
+                with lock:
+                    local_bytes["current"] += size
+                    stats["peak_local_bytes"] = max(
+                        stats["peak_local_bytes"], local_bytes["current"])
+                stats["bytes"] += size
+                future = executor.submit(upload, filename, local_file, size)
+                # the slot is released once the upload is done, so its failure is seen
+                future.add_done_callback(lambda _: slots.release())
+                futures.append(future)
+
+            for future in futures:
+                future.result()
+
+        stats["seconds"] = time.perf_counter() - start
+        return stats
+
+    def _select_files(self, files: Dict[str, int], weight_format: Optional[str]) -> Dict[str, int]:
+        """
+        Select the repository files the weight format policy needs.
+
+        :param files: Mapping of the repository file names to their sizes.
+        :param weight_format: The weight format policy, None selects every file.
+        :return: Mapping of the selected file names to their sizes.
+        """
+        if weight_format is None:
+            return files
+
+        selected = _select_model_files(files, weight_format)
+        skipped = set(files) - set(selected)
+        self.context.logger.info(
+            f"Weight format {weight_format}: selected {len(selected)} files "
+            f"({sum(selected.values())} bytes), skipped {len(skipped)} files "
+            f"({sum(files[name] for name in skipped)} bytes)")
+        return selected
+
+    def _get_previous_manifest(self, project: MlrunProject) -> Tuple[Optional[str], Dict[str, Dict[str, Any]]]:
+        """
+        Get the target directory and file manifest of the previously stored model version.
+
+        :param project: The MLRun project the model is logged to.
+        :return: The previous target directory (None when the model was never stored) and
+                 its manifest (empty when it was stored without one).
+        """
+        try:
+            previous_artifact = project.get_artifact(self.name)
+        except mlrun.errors.MLRunNotFoundError:
+            return None, {}
+
+        target_path = previous_artifact.target_path
+        if not target_path.endswith("/"):
+            target_path += "/"
+        try:
+            manifest = json.loads(
+                mlrun.get_dataitem(f"{target_path}{MODEL_MANIFEST_FILE}").get())
+        except FileNotFoundError:
+            manifest = {}
+        return target_path, manifest
+
+    def _store_model_pipelined(
+        self,
+        max_concurrent_uploads: int,
+        weight_format: Optional[str],
+        incremental: bool = False
+    ):
+        """
+        Store the model with overlapping download and upload, then log the uploaded
+        directory with its file manifest as the model artifact.
+
+        Every store writes to a new version directory, the previous versions are never
+        written to or deleted from, so an engine loading one never sees a mix of versions.
+        An incremental store transfers only the changed files from the hub and copies the
+        unchanged files from the previous version's directory within the artifact store.
+        The manifest is written once every file is in place, and a failed store leaves an
+        unlogged directory behind and the previous version untouched.
+
+        :param max_concurrent_uploads: The maximum number of concurrent uploads.
+        :param weight_format: The weight format policy, None selects every file.
+        :param incremental: Transfer only the files whose content hash changed since the
+                            previous version, unchanged files are copied from the previous
+                            version within the artifact store.
+        """
+        project = self._get_project()
+        target_path = self._model_target_path(project)
+
+        repo_manifest = self._list_repo_manifest()
+        selected = self._select_files(
+            {name: entry["size"] for name, entry in repo_manifest.items()}, weight_format)
+        manifest = {name: repo_manifest[name] for name in selected}
+
+        files = selected
+        unchanged = []
+        if incremental:
+            previous_target_path, previous_manifest = self._get_previous_manifest(project)
+            if previous_target_path is not None:
+                unchanged = [
+                    name for name, entry in manifest.items()
+                    if previous_manifest.get(name, {}).get("hash") == entry["hash"]]
+            files = {name: size for name, size in selected.items() if name not in unchanged}
+
+        self.context.logger.info(
+            f"Transferring {len(files)} of {len(manifest)} files of model "
+            f"{self.model_name} to {target_path}")
+        stats = self._transfer_pipelined(files, target_path, max_concurrent_uploads)
+
+        # the unchanged files are copied within the store, they never pass through the node
+        if unchanged:
+            with ThreadPoolExecutor(
+                    max_workers=min(ARTIFACT_FETCH_MAX_WORKERS, len(unchanged))) as executor:
+                copies = [
+                    executor.submit(
+                        _copy_artifact_file, f"{previous_target_path}{name}", f"{target_path}{name}")
+                    for name in unchanged]
+                for future in copies:
+                    future.result()
+        copied_bytes = sum(selected[name] for name in unchanged)
+        self.context.logger.info(
+            f"Transferred {stats['bytes']} bytes in {stats['seconds']:.1f}s, "
+            f"copied {len(unchanged)} unchanged files ({copied_bytes} bytes) from the previous "
+            f"version, peak local disk {stats['peak_local_bytes']} bytes")
+
+        # the manifest is written last, it only lists files that are in place
+        mlrun.get_dataitem(f"{target_path}{MODEL_MANIFEST_FILE}").put(
+            json.dumps(manifest, indent=2, sort_keys=True))
+
+        # the files are already in place, only the artifact metadata is logged
+        model_artifact = project.log_artifact(
+            item=mlrun.artifacts.DirArtifact(metadata={"key": self.name}),
+            target_path=target_path,
+            upload=False,
+            labels={"framework": "vllm", "source": "huggingface"}
+        )
+        self._invalidate_model_artifact()
+
+        self.context.logger.info(
+            f"Model {self.model_name} logged successfully to: {model_artifact.uri}")
+
+    def store_model(
         self,
-        context: mlrun.MLClientCtx,
-        name: str,
-        model_path: str,
-        model_name: str,
-        **class_args
+        pipelined: bool = False,
+        max_concurrent_uploads: int = 4,
+        weight_format: Optional[str] = None,
+        incremental: bool = False
     ):
         """
-        Initialize the VLLMModelServer with the given context, name, model path, and model name.
+        Store the model in the MLRun project.
+        This method is called to ensure the model is stored correctly.
+
+        :param pipelined: Upload each file as soon as it is downloaded instead of downloading
+                          the whole snapshot first, bounding the local disk to a few files.
+        :param max_concurrent_uploads: The maximum number of concurrent uploads when pipelined.
+        :param weight_format: Store only the weights of this format plus the config and tokenizer
+                              files, "safetensors", "bin", "pt" or "auto" for the first of those
+                              the repository has. Defaults to every file of the repository.
+        :param incremental: Compare the file manifest with the previous version and transfer only
+                            the changed files, implies pipelined. The new version gets its own
+                            directory, the previous one is left untouched. The manifest is only
+                            written by pipelined stores, so the first incremental store after a
+                            default store_model() transfers every file.
+        """
+        self.context.logger.info(
+            f"Storing model {self.model_name} in project {self.context.project}")
+
+        if pipelined or incremental:
+            try:
+                self._store_model_pipelined(max_concurrent_uploads, weight_format, incremental)
+            finally:
+                shutil.rmtree(self.model_path, ignore_errors=True)
+            self.context.logger.info(
+                f"Model {self.model_name} stored successfully.")
+            return
+
+        # Download the model, restricted to the selected files with a weight format policy
+        allow_patterns = None
+        if weight_format is not None:
+            allow_patterns = list(self._select_files(self._list_repo_files(), weight_format))
+        self._download_model(allow_patterns=allow_patterns)
+
+        # Log the model to the project
+        self._log_model()
+
+        # Delete the local model files after logging
+        if os.path.exists(self.model_path):
+            self.context.logger.info(
+                f"Deleting local model files at {self.model_path}")
+            shutil.rmtree(self.model_path)
+
+        self.context.logger.info(
+            f"Model {self.model_name} stored successfully.")
+    # endregion Model Management
+
+    def _get_project(self) -> MlrunProject:
+        """ Retrieve the MLRun project of the context, reusing the cached project object."""
+        return self.metadata_cache.get_or_fill(
+            ("project", self.context.project),
+            lambda: mlrun.get_or_create_project(name=self.context.project))
+
+    def get_model_artifact(self):
+        """ Retrieve the model artifact from the MLRun project, reusing the cached metadata."""
+        with self.inference_metrics.phase("artifact_lookup"):
+            model_artifact = self.metadata_cache.get_or_fill(
+                ("artifact", self.context.project, self.name),
+                lambda: self._get_project().get_artifact(self.name))
+        return model_artifact
+
+    def _invalidate_model_artifact(self):
+        """ Drop the cached model artifact metadata, called after a new version is logged."""
+        self.metadata_cache.invalidate(("artifact", self.context.project, self.name))
+
+    def _download_tokenizer(self) -> str:
+        """
+        Download the tokenizer from the model data item into the persistent tokenizer
+        cache. Warm calls return the cached directory without touching the object store.
+
+        :return: The directory holding the tokenizer files.
+        """
+        # tokenizer files normally needed:
+        tokenizer_files = [
+            "tokenizer.json",
+            "tokenizer.model",         # some models have one or the other
+            "tokenizer_config.json",
+            "special_tokens_map.json",
+            "config.json",              # often needed too
+            "generation_config.json",   # optional, if exists
+        ]
+
+        # get the model artifact from the context
+        model_artifact = self.get_model_artifact()
+
+        # the cache entry is keyed by the artifact uri and version
+        cache = LocalArtifactCache(
+            root=TOKENIZER_CACHE_DIR, max_bytes=TOKENIZER_CACHE_MAX_BYTES)
+        cache_key = LocalArtifactCache.entry_key(
+            model_artifact.uri, _get_artifact_version(model_artifact))
+
+        lease, cache_hit = cache.get_or_fill(
+            cache_key,
+            lambda target_dir: self._fetch_artifact_files(
+                model_artifact, tokenizer_files, target_dir))
+        tokenizer_dir = self._hold_lease(lease)
+
+        self.context.logger.info(
+            f"Tokenizer files for model {self.model_name} in {tokenizer_dir} "
+            f"(cache_hit={cache_hit})")
+
+        return tokenizer_dir
+
+    def _hold_lease(self, lease: CacheLease) -> str:
+        """
+        Keep a node cache entry from being evicted until the engine is shut down.
+
+        :param lease: The lease of the entry.
+        :return: The entry directory.
+        """
+        previous = self._cache_leases.pop(lease.path, None)
+        if previous is not None:
+            previous.release()
+        self._cache_leases[lease.path] = lease
+        return lease.path
+
+    def _fetch_artifact_files(self, model_artifact, filenames: Optional[List[str]], target_dir: str):
+        """
+        Download the listed files of the model artifact that exist in the artifact,
+        fetching them concurrently.
+
+        :param model_artifact: The model artifact to download the files from.
+        :param filenames: The names of the files to download, None for all the files.
+        :param target_dir: The directory to download the files to.
+        """
+        self.context.logger.info(
+            f"Downloading artifact files to directory: {target_dir}")
+
+        # get the files in the data item
+        data_item = mlrun.get_dataitem(model_artifact.uri)
+        data_item_files = data_item.listdir()
+
+        # download the requested files that exist in the artifact concurrently
+        selected = [
+            filename for filename in data_item_files
+            if filenames is None or filename in filenames]
+        for filename in selected:
+            os.makedirs(os.path.dirname(os.path.join(target_dir, filename)), exist_ok=True)
+        start = time.perf_counter()
+        stats = _fetch_files({
+            f"{data_item.url}{filename}": os.path.join(target_dir, filename)
+            for filename in selected
+        })
+        elapsed = time.perf_counter() - start
+
+        # a single aggregated log line with the per-file timings
+        per_file = ", ".join(
+            f"{url.rsplit('/', 1)[-1]}={stat['seconds']:.2f}s x{stat['attempts']}"
+            for url, stat in stats.items())
+        self.context.logger.info(
+            f"Downloaded {len(stats)} files "
+            f"({sum(stat['bytes'] for stat in stats.values())} bytes) "
+            f"in {elapsed:.2f}s [{per_file}]")
+
+    # region Token Planning
+    def _get_tokenizer(self):
+        """
+        Load the fast tokenizer from the cached tokenizer files, without building an engine.
+
+        :return: The tokenizer.
+        """
+        if self._tokenizer is None:
+            from transformers import AutoTokenizer
+
+            self._tokenizer = AutoTokenizer.from_pretrained(
+                self._download_tokenizer(), use_fast=True, trust_remote_code=True)
+        return self._tokenizer
+
+    def count_tokens(self, prompts: List[str], num_threads: int = 4) -> List[int]:
+        """
+        Count the tokens of each prompt with the model's tokenizer, tokenizing slices of the
+        prompts on a thread pool (the fast tokenizer releases the GIL while encoding).
+
+        :param prompts: The prompts to count.
+        :param num_threads: The number of tokenizing threads.
+        :return: The tokenized length of each prompt.
+        """
+        tokenizer = self._get_tokenizer()
+        slice_size = max(1, -(-len(prompts) // num_threads))
+
+        def count(prompts_slice: List[str]) -> List[int]:
+            return [len(input_ids) for input_ids in tokenizer(
+                prompts_slice, add_special_tokens=True)["input_ids"]]
+
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            return [
+                length
+                for lengths in executor.map(count, _chunks(prompts, slice_size))
+                for length in lengths
+            ]
+
+    def plan_batches(
+        self,
+        prompts: Optional[List[str]] = None,
+        max_tokens: int = 16,
+        max_model_len: Optional[int] = None,
+        chunk_tokens: int = PLAN_CHUNK_TOKENS,
+        num_threads: int = 4,
+        prompt_chunks: Optional[Iterable[List[str]]] = None
+    ) -> Dict[str, Any]:
+        """
+        Count the prompt tokens and suggest a batching plan, using only the tokenizer.
+
+        :param prompts: The prompts to plan.
+        :param max_tokens: The number of tokens generated per prompt.
+        :param max_model_len: The context length the engine will run with, if already chosen.
+        :param chunk_tokens: The token budget of a chunk.
+        :param num_threads: The number of tokenizing threads.
+        :param prompt_chunks: Chunks of prompts to plan instead of the prompts, counted one
+                              chunk at a time so only the token lengths are kept in memory.
+        :return: The per-prompt token lengths, length statistics, a power of two length
+                 histogram and the suggested plan.
+        """
+        if (prompts is None) == (prompt_chunks is None):
+            raise ValueError("Exactly one of prompts or prompt_chunks must be given")
+
+        start = time.perf_counter()
+        token_lengths = []
+        for chunk in [prompts] if prompts is not None else prompt_chunks:
+            token_lengths.extend(self.count_tokens(chunk, num_threads=num_threads))
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        self.context.logger.info(
+            f"Counted the tokens of {len(token_lengths)} prompts in {elapsed:.2f}s "
+            f"({len(token_lengths) / elapsed:.1f} prompts/s)")
+
+        sorted_lengths = sorted(token_lengths)
+        return {
+            "token_lengths": token_lengths,
+            "num_prompts": len(token_lengths),
+            "total_prompt_tokens": sum(token_lengths),
+            "min_prompt_tokens": sorted_lengths[0] if sorted_lengths else None,
+            "max_prompt_tokens": sorted_lengths[-1] if sorted_lengths else None,
+            "p50_prompt_tokens": _percentile(sorted_lengths, 50),
+            "p90_prompt_tokens": _percentile(sorted_lengths, 90),
+            "p99_prompt_tokens": _percentile(sorted_lengths, 99),
+            "histogram": _length_histogram(token_lengths),
+            "plan": _plan_batches(
+                token_lengths, max_tokens=max_tokens, max_model_len=max_model_len,
+                chunk_tokens=chunk_tokens),
+        }
+    # endregion Token Planning
+
+    # region Engine Management
+    def _engine_key(self, model_artifact, engine_kwargs: Dict[str, Any]) -> Tuple[str, str]:
+        """
+        Build the key identifying an engine: the model artifact URI plus the engine kwargs.
+
+        :param model_artifact: The model artifact the engine is loaded from.
+        :param engine_kwargs: Keyword arguments passed to LLM().
+        :return: A hashable key for the engine.
+        """
+        return (
+            model_artifact.uri,
+            json.dumps(engine_kwargs, sort_keys=True, default=str)
+        )
+
+    def _build_engine(self, model_artifact, engine_kwargs: Dict[str, Any]) -> "LLM":
+        """
+        Build a new LLM engine for the model artifact.
+
+        :param model_artifact: The model artifact to load the weights from.
+        :param engine_kwargs: Keyword arguments passed to LLM().
+        :return: The LLM engine.
+        """
+        # Initialize the LLM with the model path, the weights are streamed here
+        engine_args = self._engine_args(model_artifact, engine_kwargs)
+        with self.inference_metrics.phase("engine_build"):
+            return LLM(**engine_args)
+
+    def _engine_args(self, model_artifact, engine_kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Download the tokenizer and build the keyword arguments of LLM() for the model artifact.
+
+        :param model_artifact: The model artifact to load the weights from.
+        :param engine_kwargs: Keyword arguments passed to LLM().
+        :return: The keyword arguments of LLM().
+        """
+        # download the tokenizer
+        self.context.logger.info(
+            f"Downloading tokenizer for model {self.model_name}")
+        with self.inference_metrics.phase("tokenizer_download"):
+            tokenizer_dir = self._download_tokenizer()
+
+        return dict(
+            model=self._cached_weights_path(model_artifact) or model_artifact.target_path,
+            tokenizer=tokenizer_dir,
+            hf_config_path=tokenizer_dir,
+            trust_remote_code=True,
+            load_format="runai_streamer",
+            **engine_kwargs
+        )
+
+    def _cached_weights_path(self, model_artifact) -> Optional[str]:
+        """
+        Look up the model weights in the node-local weight cache, keyed by the artifact
+        uri and version and shared by the processes of the node. A hit is leased until the
+        engine is shut down, so the weights are not evicted while the engine reads them. On
+        a miss the entry is filled in a non-daemon thread while the engine streams the
+        weights from the artifact store, so the next start on the node loads from local
+        disk. The fill is renamed into place once complete, a fill cut short is cleaned up
+        by a later eviction. An artifact larger than the cache is never cached.
+
+        The cache is enabled by the "weight_cache_max_gb" parameter or the
+        VLLM_WEIGHT_CACHE_MAX_BYTES environment variable.
+
+        :param model_artifact: The model artifact to load the weights from.
+        :return: The local weights directory, or None to stream from the artifact store.
+        """
+        max_gb = self.get_param("weight_cache_max_gb", None)
+        max_bytes = int(float(max_gb) * 1024 ** 3) if max_gb is not None else WEIGHT_CACHE_MAX_BYTES
+        if not max_bytes:
+            return None
+
+        try:
+            cache = LocalArtifactCache(root=WEIGHT_CACHE_DIR, max_bytes=max_bytes)
+            cache_key = LocalArtifactCache.entry_key(
+                model_artifact.uri, _get_artifact_version(model_artifact))
+            # a fill in progress in another process holds the entry lock, stream meanwhile
+            lease = cache.lease(cache_key, blocking=False)
+            if lease is not None:
+                weights_dir = self._hold_lease(lease)
+                self.context.logger.info(
+                    f"Loading the weights of model {self.model_name} from the node cache {weights_dir}")
+                return weights_dir
+
+            artifact_bytes = self._artifact_bytes(model_artifact)
+            if artifact_bytes > max_bytes:
+                self.context.logger.info(
+                    f"Weights of model {self.model_name} ({artifact_bytes} bytes) are larger than "
+                    f"the node cache ({max_bytes} bytes), streaming them without caching")
+                return None
+
+            with VLLMModelServer._weight_fills_lock:
+                fill = VLLMModelServer._weight_fills.get(cache_key)
+                if fill is None or not fill.is_alive():
+                    # not a daemon, so the process waits for the fill instead of killing it
+                    fill = threading.Thread(
+                        target=self._fill_weight_cache,
+                        args=(cache, cache_key, model_artifact),
+                        name="vllm-weight-cache-fill", daemon=False)
+                    VLLMModelServer._weight_fills[cache_key] = fill
+                    fill.start()
+        except Exception as exc:
+            self.context.logger.warning(
+                f"Node weight cache unavailable, streaming the weights: {exc}")
+            return None
+
+        self.context.logger.info(
+            f"Weights of model {self.model_name} are not cached on the node, streaming them "
+            f"from {model_artifact.target_path} while the cache is filled")
+        return None
+
+    def _artifact_bytes(self, model_artifact) -> int:
+        """
+        Get the total size of the files of a model artifact, from its manifest when it has
+        one, otherwise from the artifact store.
+
+        :param model_artifact: The model artifact.
+        :return: The size in bytes.
+        """
+        target_path = model_artifact.target_path.rstrip("/")
+        try:
+            manifest = json.loads(
+                mlrun.get_dataitem(f"{target_path}/{MODEL_MANIFEST_FILE}").get())
+            return sum(entry["size"] for entry in manifest.values())
+        except FileNotFoundError:
+            pass
+        return sum(
+            mlrun.get_dataitem(f"{target_path}/{filename}").stat().size or 0
+            for filename in mlrun.get_dataitem(model_artifact.uri).listdir())
+
+    def _fill_weight_cache(self, cache: LocalArtifactCache, cache_key: str, model_artifact):
+        """
+        Fill the node weight cache entry of a model artifact, run in a fill thread.
+
+        :param cache: The node weight cache.
+        :param cache_key: The entry key of the artifact.
+        :param model_artifact: The model artifact to download the files from.
+        """
+        try:
+            lease, _ = cache.get_or_fill(
+                cache_key,
+                lambda target_dir: self._fetch_artifact_files(model_artifact, None, target_dir))
+            weights_dir = lease.path
+            lease.release()
+            self.context.logger.info(
+                f"Cached the weights of model {self.model_name} on the node in {weights_dir}")
+        except Exception as exc:
+            self.context.logger.warning(
+                f"Failed to cache the weights of model {self.model_name} on the node: {exc}")
+
+    def _get_engine(self, **engine_kwargs) -> "LLM":
+        """
+        Return the warm LLM engine, rebuilding it when the model artifact or the
+        engine kwargs changed since it was built.
+
+        :param engine_kwargs: Keyword arguments passed to LLM().
+        :return: The LLM engine.
+        """
+        model_artifact = self.get_model_artifact()
+        key = self._engine_key(model_artifact, engine_kwargs)
+
+        # reuse the engine if it was built with the same key
+        if self._llm is not None and self._llm_key == key:
+            self.engine_warm = True
+            self.context.logger.info(
+                f"Reusing warm engine for model {self.model_name}")
+            return self._llm
+
+        # the key changed, release the old engine before building the new one
+        self.engine_warm = False
+        self._shutdown_engine()
+
+        self.context.logger.info(
+            f"Building engine for model {self.model_name} from {model_artifact.uri}")
+        self._llm = self._build_engine(model_artifact, engine_kwargs)
+        self._llm_key = key
+
+        return self._llm
+
+    def _get_worker_pool(self, **engine_kwargs) -> EngineWorkerPool:
+        """
+        Return the warm data-parallel worker pool, restarting it when the model artifact,
+        the engine kwargs or the number of workers changed since it was started.
+
+        :param engine_kwargs: Keyword arguments passed to LLM() in each worker.
+        :return: The engine worker pool.
+        """
+        model_artifact = self.get_model_artifact()
+        key = (*self._engine_key(model_artifact, engine_kwargs), self.data_parallel_size)
+
+        if self._worker_pool is not None and self._worker_pool_key == key:
+            self.engine_warm = True
+            self.context.logger.info(
+                f"Reusing {self.data_parallel_size} warm engine workers for model {self.model_name}")
+            return self._worker_pool
+
+        # the workers own the devices, release the engines held so far
+        self.engine_warm = False
+        self._shutdown_engine()
+
+        self.context.logger.info(
+            f"Starting {self.data_parallel_size} engine workers for model {self.model_name} "
+            f"from {model_artifact.uri}")
+        engine_args = self._engine_args(model_artifact, engine_kwargs)
+        with self.inference_metrics.phase("engine_build"):
+            self._worker_pool = EngineWorkerPool(
+                num_workers=self.data_parallel_size, engine_args=engine_args)
+        self._worker_pool_key = key
+
+        return self._worker_pool
+
+    def _shutdown_engine(self):
+        """
+        Release the current LLM engine, or the data-parallel workers, and the device
+        memory they hold.
+        """
+        # the cached tokenizer and weight files may be evicted once the engine is gone
+        for lease in self._cache_leases.values():
+            lease.release()
+        self._cache_leases.clear()
+
+        if self._worker_pool is not None:
+            self.context.logger.info(
+                f"Stopping engine workers for model {self.model_name}")
+            self._worker_pool.close()
+            self._worker_pool = None
+            self._worker_pool_key = None
+
+        if self._llm is None:
+            return
+
+        self.context.logger.info(
+            f"Shutting down engine for model {self.model_name}")
+        self._llm = None
+        self._llm_key = None
+        gc.collect()
+
+        # free the cached device memory, torch is installed alongside vllm
+        try:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except ImportError:
+            pass
+
+    def post_init(self, mode: str = "sync", **kwargs):
+        """
+        Load and warm up the model, in a background thread unless the "background_warmup"
+        parameter is False. The server reports ready only once the warm-up is done, so
+        the serving graph routes traffic only to warm replicas.
+
+        :param mode: The loading mode requested by the serving graph.
+        """
+        # a VLLMModelRouter loads its routes on their first request, see _load_and_update_state
+        if self.get_param("background_warmup", True) and not self.get_param("load_on_demand", False):
+            mode = "async"
+        super().post_init(mode=mode, **kwargs)
+
+    def _load_and_update_state(self):
+        """
+        Load the model and mark it ready, unless a VLLMModelRouter loads it on its first
+        request, then the rest of post_init still runs and only the load is skipped.
+        """
+        if self.get_param("load_on_demand", False):
+            self.context.logger.info(f"Model {self.model_name} is loaded on its first request")
+            return
+        super()._load_and_update_state()
+
+    def load(self):
+        """
+        Build the engine once when the model server is initialized, so that
+        later calls reuse the warm engine, then warm it up with synthetic prompts.
+        """
+        with self._load_lock:
+            # a request may race the background load, the engine is built once
+            if self._batcher is not None:
+                return
+
+            self._get_engine(**self.engine_kwargs)
+            batcher = RequestMicroBatcher(
+                run_batch=self._run_batch,
+                max_batch_size=int(self.get_param("max_batch_size", 32)),
+                max_wait_ms=float(self.get_param("max_batch_wait_ms", 5.0)),
+                run_stream_batch=self._run_stream_batch,
+                priority_weights=self.get_param("priority_weights", None),
+                max_queue_size=int(self.get_param("max_queue_size", 0)),
+                default_priority=self.get_param("default_priority", None))
+            self._warm_up(batcher)
+            self._batcher = batcher
+
+    def unload(self):
+        """
+        Stop the serving path and release the engine, the server reports not ready until
+        it is loaded again.
+        """
+        with self._load_lock:
+            self.ready = False
+            if self._batcher is not None:
+                self._batcher.close()
+                self._batcher = None
+            self._shutdown_engine()
+
+    def engine_memory_bytes(self) -> int:
+        """
+        Get the memory the engine of the model holds, for the memory budget of a
+        VLLMModelRouter. It is the "engine_memory_gb" parameter when given, otherwise an
+        estimate from the weight file sizes in the manifest of the model artifact.
+
+        :return: The engine memory in bytes.
+        """
+        memory_gb = self.get_param("engine_memory_gb", None)
+        if memory_gb is not None:
+            return int(float(memory_gb) * 1024 ** 3)
+
+        target_path = self.get_model_artifact().target_path.rstrip("/")
+        try:
+            manifest = json.loads(
+                mlrun.get_dataitem(f"{target_path}/{MODEL_MANIFEST_FILE}").get())
+        except FileNotFoundError:
+            raise ValueError(
+                f"Model {self.model_name} has no manifest to estimate its engine memory from, "
+                f"set the engine_memory_gb parameter")
+        weight_patterns = [
+            pattern for patterns in WEIGHT_FORMAT_PATTERNS.values() for pattern in patterns]
+        weight_bytes = sum(
+            entry["size"] for name, entry in manifest.items()
+            if any(fnmatch.fnmatch(name, pattern) for pattern in weight_patterns))
+        return int(weight_bytes * ENGINE_MEMORY_OVERHEAD)
+
+    def _warm_up(self, batcher: RequestMicroBatcher):
+        """
+        Run the synthetic warm-up prompts through the micro-batcher: a single request
+        first, then a full batch, so the kernels of both shapes are ready before the
+        first real request. The timings are kept in warmup_stats.
+
+        :param batcher: The micro-batcher of the serving path.
+        """
+        prompts = self.get_param("warmup_prompts", DEFAULT_WARMUP_PROMPTS) or []
+        phases = self.inference_metrics.phase_seconds
+        self.warmup_stats = {
+            "load_seconds": round(
+                phases.get("artifact_lookup", 0.0) + phases.get("tokenizer_download", 0.0)
+                + phases.get("engine_build", 0.0), 4),
+            "num_prompts": 0,
+        }
+        if prompts:
+            sampling_params = SamplingParams(
+                max_tokens=int(self.get_param("warmup_max_tokens", 16)))
+
+            start = time.perf_counter()
+            batcher.submit(prompts[0], sampling_params).future.result()
+            first_request = time.perf_counter() - start
+
+            batch = [prompts[index % len(prompts)] for index in range(batcher.max_batch_size)]
+            batch_start = time.perf_counter()
+            for pending in [batcher.submit(prompt, sampling_params) for prompt in batch]:
+                pending.future.result()
+            batch_seconds = time.perf_counter() - batch_start
+
+            self.warmup_stats.update({
+                "num_prompts": 1 + len(batch),
+                "first_request_ms": first_request * 1000,
+                "full_batch_ms": batch_seconds * 1000,
+                "total_seconds": round(time.perf_counter() - start, 4),
+            })
+
+        for name, value in self.warmup_stats.items():
+            self.set_metric(f"warmup_{name}", value)
+        self.context.logger.info(
+            f"Model {self.model_name} warmed up: {self.warmup_stats}")
+
+    def op_warmup(self, event):
+        """
+        Serving graph operation (<model-url>/warmup) reporting the warm-up state and
+        timings, with status 503 until the server is warm.
+
+        :param event: The serving event.
+        :return: A JSON response.
+        """
+        body = {"ready": self.ready, "error": str(self.error) if self.error else None,
+                **self.warmup_stats}
+        return self.context.Response(
+            body=json.dumps(body),
+            content_type="application/json",
+            status_code=200 if self.ready else 503)
+    # endregion Engine Management
+
+    # region Serving
+    def _run_batch(
+        self,
+        prompts: List[str],
+        sampling_params: List["SamplingParams"]
+    ) -> List["RequestOutput"]:
+        """
+        Run a micro-batch on the warm engine as a single generate call.
+
+        :param prompts: The prompts of the batch.
+        :param sampling_params: The sampling parameters of each prompt.
+        :return: The request outputs in the order of the prompts.
+        """
+        llm = self._llm or self._get_engine(**self.engine_kwargs)
+        return llm.generate(prompts, sampling_params=sampling_params, use_tqdm=False)
+
+    def predict(self, request: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Generate completions for the request inputs. Concurrent requests are collected
+        into micro-batches before they reach the engine.
+
+        :param request: The request body, "inputs" holds the prompts, the optional
+                        "sampling_params" the sampling parameters of all prompts and the
+                        optional "priority" the priority class of the request.
+        :return: A result per prompt with the text, the finish reason and the batching stats.
+        """
+        if self._batcher is None:
+            self.load()
+
+        sampling_params = request.get("sampling_params") or {}
+        if isinstance(sampling_params, dict):
+            sampling_params = SamplingParams(**sampling_params)
+
+        pending = self._batcher.submit_many(
+            [str(prompt) for prompt in request["inputs"]], sampling_params,
+            priority=request.get("priority"))
+
+        results = []
+        for pending_request in pending:
+            result = pending_request.future.result()
+            completion = result["output"].outputs[0]
+            results.append({
+                "text": completion.text,
+                "finish_reason": completion.finish_reason,
+                "queue_depth": result["queue_depth"],
+                "batch_size": result["batch_size"],
+                "queue_wait_ms": result["queue_wait_ms"],
+                "priority": result["priority"],
+            })
+        return results
+
+    def _run_stream_batch(
+        self,
+        prompts: List[str],
+        sampling_params: List["SamplingParams"]
+    ) -> Iterator[Tuple[int, "RequestOutput"]]:
+        """
+        Run a micro-batch on the warm engine step by step, yielding the cumulative
+        output of every request after each engine step.
+
+        :param prompts: The prompts of the batch.
+        :param sampling_params: The sampling parameters of each prompt.
+        :return: An iterator over (prompt index, cumulative request output).
+        """
+        llm = self._llm or self._get_engine(**self.engine_kwargs)
+        engine = llm.llm_engine
+
+        request_ids = {}
+        for index, (prompt, params) in enumerate(zip(prompts, sampling_params)):
+            request_id = f"stream-{uuid.uuid4().hex}"
+            request_ids[request_id] = index
+            engine.add_request(request_id, prompt, params)
+
+        while engine.has_unfinished_requests():
+            for output in engine.step():
+                if output.request_id in request_ids:
+                    yield request_ids[output.request_id], output
+
+    def stream(self, request: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        """
+        Generate completions for the request inputs, yielding text deltas as they are
+        generated. The last event of each prompt holds its finish reason, batching
+        stats, time-to-first-token and inter-token latency. The latencies are measured on
+        the server from the enqueue of the request, they do not include the network or
+        the buffering of the response.
+
+        :param request: The request body, "inputs" holds the prompts, the optional
+                        "sampling_params" the sampling parameters of all prompts and the
+                        optional "priority" the priority class of the request.
+        :return: An iterator over the delta and final events.
+        """
+        if self._batcher is None:
+            self.load()
+
+        sampling_params = request.get("sampling_params") or {}
+        if isinstance(sampling_params, dict):
+            sampling_params = SamplingParams(**sampling_params)
+
+        pending = self._batcher.submit_many(
+            [str(prompt) for prompt in request["inputs"]], sampling_params, stream=True,
+            priority=request.get("priority"))
+
+        for index, pending_request in enumerate(pending):
+            # the deltas are buffered while an earlier prompt is being yielded
+            for delta in iter(pending_request.deltas.get, None):
+                yield {"index": index, "delta": delta}
+
+            result = pending_request.future.result()
+            yield {
+                "index": index,
+                "finish_reason": result["output"].outputs[0].finish_reason,
+                "batch_size": result["batch_size"],
+                "queue_depth": result["queue_depth"],
+                "queue_wait_ms": result["queue_wait_ms"],
+                "priority": result["priority"],
+                "server_ttft_ms": result["ttft_ms"],
+                "server_mean_itl_ms": result["mean_itl_ms"],
+                "server_max_itl_ms": result["max_itl_ms"],
+            }
+
+    def op_events(self, event):
+        """
+        Serving graph operation (<model-url>/events) returning the transcript of the
+        stream() events. The serving runtime returns a response body only once it is
+        complete, so the events are buffered until every prompt is finished: the client
+        gets no earlier first token than with infer, only the per-token deltas and the
+        server-side latencies. Use stream() in-process for incremental output.
+
+        :param event: The serving event, its body is the request.
+        :return: A JSON response, "events" holds the stream() events in order.
+        """
+        # custom operations skip the readiness check, cold replicas reject the request
+        if not self.ready:
+            return self.context.Response(
+                body=b"model not ready",
+                headers={"Retry-After": "5"},
+                status_code=503)
+
+        return self.context.Response(
+            body=json.dumps({"events": list(self.stream(event.body))}),
+            content_type="application/json",
+            status_code=200)
+
+    def op_queues(self, event):
+        """
+        Serving graph operation (<model-url>/queues) reporting the depth, counters and
+        queue wait histogram of every priority class.
+
+        :param event: The serving event.
+        :return: A JSON response.
+        """
+        body = self._batcher.stats() if self._batcher is not None else {}
+        return self.context.Response(
+            body=json.dumps(body),
+            content_type="application/json",
+            status_code=200)
 
-        :param context: MLRun context for the server.
-        :param name: Name of the model server.
-        :param model_path: Path to the VLLM model.
-        :param model_name: Name of the VLLM model.
-        :param class_args: Additional arguments for the model server.
+    def do_event(self, event, *args, **kwargs):
         """
-        super().__init__(
-            context=context,
-            name=name,
-            model_path=model_path,
-            **class_args
-        )
+        Handle a serving event, answering a request whose priority queue is full at once
+        with status 429 and a Retry-After header.
 
-        # Save hub loading parameters:
-        self.model_name = model_name
+        :param event: The serving event.
+        :return: The event with the response body.
+        """
+        try:
+            return super().do_event(event, *args, **kwargs)
+        except QueueFullError as exc:
+            setattr(event, "terminated", True)
+            event.body = self.context.Response(
+                body=json.dumps({"error": str(exc), "priority": exc.priority}),
+                content_type="application/json",
+                headers={"Retry-After": str(exc.retry_after)},
+                status_code=429)
+            return event
+    # endregion Serving
 
-    # region Model Management
-    def _download_model(self):
+    def run_fingerprint(
+        self,
+        sampling_params: Union["SamplingParams", Dict],
+        generate_kwargs: Dict[str, Any]
+    ) -> str:
         """
-        Download the model from Hugging Face Hub if it is not already present.
+        Fingerprint the model version and the parameters of an offline inference run,
+        runs with the same fingerprint generate the same kind of results.
+
+        :param sampling_params: Sampling parameters for the model.
+        :param generate_kwargs: Additional keyword arguments passed to LLM().
+        :return: The hex digest.
+        """
+        model_artifact = self.get_model_artifact()
+        if not isinstance(sampling_params, dict):
+            sampling_params = _normalize_sampling_params(sampling_params)
+        return hashlib.sha256(json.dumps({
+            "model": f"{model_artifact.uri}@{_get_artifact_version(model_artifact)}",
+            "sampling_params": sampling_params,
+            "engine_kwargs": {**self.engine_kwargs, **generate_kwargs},
+        }, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def offline_inference(
+        self,
+        prompts: List[str],
+        sampling_params: Union["SamplingParams", Dict],
+        **generate_kwargs
+    ) -> List["RequestOutput"]:
+        """
+        Perform offline inference using the VLLM model.
+
+        :param prompts: List of prompts to process.
+        :param sampling_params: Sampling parameters for the model.
+        :param generate_kwargs: Additional keyword arguments to pass to LLM(), a change rebuilds the engine.
+        :return List of RequestOutput containing the model's responses.
         """
         self.context.logger.info(
-            f"Downloading model {self.model_name} to {self.model_path}")
+            f"Running offline inference...")
 
-        snapshot_download(
-            repo_id=self.model_name,
-            local_dir=self.model_path)
+        # If sampling_params is a dict, convert it to SamplingParams
+        if isinstance(sampling_params, dict):
+            sampling_params = SamplingParams(**sampling_params)
 
-        # delete the .cache directory if it exists
-        cache_dir = os.path.join(self.model_path, ".cache")
-        if os.path.exists(cache_dir):
-            self.context.logger.info(f"Deleting cache directory: {cache_dir}")
-            shutil.rmtree(cache_dir)
+        engine_kwargs = {**self.engine_kwargs, **generate_kwargs}
+
+        # serve what we can from the response cache
+        if self.response_cache is not None:
+            if _is_deterministic(sampling_params):
+                return self._cached_inference(prompts, sampling_params, engine_kwargs)
+            self.context.logger.info(
+                "Bypassing the response cache, the sampling is not deterministic")
+
+        # Run inference
+        outputs = self._run_engine(prompts, sampling_params, engine_kwargs)
 
         self.context.logger.info(
-            f"Model {self.model_name} downloaded successfully to: {self.model_path}")
+            f"Offline inference completed with {len(outputs)} responses "
+            f"(engine_warm={self.engine_warm}).")
 
-    def _log_model(self):
+        return outputs
+
+    def _run_engine(
+        self,
+        prompts: List[str],
+        sampling_params: "SamplingParams",
+        engine_kwargs: Dict[str, Any]
+    ) -> List["RequestOutput"]:
         """
-        Log the model to the MLRun project.
+        Generate the prompts on the warm engine, or across the data-parallel workers when
+        data_parallel_size is greater than 1.
 
-        :param project: The MLRun project to log the model to.
+        :param prompts: List of prompts to process.
+        :param sampling_params: Sampling parameters for the model.
+        :param engine_kwargs: Keyword arguments passed to LLM().
+        :return List of RequestOutput in the order of the prompts.
         """
-        # get the project from the context
-        project_name = self.context.project
-        project = mlrun.get_or_create_project(name=project_name)
+        if self.data_parallel_size <= 1:
+            # get the warm engine, building it only if the key changed
+            llm = self._get_engine(**engine_kwargs)
+            return self._generate(llm, prompts, sampling_params)
 
-        self.context.logger.info(
-            f"Logging model {self.model_name} to project {project.name}")
+        pool = self._get_worker_pool(**engine_kwargs)
+        start = time.perf_counter()
+        with self.inference_metrics.phase("generate"):
+            try:
+                outputs, stats = pool.generate(prompts, sampling_params)
+            except RuntimeError:
+                # a failed pool is closed, the next run starts new workers
+                self._worker_pool = self._worker_pool_key = None
+                raise
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        self.inference_metrics.record_outputs(outputs)
 
-        # Assuming the model is saved in the model_path
-        model_artifact = project.log_artifact(
-            item=self.name,
-            local_path=self.model_path,
-            upload=True,
-            labels={"framework": "vllm", "source": "huggingface"}
-        )
-        # model_artifact = project.log_model(
-        #     key=self.name,
-        #      model_dir=self.model_path,
-        #     labels={"framework": "vllm", "source": "huggingface"}
-        # )
+        # accumulate the per-worker throughput over the chunks of the run
+        for worker, worker_stats in stats.items():
+            totals = self.worker_stats.setdefault(
+                worker, {"prompts": 0, "generated_tokens": 0, "seconds": 0.0})
+            for name in totals:
+                totals[name] += worker_stats[name]
+            totals["generated_tokens_per_second"] = (
+                totals["generated_tokens"] / totals["seconds"] if totals["seconds"] else 0.0)
 
+        per_worker = ", ".join(
+            f"worker {worker}={worker_stats['prompts']} prompts "
+            f"{worker_stats['generated_tokens_per_second']:.1f} tokens/s"
+            for worker, worker_stats in stats.items())
         self.context.logger.info(
-            f"Model {self.model_name} logged successfully to: {model_artifact.uri}")
+            f"Generated {len(prompts)} prompts on {pool.num_workers} workers: "
+            f"{len(prompts) / elapsed:.1f} prompts/s [{per_worker}]")
+
+        return outputs
 
-    def store_model(self):
+    def _generate(
+        self,
+        llm: "LLM",
+        prompts: List[str],
+        sampling_params: "SamplingParams"
+    ) -> List["RequestOutput"]:
         """
-        Store the model in the MLRun project.
-        This method is called to ensure the model is stored correctly.
+        Generate the prompts with per-request timings, optionally scheduling the prompts by shared prefix and
+        tokenized length first. The outputs are returned in the caller's order.
+
+        :param llm: The LLM engine.
+        :param prompts: List of prompts to process.
+        :param sampling_params: Sampling parameters for the model.
+        :return List of RequestOutput in the order of the prompts.
         """
-        self.context.logger.info(
-            f"Storing model {self.model_name} in project {self.context.project}")
+        scheduled = self.schedule_prompts and len(prompts) > 1
+        order = list(range(len(prompts)))
+        schedule_info = ""
+        if scheduled:
+            # tokenize the prompts to bucket them by length
+            tokenizer = llm.get_tokenizer()
+            token_lengths = [
+                len(input_ids) for input_ids in
+                tokenizer(prompts, add_special_tokens=False)["input_ids"]]
 
-        # Download the model
-        self._download_model()
+            before = _prefix_sharing_ratio(prompts, order)
+            order = _schedule_prompts(prompts, token_lengths)
+            after = _prefix_sharing_ratio(prompts, order)
+            schedule_info = f", adjacent prefix sharing {before:.0%} -> {after:.0%}"
+            self.inference_metrics.record_schedule(len(prompts), before, after)
 
-        # Log the model to the project
-        self._log_model()
+        start = time.perf_counter()
+        with self.inference_metrics.phase("generate"):
+            scheduled_outputs = _generate_timed(
+                llm,
+                [prompts[index] for index in order] if scheduled else prompts,
+                sampling_params
+            )
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        self.inference_metrics.record_outputs(scheduled_outputs)
 
-        # Delete the local model files after logging
-        if os.path.exists(self.model_path):
-            self.context.logger.info(
-                f"Deleting local model files at {self.model_path}")
-            shutil.rmtree(self.model_path)
+        # restore the caller's order
+        outputs = [None] * len(prompts)
+        for index, output in zip(order, scheduled_outputs):
+            outputs[index] = output
 
+        # the throughput of scheduled and unscheduled runs can be compared in the run results
+        generated_tokens = sum(
+            len(completion.token_ids) for output in outputs for completion in output.outputs)
         self.context.logger.info(
-            f"Model {self.model_name} stored successfully.")
-    # endregion Model Management
+            f"Generated {len(prompts)} prompts (scheduled={scheduled}{schedule_info}): "
+            f"{len(prompts) / elapsed:.1f} prompts/s, "
+            f"{generated_tokens / elapsed:.1f} generated tokens/s")
 
-    def get_model_artifact(self):
-        """ Retrieve the model artifact from the MLRun project."""
-        project = mlrun.get_or_create_project(name=self.context.project)
-        model_artifact = project.get_artifact(self.name)
-        return model_artifact
+        return outputs
 
-    def _download_tokenizer(self) -> str:
+    def _cached_inference(
+        self,
+        prompts: List[str],
+        sampling_params: "SamplingParams",
+        engine_kwargs: Dict[str, Any]
+    ) -> List["RequestOutput"]:
         """
-        Download the tokenizer from the model data item.
+        Run inference through the response cache. Duplicate prompts are generated once
+        and fanned out, and the engine is not touched when every prompt is a cache hit.
+
+        :param prompts: List of prompts to process.
+        :param sampling_params: Deterministic sampling parameters for the model.
+        :param engine_kwargs: Keyword arguments passed to LLM().
+        :return List of RequestOutput in the order of the prompts.
         """
-        # tokenizer files normally needed:
-        tokenizer_files = [
-            "tokenizer.json",
-            "tokenizer.model",         # some models have one or the other
-            "tokenizer_config.json",
-            "special_tokens_map.json",
-            "config.json",              # often needed too
-            "generation_config.json",   # optional, if exists
-        ]
+        model_artifact = self.get_model_artifact()
+        model_key = f"{model_artifact.uri}@{_get_artifact_version(model_artifact)}"
+        sampling_key = json.dumps(
+            _normalize_sampling_params(sampling_params), sort_keys=True, default=str)
+        keys = [ResponseCache.key(prompt, sampling_key, model_key) for prompt in prompts]
+
+        results = self.response_cache.get_many(list(set(keys)))
+
+        # the unique prompts that are not cached, in their original order
+        missing = {}
+        for key, prompt in zip(keys, prompts):
+            if key not in results and key not in missing:
+                missing[key] = prompt
+
+        if missing:
+            generated = dict(zip(missing, self._run_engine(
+                list(missing.values()), sampling_params, engine_kwargs)))
+            self.response_cache.put_many(generated)
+            results.update(generated)
 
-        # create a temporary directory to store the tokenizer files
-        temp_dir = tempfile.mkdtemp(prefix="vllm_tokenizer_")
+        num_hits = sum(1 for key in keys if key not in missing)
+        self.response_cache.hits += num_hits
+        self.response_cache.misses += len(missing)
         self.context.logger.info(
-            f"Downloading tokenizer files to temporary directory: {temp_dir}")
+            f"Offline inference completed with {len(prompts)} responses "
+            f"(cache_hits={num_hits}, cache_misses={len(missing)}, "
+            f"duplicates={len(prompts) - num_hits - len(missing)}).")
 
-        # get the model artifact from the context
-        model_artifact = self.get_model_artifact()
+        # each prompt gets its own copy of the shared output
+        return [copy.copy(results[key]) for key in keys]
 
-        # get the files in the data item
-        data_item = mlrun.get_dataitem(model_artifact.uri)
-        data_item_files = data_item.listdir()
 
-        # download tokenizer-related files
-        for filename in data_item_files:
-            # if the file is not in the tokenizer files, skip it
-            if filename not in tokenizer_files:
-                continue
+# region Model Router
+class VLLMModelRouter(mlrun.serving.routers.ModelRouter):
+    """
+    Route requests by model name to VLLMModelServer routes hosted in one serving
+    process. The engines are loaded on the first request of their model and kept
+    within a memory budget: when a model does not fit, the engines of the least
+    recently used idle models are unloaded first. The load, eviction and hit counts
+    are reported with the router metadata (<health-prefix>) and the model list.
 
-            # download the file to the temporary directory
-            self.context.logger.info(
-                f"...Downloading {filename} to {temp_dir}")
-            data_item_file = mlrun.get_dataitem(f"{data_item.url}{filename}")
-            data_item_file.download(target_path=f"{temp_dir}/{filename}")
+    The budget is only as good as the declared engine memory, so set each route's
+    "engine_memory_gb" and size its engine to it (e.g. with gpu_memory_utilization).
+    """
 
-        return temp_dir
+    # operations served without loading the engine, along with the GET model metadata
+    PASSIVE_OPERATIONS = ("ready", "warmup")
 
-    def offline_inference(
+    def __init__(
         self,
-        prompts: List[str],
-        sampling_params: Union[SamplingParams, Dict],
-        **generate_kwargs
-    ) -> List[RequestOutput]:
+        context=None,
+        name: Optional[str] = None,
+        routes=None,
+        memory_budget_gb: Optional[float] = None,
+        **kwargs
+    ):
         """
-        Perform offline inference using the VLLM model.
+        Initialize the router.
 
-        :param prompts: List of prompts to process.
-        :param sampling_params: Sampling parameters for the model.
-        :param generate_kwargs: Additional keyword arguments to pass to llm.generate().
-        :return List of RequestOutput containing the model's responses.
+        :param context: MLRun context, passed in by the serving graph.
+        :param name: Name of the router step.
+        :param routes: The model routes, passed in by the serving graph.
+        :param memory_budget_gb: The memory the loaded engines may hold together, no limit
+                                 when not given.
+        :param kwargs: Additional arguments of the model router.
         """
-        self.context.logger.info(
-            f"Running offline inference...")
+        super().__init__(context=context, name=name, routes=routes, **kwargs)
+        self.memory_budget_bytes = int(memory_budget_gb * 1024 ** 3) if memory_budget_gb else None
 
-        # get the model artifact
-        model_artifact = self.get_model_artifact()
+        # the routes are built after the router, they defer loading to the router
+        for route in (routes or {}).values():
+            route.class_args = {"load_on_demand": True, **(route.class_args or {})}
 
-        # download the tokenizer
-        self.context.logger.info(
-            f"Downloading tokenizer for model {self.model_name}")
-        tokenizer_dir = self._download_tokenizer()
+        # loaded models in least recently used order, with the memory of their engine
+        self._loaded: "OrderedDict[str, int]" = OrderedDict()
+        self._memory: Dict[str, int] = {}
+        self._in_flight: Dict[str, int] = defaultdict(int)
+        self._pool_lock = threading.Lock()
+        self._engine_lock = threading.Lock()
+        self.model_stats: Dict[str, Dict[str, int]] = defaultdict(
+            lambda: {"loads": 0, "evictions": 0, "hits": 0})
 
-        # If sampling_params is a dict, convert it to SamplingParams
-        if isinstance(sampling_params, dict):
-            sampling_params = SamplingParams(**sampling_params)
+    def engine_pool_stats(self) -> Dict[str, Any]:
+        """
+        Get the state and counters of the engine pool.
 
-        # Initialize the LLM with the model path
-        llm = LLM(
-            model=model_artifact.target_path,
-            tokenizer=tokenizer_dir,
-            hf_config_path=tokenizer_dir,
-            trust_remote_code=True,
-            load_format="runai_streamer",
-            **generate_kwargs
-        )
+        :return: The memory budget and use, the loaded models from least to most recently
+                 used, and the load, eviction and hit counts in total and per model.
+        """
+        with self._pool_lock:
+            models = {name: dict(stats) for name, stats in self.model_stats.items()}
+            return {
+                "memory_budget_bytes": self.memory_budget_bytes,
+                "memory_used_bytes": sum(self._loaded.values()),
+                "loaded_models": list(self._loaded),
+                **{counter: sum(stats[counter] for stats in models.values())
+                   for counter in ("loads", "evictions", "hits")},
+                "models": models,
+            }
 
-        # Run inference
-        outputs = llm.generate(
-            prompts,
-            sampling_params=sampling_params
-        )
+    def get_metadata(self) -> Dict[str, Any]:
+        """
+        Get the router details and the engine pool stats.
+
+        :return: The router metadata.
+        """
+        return {**super().get_metadata(), "engine_pool": self.engine_pool_stats()}
+
+    def _handle_event(self, event):
+        name, route, subpath = self._resolve_route(event.body, event.path)
+        if not route:
+            setattr(event, "terminated", True)
+            event.body = {"models": list(self.routes.keys()), "engine_pool": self.engine_pool_stats()}
+            return event
+        if self._is_passive(event, subpath):
+            return super()._handle_event(event)
+
+        self._acquire(name, route.async_object)
+        try:
+            return super()._handle_event(event)
+        finally:
+            with self._pool_lock:
+                self._in_flight[name] -= 1
+
+    def _is_passive(self, event, subpath: str) -> bool:
+        """
+        Check if a request is served without loading the engine. The operation is resolved
+        like V2ModelServer.do_event does: the path, else the body's "operation", else infer
+        for any method but GET.
 
+        :param event: The serving event.
+        :param subpath: The operation path of the route.
+        :return: True for the GET model metadata and the passive operations.
+        """
+        op = subpath.strip("/")
+        if not op and isinstance(event.body, dict):
+            op = event.body.get("operation") or ""
+        if not op:
+            return event.method == "GET"
+        return op in self.PASSIVE_OPERATIONS
+
+    def _acquire(self, name: str, server: VLLMModelServer):
+        """
+        Make sure the engine of a model is loaded and mark it in use, unloading least
+        recently used idle engines to make room for it.
+
+        :param name: The route name of the model.
+        :param server: The model server of the route.
+        """
+        with self._pool_lock:
+            self._in_flight[name] += 1
+            if name in self._loaded:
+                self._loaded.move_to_end(name)
+                self.model_stats[name]["hits"] += 1
+                evicted = []
+            else:
+                try:
+                    evicted = self._reserve(name, server)
+                except Exception:
+                    self._in_flight[name] -= 1
+                    raise
+                self.model_stats[name]["loads"] += 1
+        if not evicted and server.ready:
+            return
+
+        # the engines are (un)loaded outside the pool lock so the loaded models keep
+        # serving, and one at a time so an evicted model reserved again is not unloaded
+        try:
+            with self._engine_lock:
+                for evicted_name in evicted:
+                    with self._pool_lock:
+                        if evicted_name in self._loaded:
+                            continue
+                    self.context.logger.info(
+                        f"Unloading model {evicted_name} to make room for {name}")
+                    self.routes[evicted_name].async_object.unload()
+                server.load()
+                server.ready = True
+        except Exception:
+            with self._pool_lock:
+                self._in_flight[name] -= 1
+                self._loaded.pop(name, None)
+            raise
+
+    def _reserve(self, name: str, server: VLLMModelServer) -> List[str]:
+        """
+        Reserve the memory of a model in the pool, called with the pool lock held.
+
+        :param name: The route name of the model.
+        :param server: The model server of the route.
+        :return: The names of the models to unload to make room for it.
+        """
+        if name not in self._memory:
+            self._memory[name] = server.engine_memory_bytes()
+        memory = self._memory[name]
+
+        evicted = []
+        if self.memory_budget_bytes is not None:
+            if memory > self.memory_budget_bytes:
+                raise ValueError(
+                    f"Model {name} needs {memory} bytes, more than the memory budget of "
+                    f"{self.memory_budget_bytes} bytes")
+            used = sum(self._loaded.values())
+            for candidate in list(self._loaded):
+                if used + memory <= self.memory_budget_bytes:
+                    break
+                if self._in_flight[candidate]:
+                    continue
+                used -= self._loaded.pop(candidate)
+                self.model_stats[candidate]["evictions"] += 1
+                evicted.append(candidate)
+            if used + memory > self.memory_budget_bytes:
+                # nothing was unloaded yet, put the evicted models back
+                for candidate in reversed(evicted):
+                    self._loaded[candidate] = self._memory[candidate]
+                    self._loaded.move_to_end(candidate, last=False)
+                    self.model_stats[candidate]["evictions"] -= 1
+                raise RuntimeError(
+                    f"Model {name} does not fit in the memory budget while the loaded models "
+                    f"serve requests, retry later")
+
+        self._loaded[name] = memory
         self.context.logger.info(
-            f"Offline inference completed with {len(outputs)} responses.")
+            f"Loading model {name} ({memory} bytes), "
+            f"{sum(self._loaded.values())} of {self.memory_budget_bytes} bytes in use")
+        return evicted
+# endregion Model Router
 
-        return outputs
 
 # region Handler Methods
 
 
+def _chunks(items: List[Any], chunk_size: int) -> Iterator[List[Any]]:
+    """
+    Split a list into consecutive chunks.
+
+    :param items: The list to split.
+    :param chunk_size: The maximum size of a chunk.
+    :return: An iterator over the chunks.
+    """
+    for start in range(0, len(items), chunk_size):
+        yield items[start:start + chunk_size]
+
+
+def _rebatch(batches: Iterator[List[Any]], batch_size: int) -> Iterator[List[Any]]:
+    """
+    Regroup an iterator of variable sized batches into batches of a fixed size.
+
+    :param batches: The batches to regroup.
+    :param batch_size: The size of the output batches, the last one may be smaller.
+    :return: An iterator over the regrouped batches.
+    """
+    buffer = []
+    for batch in batches:
+        buffer.extend(batch)
+        while len(buffer) >= batch_size:
+            yield buffer[:batch_size]
+            buffer = buffer[batch_size:]
+    if buffer:
+        yield buffer
+
+
+def _iter_dataset_prompts(
+    local_path: str,
+    prompt_column: str,
+    batch_size: int
+) -> Iterator[List[str]]:
+    """
+    Read the prompt column of a Parquet, CSV or JSONL file lazily in record batches,
+    so the file is never fully loaded into memory. A JSON file, a list of records or an
+    object with a "prompts" list, is parsed whole.
+
+    :param local_path: The local path of the dataset file.
+    :param prompt_column: The name of the column holding the prompts.
+    :param batch_size: The number of prompts per batch.
+    :return: An iterator over the prompt batches.
+    """
+    suffix = os.path.splitext(local_path)[1].lower()
+
+    if suffix in (".parquet", ".pq"):
+        # column projection, only the prompt column is read from the file
+        batches = (
+            batch.column(0).to_pylist()
+            for batch in pq.ParquetFile(local_path).iter_batches(
+                batch_size=batch_size, columns=[prompt_column]))
+    elif suffix == ".csv":
+        reader = pa_csv.open_csv(
+            local_path,
+            convert_options=pa_csv.ConvertOptions(
+                include_columns=[prompt_column],
+                column_types={prompt_column: pa.string()}))
+        batches = (batch.column(0).to_pylist() for batch in reader)
+    elif suffix in (".jsonl", ".ndjson"):
+        def read_lines():
+            with open(local_path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        yield [json.loads(line)[prompt_column]]
+        batches = read_lines()
+    elif suffix == ".json":
+        # a JSON document is parsed whole: a list of records or {"prompts": [...]}
+        with open(local_path, encoding="utf-8") as f:
+            document = json.load(f)
+        if isinstance(document, dict):
+            if "prompts" not in document:
+                raise ValueError(
+                    "A JSON prompts dataset must be a list of records or hold a \"prompts\" list")
+            document = document["prompts"]
+        batches = [[
+            record[prompt_column] if isinstance(record, dict) else record
+            for record in document]]
+    else:
+        raise ValueError(
+            f"Unsupported prompts dataset format {suffix}, expected Parquet, CSV, JSON or JSONL")
+
+    for batch in _rebatch(batches, batch_size):
+        yield [str(prompt) if prompt is not None else "" for prompt in batch]
+
+
+def _log_outputs_file(context: mlrun.MLClientCtx, key: str, local_path: str, output_format: str):
+    """
+    Log a results file: Parquet as a dataset artifact, JSONL as a plain artifact since
+    dataset artifacts do not support the JSONL format.
+
+    :param context: MLRun context.
+    :param key: The artifact key.
+    :param local_path: The local results file.
+    :param output_format: The file format, "parquet" or "jsonl".
+    """
+    if output_format == "parquet":
+        context.log_dataset(
+            key=key,
+            df=None,
+            local_path=local_path,
+            format=output_format)
+    else:
+        context.log_artifact(
+            key,
+            local_path=local_path,
+            format=output_format)
+
+
+def _run_streaming_inference(
+    context: mlrun.MLClientCtx,
+    server: VLLMModelServer,
+    prompt_chunks: Iterator[List[str]],
+    sampling_params: Dict[str, Union[float, int, str]],
+    output_format: str,
+    checkpoint: Optional[InferenceCheckpoint] = None,
+    pipeline_queue_size: int = PIPELINE_QUEUE_SIZE,
+    **generate_kwargs
+):
+    """
+    Run offline inference chunk by chunk, appending each chunk's results to a dataset
+    artifact as it finishes. Prefetching the prompts, generation and writing the results
+    run as overlapping stages, so the engine does not wait on the dataset or the artifact
+    store. Only summary counters and the busy / idle time of every stage are logged as
+    run results.
+
+    :param context: MLRun context.
+    :param server: The model server running the inference.
+    :param prompt_chunks: The prompts, split into chunks.
+    :param sampling_params: Sampling parameters for the model.
+    :param output_format: The dataset file format, "parquet" or "jsonl".
+    :param checkpoint: Optional checkpoint to resume from and to record completed chunks in.
+    :param pipeline_queue_size: The number of chunks queued between two stages.
+    :param generate_kwargs: Additional keyword arguments for inference.
+    """
+    output_dir = tempfile.mkdtemp(prefix="vllm_outputs_")
+    writer = InferenceResultWriter(
+        path=os.path.join(output_dir, f"outputs.{output_format}"),
+        output_format=output_format)
+
+    # chunks completed by a previous run with the same run key are not generated again
+    completed_chunks = checkpoint.load(context.logger) if checkpoint else 0
+
+    counters = {"num_chunks": 0, "num_empty_responses": 0, "num_recovered": 0, "num_generated": 0}
+
+    def prefetch(indexed_chunk: Tuple[int, List[str]]) -> Tuple[int, List[str], Optional[pa.Table]]:
+        chunk_index, chunk = indexed_chunk
+        if chunk_index < completed_chunks:
+            return chunk_index, chunk, checkpoint.read_chunk(chunk_index, chunk)
+        return chunk_index, chunk, None
+
+    def generate(
+        prefetched_chunk: Tuple[int, List[str], Optional[pa.Table]]
+    ) -> Tuple[int, List[str], pa.Table, bool]:
+        chunk_index, chunk, table = prefetched_chunk
+        if table is not None:
+            counters["num_recovered"] += table.num_rows
+            return chunk_index, chunk, table, False
+        outputs = server.offline_inference(
+            prompts=chunk,
+            sampling_params=sampling_params,
+            **generate_kwargs)
+        table = _outputs_to_table(outputs)
+        counters["num_generated"] += table.num_rows
+        return chunk_index, chunk, table, True
+
+    def write(generated_chunk: Tuple[int, List[str], pa.Table, bool]):
+        chunk_index, chunk, table, generated = generated_chunk
+        if checkpoint and generated:
+            checkpoint.add_chunk(chunk_index, chunk, table)
+
+        # write the chunk and drop it, memory stays bounded by the chunk size
+        writer.write(table)
+        counters["num_chunks"] += 1
+        counters["num_empty_responses"] += pc.sum(
+            pc.equal(pc.utf8_length(table["response"]), 0)).as_py() or 0
+
+        context.logger.info(
+            f"Chunk {counters['num_chunks']} done, {writer.num_rows} responses written.")
+
+    executor = PipelinedExecutor(queue_size=pipeline_queue_size)
+    try:
+        executor.run(enumerate(prompt_chunks), prefetch=prefetch, generate=generate, write=write)
+        writer.close()
+        if checkpoint:
+            checkpoint.commit()
+
+        _log_outputs_file(context, "outputs", writer.path, output_format)
+    finally:
+        writer.close()
+        shutil.rmtree(output_dir, ignore_errors=True)
+        if checkpoint:
+            checkpoint.close()
+
+    stages = executor.summary()
+    context.logger.info(
+        "Pipeline stages: " + ", ".join(
+            f"{name} busy {stage.busy_seconds:.2f}s idle {stage.idle_seconds:.2f}s"
+            for name, stage in executor.stages.items())
+        + f", bottleneck {stages['pipeline_bottleneck']}")
+
+    context.log_results({
+        **counters,
+        "num_responses": writer.num_rows,
+        "engine_warm": server.engine_warm,
+        **stages,
+    })
+
+
+def _log_inference_metrics(context: mlrun.MLClientCtx, server: VLLMModelServer):
+    """
+    Log the phase timings and throughput of the run as results and a metrics artifact.
+
+    :param context: The MLRun context.
+    :param server: The model server that ran the inference.
+    """
+    summary = server.inference_metrics.summary()
+    context.log_results(summary)
+    if server.worker_stats:
+        context.log_result(key="worker_throughput", value=server.worker_stats)
+    context.log_artifact(
+        "inference_metrics",
+        body=json.dumps({
+            **summary,
+            "phase_calls": dict(server.inference_metrics.phase_calls),
+            "workers": server.worker_stats,
+        }, indent=2),
+        format="json",
+    )
+    context.logger.info(
+        f"Inference metrics: {summary['num_requests']} requests, "
+        f"{summary['prompt_tokens']} prompt tokens, "
+        f"{summary['generated_tokens']} generated tokens")
+
+
 def offline_inference_handler(
     context: mlrun.MLClientCtx,
     model_name: str,
-    prompts: List[str],
-    sampling_params: Dict[str, Union[float, int, str]],
+    prompts: Optional[List[str]] = None,
+    sampling_params: Optional[Dict[str, Union[float, int, str]]] = None,
+    prompts_dataset: Optional[mlrun.DataItem] = None,
+    prompt_column: str = "prompt",
+    chunk_size: Optional[int] = None,
+    output_format: str = "parquet",
+    run_key: Optional[str] = None,
+    checkpoint_path: Optional[str] = None,
+    checkpoint_interval: int = 1,
+    response_cache_path: Optional[str] = None,
+    response_cache_url: Optional[str] = None,
+    schedule_prompts: bool = False,
+    data_parallel_size: int = 1,
+    log_outputs_result: bool = True,
+    pipeline_queue_size: int = PIPELINE_QUEUE_SIZE,
     **generate_kwargs
 ) -> List[Dict[str, str]]:
     """
@@ -229,11 +4114,45 @@ def offline_inference_handler(
     :param context: MLRun context.
     :param model_name: Name of the VLLM model.
     :param prompts: List of prompts to process.
-    :param sampling_params: Sampling parameters for the model.
+    :param sampling_params: Sampling parameters for the model, defaults to the vLLM defaults.
+    :param prompts_dataset: Parquet, CSV, JSON or JSONL dataset input to read the prompts from
+                            instead of the prompts parameter. The prompts are read lazily (JSON
+                            files are parsed whole) and always run in streaming mode.
+    :param prompt_column: The dataset column holding the prompts.
+    :param chunk_size: When set, run the prompts in chunks of this size and stream the
+                       results to the "outputs" dataset artifact instead of a run result.
+    :param output_format: The dataset file format in streaming mode, "parquet" or "jsonl".
+    :param run_key: When set, checkpoint the completed chunks (streaming mode) so a rerun with
+                    the same run key skips them and continues from the last checkpoint.
+    :param checkpoint_path: The artifact store directory for the checkpoint, defaults to
+                            checkpoints/<run_key> under the project artifact path.
+    :param checkpoint_interval: The number of chunks between checkpoint uploads.
+    :param response_cache_path: Local SQLite file of the response cache, enables the cache.
+    :param response_cache_url: Artifact store url the response cache is loaded from and synced
+                               to at the end of the run, enables the cache.
+    :param schedule_prompts: Group the prompts by shared prefix and tokenized length before they
+                             are submitted to the engine, the results keep the original order.
+    :param data_parallel_size: The number of engine worker processes the prompts are sharded
+                               across, each pinned to its own devices (or CPU cores).
+    :param log_outputs_result: Also log the prompt / response pairs as the "outputs" run result
+                               (non-streaming mode). Deprecated, the run result holds every
+                               response in the run DB, read the "outputs_table" dataset instead.
+    :param pipeline_queue_size: The number of chunks queued between the prefetch, generate and write
+                                stages in streaming mode, more chunks absorb slower reads and
+                                writes at the cost of memory.
     :param generate_kwargs: Additional keyword arguments for inference.
     """
-    context.logger.info(
-        f"Running offline inference for model {model_name} with {len(prompts)} prompts.")
+    if (prompts is None) == (prompts_dataset is None):
+        raise ValueError("Exactly one of prompts or prompts_dataset must be given")
+    sampling_params = sampling_params or {}
+
+    if prompts is not None:
+        context.logger.info(
+            f"Running offline inference for model {model_name} with {len(prompts)} prompts.")
+    else:
+        context.logger.info(
+            f"Running offline inference for model {model_name} with prompts from "
+            f"{prompts_dataset.url} (column {prompt_column}).")
 
     # set the aws endpoint url for vLLM
     s3_endpoint_url = os.environ.get("S3_ENDPOINT_URL")
@@ -248,21 +4167,163 @@ def offline_inference_handler(
         model_name=model_name
     )
 
-    # run offline inference
-    outputs = server.offline_inference(
-        prompts=prompts,
-        sampling_params=sampling_params,
-        **generate_kwargs)
-
-    # log the output
-    output_dict = [{
-        "prompt": str(output.prompt) if output.prompt is not None else "",
-        "response": str(output.outputs[0].text) if output.outputs and output.outputs[0].text is not None else "",
-    } for output in outputs]
-
-    context.log_result(
-        key="outputs",
-        value=output_dict,
+    server.schedule_prompts = schedule_prompts
+    server.data_parallel_size = data_parallel_size
+
+    # optional response cache, synced to the artifact store when the run ends
+    if response_cache_path or response_cache_url:
+        server.response_cache = ResponseCache(
+            path=response_cache_path, remote_url=response_cache_url)
+
+    try:
+        # prompts from a dataset are read lazily, checkpointed runs are streamed too
+        if prompts_dataset is not None or chunk_size or run_key:
+            chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+            if prompts_dataset is not None:
+                prompt_chunks = _iter_dataset_prompts(
+                    local_path=prompts_dataset.local(),
+                    prompt_column=prompt_column,
+                    batch_size=chunk_size)
+            else:
+                prompt_chunks = _chunks(prompts, chunk_size)
+
+            checkpoint = None
+            if run_key:
+                checkpoint = InferenceCheckpoint(
+                    path=checkpoint_path or _default_checkpoint_path(context, run_key),
+                    chunk_size=chunk_size,
+                    interval=checkpoint_interval,
+                    fingerprint=server.run_fingerprint(sampling_params, generate_kwargs))
+
+            try:
+                _run_streaming_inference(
+                    context=context,
+                    server=server,
+                    prompt_chunks=prompt_chunks,
+                    sampling_params=sampling_params,
+                    output_format=output_format,
+                    checkpoint=checkpoint,
+                    pipeline_queue_size=pipeline_queue_size,
+                    **generate_kwargs)
+            finally:
+                if prompts_dataset is not None:
+                    prompts_dataset.remove_local()
+            _log_inference_metrics(context, server)
+            return
+
+        # run offline inference
+        outputs = server.offline_inference(
+            prompts=prompts,
+            sampling_params=sampling_params,
+            **generate_kwargs)
+
+        # log the output, the enriched table as a parquet dataset and, unless disabled, the
+        # prompt / response pairs as a run result
+        table = _outputs_to_table(outputs)
+        output_dir = tempfile.mkdtemp(prefix="vllm_outputs_")
+        try:
+            writer = InferenceResultWriter(path=os.path.join(output_dir, "outputs.parquet"))
+            writer.write(table)
+            writer.close()
+            context.log_dataset(
+                key="outputs_table",
+                df=None,
+                local_path=writer.path,
+                format="parquet")
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+        if log_outputs_result:
+            context.logger.warning(
+                "The outputs run result is deprecated, read the outputs_table dataset and "
+                "pass log_outputs_result=False")
+            context.log_result(
+                key="outputs",
+                value=table.select(["prompt", "response"]).to_pylist(),
+            )
+        context.log_result(key="engine_warm", value=server.engine_warm)
+        _log_inference_metrics(context, server)
+    finally:
+        # the worker processes do not outlive the run
+        if server.data_parallel_size > 1:
+            server._shutdown_engine()
+        if server.response_cache is not None:
+            server.response_cache.sync()
+            server.response_cache.close()
+            context.log_results({
+                "cache_hits": server.response_cache.hits,
+                "cache_misses": server.response_cache.misses,
+            })
+
+
+def token_plan_handler(
+    context: mlrun.MLClientCtx,
+    model_name: str,
+    prompts: Optional[List[str]] = None,
+    prompts_dataset: Optional[mlrun.DataItem] = None,
+    prompt_column: str = "prompt",
+    max_tokens: int = 16,
+    max_model_len: Optional[int] = None,
+    chunk_tokens: int = PLAN_CHUNK_TOKENS,
+    num_threads: int = 4
+):
+    """
+    Handler counting the prompt tokens and suggesting a batching plan, using only the
+    cached tokenizer files of the model (no engine is built).
+
+    :param context: MLRun context.
+    :param model_name: Name of the VLLM model.
+    :param prompts: List of prompts to plan.
+    :param prompts_dataset: Parquet, CSV, JSON or JSONL dataset input to read the prompts from
+                            instead of the prompts parameter.
+    :param prompt_column: The dataset column holding the prompts.
+    :param max_tokens: The number of tokens generated per prompt.
+    :param max_model_len: The context length the engine will run with, if already chosen.
+    :param chunk_tokens: The token budget of a chunk.
+    :param num_threads: The number of tokenizing threads.
+    """
+    if (prompts is None) == (prompts_dataset is None):
+        raise ValueError("Exactly one of prompts or prompts_dataset must be given")
+
+    server = VLLMModelServer(
+        context=context,
+        name=model_name,
+        model_path=f"/tmp/{model_name}",
+        model_name=model_name
     )
+    # the dataset prompts are streamed through the tokenizer chunk by chunk
+    try:
+        plan = server.plan_batches(
+            prompts,
+            max_tokens=max_tokens,
+            max_model_len=max_model_len,
+            chunk_tokens=chunk_tokens,
+            num_threads=num_threads,
+            prompt_chunks=_iter_dataset_prompts(
+                local_path=prompts_dataset.local(),
+                prompt_column=prompt_column,
+                batch_size=DEFAULT_CHUNK_SIZE) if prompts_dataset is not None else None)
+    finally:
+        if prompts_dataset is not None:
+            prompts_dataset.remove_local()
+    token_lengths = plan.pop("token_lengths")
+
+    # the per-prompt lengths go to a dataset, the summary and plan to results and a json artifact
+    output_dir = tempfile.mkdtemp(prefix="vllm_token_plan_")
+    try:
+        local_path = os.path.join(output_dir, "token_lengths.parquet")
+        pq.write_table(
+            pa.table({"prompt_tokens": pa.array(token_lengths, type=pa.int32())}),
+            local_path, compression=OUTPUT_COMPRESSION)
+        context.log_dataset(
+            key="token_lengths",
+            df=None,
+            local_path=local_path,
+            format="parquet")
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    context.log_results(plan)
+    context.log_artifact("token_plan", body=json.dumps(plan, indent=2), format="json")
 
 # endregion Handler Methods
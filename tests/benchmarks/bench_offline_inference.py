@@ -0,0 +1,453 @@
+"""
+Benchmark of the offline_inference_handler overhead, without a GPU or network.
+
+The vllm engine is replaced by a deterministic fake with a configurable per-token
+latency and output length, and the MLRun project, artifact store and run context by
+fakes backed by a local directory. The handler runs end to end (sampling parameter
+conversion, engine dispatch, output tables, result files and result logging) and the
+time not spent in the fake engine is reported as the handler overhead.
+
+Usage:
+    python tests/benchmarks/bench_offline_inference.py                   # 1k, 100k, 1M prompts
+    python tests/benchmarks/bench_offline_inference.py --sizes 1000 --save
+    python tests/benchmarks/bench_offline_inference.py --compare --tolerance 0.25
+    python tests/benchmarks/bench_offline_inference.py --generate-paths --sizes 10000
+
+The baselines in baselines.json are machine specific, save new ones before comparing
+on another machine.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+from functions.vllm_model_server import (DEFAULT_CHUNK_SIZE, VLLMModelServer, _generate_timed,
+                                         offline_inference_handler)
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), 'baselines.json')
+DEFAULT_SIZES = [1_000, 100_000, 1_000_000]
+
+# stands in for vllm.sampling_params.RequestOutputKind
+OUTPUT_KINDS = SimpleNamespace(CUMULATIVE='cumulative', DELTA='delta', FINAL_ONLY='final_only')
+
+
+class FakeLLM:
+    """
+    A deterministic stand-in for vllm.LLM. Every engine step decodes the whole running
+    batch, taking per_token_latency seconds per output token, and returns the finished
+    request outputs.
+    """
+
+    def __init__(self, per_token_latency: float = 0.0, output_tokens: int = 16, **engine_args):
+        """
+        Initialize the fake engine.
+
+        :param per_token_latency: Seconds per decode step of the batch.
+        :param output_tokens: Tokens generated per request, capped by max_tokens.
+        :param engine_args: The keyword arguments the handler passed to LLM().
+        """
+        self.per_token_latency = per_token_latency
+        self.output_tokens = output_tokens
+        self.engine_args = engine_args
+        self.engine_seconds = 0.0
+        self.num_requests = 0
+        self._pending = []
+
+    @property
+    def llm_engine(self):
+        return self
+
+    def get_tokenizer(self):
+        return lambda prompts, add_special_tokens=True: {'input_ids': [prompt.split() for prompt in prompts]}
+
+    def add_request(self, request_id: str, prompt: str, params):
+        self._pending.append((request_id, prompt, params))
+
+    def has_unfinished_requests(self) -> bool:
+        return bool(self._pending)
+
+    def step(self) -> List[SimpleNamespace]:
+        start = time.perf_counter()
+        pending, self._pending = self._pending, []
+        num_tokens = max(
+            (self._num_tokens(params) for _, _, params in pending), default=0)
+        if self.per_token_latency:
+            time.sleep(self.per_token_latency * num_tokens)
+        outputs = [
+            self._output(request_id, prompt, self._num_tokens(params))
+            for request_id, prompt, params in pending]
+        self.num_requests += len(outputs)
+        self.engine_seconds += time.perf_counter() - start
+        return outputs
+
+    def generate(self, prompts, sampling_params=None, use_tqdm=True) -> List[SimpleNamespace]:
+        for index, prompt in enumerate(prompts):
+            params = sampling_params[index] if isinstance(sampling_params, list) else sampling_params
+            self.add_request(str(index), prompt, params)
+        return self.step()
+
+    def _num_tokens(self, params) -> int:
+        max_tokens = getattr(params, 'max_tokens', None)
+        return min(self.output_tokens, max_tokens) if max_tokens else self.output_tokens
+
+    @staticmethod
+    def _output(request_id: str, prompt: str, num_tokens: int, finished: bool = True) -> SimpleNamespace:
+        return SimpleNamespace(
+            request_id=request_id, prompt=prompt, finished=finished, metrics=None,
+            prompt_token_ids=list(range(len(prompt.split()))),
+            outputs=[SimpleNamespace(
+                index=0, text=' '.join(['tok'] * num_tokens), token_ids=list(range(num_tokens)),
+                finish_reason='length')])
+
+
+class SteppingFakeLLM(FakeLLM):
+    """
+    A fake engine decoding one token of every running request per step and honouring
+    the output kind of the requests like the vllm engine: a CUMULATIVE request gets its
+    output so far on every step, a FINAL_ONLY request only once it finishes. generate()
+    adds FINAL_ONLY requests, as LLM.generate does.
+    """
+
+    def add_request(self, request_id: str, prompt: str, params):
+        self._pending.append([request_id, prompt, params, 0])
+
+    def step(self) -> List[SimpleNamespace]:
+        start = time.perf_counter()
+        if self.per_token_latency:
+            time.sleep(self.per_token_latency)
+        outputs = []
+        running = []
+        for request in self._pending:
+            request_id, prompt, params, num_tokens = request
+            request[3] = num_tokens = num_tokens + 1
+            finished = num_tokens >= self._num_tokens(params)
+            if finished or getattr(params, 'output_kind', None) != OUTPUT_KINDS.FINAL_ONLY:
+                outputs.append(self._output(request_id, prompt, num_tokens, finished))
+            if finished:
+                self.num_requests += 1
+            else:
+                running.append(request)
+        self._pending = running
+        self.engine_seconds += time.perf_counter() - start
+        return outputs
+
+    def generate(self, prompts, sampling_params=None, use_tqdm=True) -> List[SimpleNamespace]:
+        for index, prompt in enumerate(prompts):
+            params = sampling_params[index] if isinstance(sampling_params, list) else sampling_params
+            self.add_request(str(index), prompt, SimpleNamespace(**{
+                **vars(params or SimpleNamespace()), 'output_kind': OUTPUT_KINDS.FINAL_ONLY}))
+        outputs = {}
+        while self.has_unfinished_requests():
+            for output in self.step():
+                outputs[int(output.request_id)] = output
+        return [outputs[index] for index in range(len(prompts))]
+
+
+class FakeArtifactStore:
+    """
+    A filesystem-backed stand-in for the MLRun project and artifact store. The model
+    artifact is a directory of config and tokenizer files, and logged artifacts and
+    results are stored under the same root.
+    """
+
+    MODEL_FILES = {
+        'config.json': {'architectures': ['FakeForCausalLM'], 'max_position_embeddings': 4096},
+        'tokenizer.json': {'version': '1.0', 'model': {'type': 'WordLevel'}},
+        'tokenizer_config.json': {'model_max_length': 4096},
+    }
+
+    def __init__(self, root: str, name: str = 'benchmark'):
+        """
+        Create the store and the model artifact files.
+
+        :param root: The directory backing the store.
+        :param name: The project name.
+        """
+        self.root = root
+        self.name = name
+        self.artifacts: Dict[str, SimpleNamespace] = {}
+        self.results: Dict[str, Any] = {}
+
+    def add_model(self, key: str) -> SimpleNamespace:
+        """
+        Store the files of a model artifact.
+
+        :param key: The artifact key, the handler's model name.
+        :return: The model artifact.
+        """
+        model_dir = os.path.join(self.root, 'models', key.replace('/', '_'))
+        os.makedirs(model_dir, exist_ok=True)
+        for filename, body in self.MODEL_FILES.items():
+            with open(os.path.join(model_dir, filename), 'w') as f:
+                json.dump(body, f)
+        artifact = SimpleNamespace(
+            key=key, uri=f'{model_dir}/', target_path=f'{model_dir}/',
+            metadata=SimpleNamespace(uid='benchmark', tree=None, hash=None))
+        self.artifacts[key] = artifact
+        return artifact
+
+    def get_artifact(self, key: str) -> SimpleNamespace:
+        return self.artifacts[key]
+
+    def log_file(self, key: str, local_path: Optional[str] = None, body: Optional[str] = None) -> str:
+        """
+        Store a logged artifact file.
+
+        :param key: The artifact key.
+        :param local_path: The local file to copy, or
+        :param body: The artifact body.
+        :return: The stored path.
+        """
+        target_dir = os.path.join(self.root, 'artifacts')
+        os.makedirs(target_dir, exist_ok=True)
+        if local_path is not None:
+            target_path = os.path.join(target_dir, f'{key}{os.path.splitext(local_path)[1]}')
+            shutil.copyfile(local_path, target_path)
+        else:
+            target_path = os.path.join(target_dir, key)
+            with open(target_path, 'w') as f:
+                f.write(body or '')
+        return target_path
+
+
+class FakeContext:
+    """
+    A stand-in for the MLRun run context, logging into a FakeArtifactStore.
+    """
+
+    def __init__(self, store: FakeArtifactStore):
+        self.store = store
+        self.project = store.name
+        self.name = 'offline-inference-benchmark'
+        self.artifact_path = os.path.join(store.root, 'artifacts')
+        self.logger = logging.getLogger('offline-inference-benchmark')
+
+    def get_param(self, key: str, default=None):
+        return default
+
+    def log_result(self, key: str, value: Any):
+        self.store.results[key] = value
+
+    def log_results(self, results: Dict[str, Any]):
+        self.store.results.update(results)
+
+    def log_dataset(self, key: str, df=None, local_path: Optional[str] = None, format: Optional[str] = None,
+                    **kwargs):
+        self.store.log_file(key, local_path=local_path)
+
+    def log_artifact(self, key: str, local_path: Optional[str] = None, body: Optional[str] = None,
+                     format: Optional[str] = None, **kwargs):
+        self.store.log_file(key, local_path=local_path, body=body)
+
+
+def make_prompts(num_prompts: int) -> List[str]:
+    """
+    Build deterministic prompts of a few varying lengths.
+
+    :param num_prompts: The number of prompts.
+    :return: The prompts.
+    """
+    return [f'question {index}: ' + 'word ' * (4 + index % 13) for index in range(num_prompts)]
+
+
+def run_benchmark(
+    num_prompts: int,
+    chunk_size: Optional[int] = DEFAULT_CHUNK_SIZE,
+    per_token_latency: float = 0.0,
+    output_tokens: int = 16
+) -> Dict[str, Any]:
+    """
+    Run offline_inference_handler once on the fake engine and artifact store.
+
+    :param num_prompts: The number of prompts.
+    :param chunk_size: The handler chunk size, None for the in-memory (non-streaming) mode.
+    :param per_token_latency: Seconds per decode step of the fake engine.
+    :param output_tokens: Tokens generated per request.
+    :return: The wall, engine and overhead seconds and the per-prompt overhead.
+    """
+    prompts = make_prompts(num_prompts)
+    root = tempfile.mkdtemp(prefix='vllm_benchmark_')
+    engines = []
+
+    def build_engine(**engine_args):
+        engines.append(FakeLLM(per_token_latency, output_tokens, **engine_args))
+        return engines[-1]
+
+    try:
+        store = FakeArtifactStore(root)
+        store.add_model('benchmark-model')
+        context = FakeContext(store)
+        VLLMModelServer._metadata_cache.invalidate()
+        with patch('functions.vllm_model_server.LLM', side_effect=build_engine), \
+                patch('functions.vllm_model_server.SamplingParams',
+                      side_effect=lambda **kwargs: SimpleNamespace(**kwargs)), \
+                patch('functions.vllm_model_server.RequestOutputKind', OUTPUT_KINDS), \
+                patch('functions.vllm_model_server.TOKENIZER_CACHE_DIR', os.path.join(root, 'tokenizers')), \
+                patch('functions.vllm_model_server.mlrun.get_or_create_project', return_value=store):
+            start = time.perf_counter()
+            offline_inference_handler(
+                context=context,
+                model_name='benchmark-model',
+                prompts=prompts,
+                sampling_params={'max_tokens': output_tokens, 'temperature': 0},
+                chunk_size=chunk_size,
+                log_outputs_result=chunk_size is None)
+            wall_seconds = time.perf_counter() - start
+        # the busy / idle time of the read, generate and write stages of chunked runs
+        stages = {
+            key: value for key, value in store.results.items()
+            if key.startswith('stage_') or key == 'pipeline_bottleneck'}
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+        VLLMModelServer._metadata_cache.invalidate()
+
+    engine_seconds = sum(engine.engine_seconds for engine in engines)
+    overhead_seconds = wall_seconds - engine_seconds
+    return {
+        'num_prompts': num_prompts,
+        'mode': 'chunked' if chunk_size else 'in_memory',
+        'chunk_size': chunk_size,
+        'per_token_latency': per_token_latency,
+        'output_tokens': output_tokens,
+        'num_generated': sum(engine.num_requests for engine in engines),
+        'wall_seconds': round(wall_seconds, 4),
+        'engine_seconds': round(engine_seconds, 4),
+        'overhead_seconds': round(overhead_seconds, 4),
+        'overhead_us_per_prompt': round(overhead_seconds / num_prompts * 1e6, 3),
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        **stages,
+    }
+
+
+def compare_generate_paths(
+    num_prompts: int,
+    output_tokens: int = 16,
+    per_token_latency: float = 0.0
+) -> Dict[str, Any]:
+    """
+    Time the instrumented engine loop of offline inference, _generate_timed, against
+    LLM.generate on the stepping fake engine, and the loop with cumulative outputs,
+    which rebuilds the output of every running request on each step.
+
+    :param num_prompts: The number of prompts.
+    :param output_tokens: Tokens generated per request, one per engine step.
+    :param per_token_latency: Seconds per engine step.
+    :return: The seconds of each path and the overhead of _generate_timed over LLM.generate.
+    """
+    prompts = make_prompts(num_prompts)
+    sampling_params = SimpleNamespace(max_tokens=output_tokens, temperature=0)
+
+    def timed(generate: Callable[[SteppingFakeLLM], List[SimpleNamespace]]) -> float:
+        llm = SteppingFakeLLM(per_token_latency, output_tokens)
+        start = time.perf_counter()
+        outputs = generate(llm)
+        assert len(outputs) == num_prompts and llm.num_requests == num_prompts
+        return time.perf_counter() - start
+
+    with patch('functions.vllm_model_server.RequestOutputKind', OUTPUT_KINDS):
+        generate_seconds = timed(lambda llm: llm.generate(prompts, sampling_params))
+        timed_seconds = timed(lambda llm: _generate_timed(llm, prompts, sampling_params))
+        # the loop as it was before the requests were added FINAL_ONLY
+        with patch('functions.vllm_model_server._final_only', side_effect=lambda params: params):
+            cumulative_seconds = timed(lambda llm: _generate_timed(llm, prompts, sampling_params))
+
+    return {
+        'num_prompts': num_prompts,
+        'output_tokens': output_tokens,
+        'llm_generate_seconds': round(generate_seconds, 4),
+        'generate_timed_seconds': round(timed_seconds, 4),
+        'generate_timed_cumulative_seconds': round(cumulative_seconds, 4),
+        'generate_timed_overhead': round(timed_seconds / generate_seconds - 1, 4),
+    }
+
+
+def compare(results: Dict[str, Dict[str, Any]], baselines: Dict[str, Dict[str, Any]],
+            tolerance: float) -> List[str]:
+    """
+    Compare the per-prompt overhead of the runs to their baselines.
+
+    :param results: The runs by name.
+    :param baselines: The baseline runs by name.
+    :param tolerance: The allowed relative increase of the per-prompt overhead.
+    :return: A description of every regression.
+    """
+    regressions = []
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        if baseline is None:
+            continue
+        limit = baseline['overhead_us_per_prompt'] * (1 + tolerance)
+        if result['overhead_us_per_prompt'] > limit:
+            regressions.append(
+                f"{name}: {result['overhead_us_per_prompt']} us/prompt, baseline "
+                f"{baseline['overhead_us_per_prompt']} us/prompt (limit {limit:.3f})")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Prompt counts to run.')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='Handler chunk size, 0 for the in-memory mode.')
+    parser.add_argument('--per-token-latency-ms', type=float, default=0.0,
+                        help='Fake engine latency per decode step.')
+    parser.add_argument('--output-tokens', type=int, default=16, help='Tokens generated per request.')
+    parser.add_argument('--save', action='store_true', help='Store the runs as the new baselines.')
+    parser.add_argument('--compare', action='store_true', help='Fail on a regression against the baselines.')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed relative increase of the per-prompt overhead.')
+    parser.add_argument('--generate-paths', action='store_true',
+                        help='Compare the instrumented engine loop with LLM.generate instead.')
+    args = parser.parse_args(argv)
+
+    if args.generate_paths:
+        for num_prompts in args.sizes:
+            result = compare_generate_paths(
+                num_prompts, output_tokens=args.output_tokens,
+                per_token_latency=args.per_token_latency_ms / 1000)
+            print(json.dumps({f'generate_paths_{num_prompts}': result}))
+        return 0
+
+    results = {}
+    for num_prompts in args.sizes:
+        result = run_benchmark(
+            num_prompts, chunk_size=args.chunk_size or None,
+            per_token_latency=args.per_token_latency_ms / 1000, output_tokens=args.output_tokens)
+        name = f"{result['mode']}_{num_prompts}"
+        results[name] = result
+        print(json.dumps({name: result}))
+
+    baselines = {}
+    if os.path.exists(BASELINES_PATH):
+        with open(BASELINES_PATH) as f:
+            baselines = json.load(f)
+
+    if args.save:
+        baselines.setdefault('runs', {}).update(results)
+        baselines['environment'] = {
+            'python': platform.python_version(), 'machine': platform.machine(),
+            'processor': platform.processor(), 'cpus': os.cpu_count()}
+        with open(BASELINES_PATH, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.compare:
+        regressions = compare(results, baselines.get('runs', {}), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,15 @@
 """
 Tests for VLLMModelServer class.
 """
+import json
+import multiprocessing
 import os
+import sqlite3
+import subprocess
 import sys
+import threading
+import time
+from types import SimpleNamespace
 from unittest.mock import MagicMock, Mock, patch
 
 import mlrun
@@ -10,9 +17,27 @@ import pytest
 
 # Add the src directory to the path so we can import our module
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
-from functions.vllm_model_server import VLLMModelServer
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from functions.vllm_model_server import (MODEL_MANIFEST_FILE, OUTPUT_SCHEMA, EngineWorkerPool, InferenceMetrics,
+                                         InferenceResultWriter, LocalArtifactCache, MetadataCache,
+                                         PipelinedExecutor, QueueFullError,
+                                         RequestMicroBatcher, ResponseCache, VLLMModelRouter, VLLMModelServer,
+                                         _copy_artifact_file, _fetch_files,
+                                         _iter_dataset_prompts, _outputs_to_table, _PendingRequest,
+                                         _prefix_sharing_ratio, _schedule_prompts, _select_model_files,
+                                         import_profile_report, offline_inference_handler, token_plan_handler)
 
 # region Unit Tests
+@pytest.fixture(autouse=True)
+def clear_metadata_cache():
+    """Drop the per-process metadata cache so lookups never leak between tests."""
+    VLLMModelServer._metadata_cache.invalidate()
+    yield
+    VLLMModelServer._metadata_cache.invalidate()
+
+
 class TestVLLMModelServer:
     """Test suite for VLLMModelServer class."""
 
@@ -22,6 +47,7 @@ class TestVLLMModelServer:
         context = Mock()
         context.name = "test_context"
         context.logger = Mock()
+        context.get_param.side_effect = lambda key, default=None: default
         return context
 
     @pytest.fixture
@@ -177,6 +203,1806 @@ class TestVLLMModelServer:
                 repo_id=sample_init_params['model_name'],
                 local_dir=sample_init_params['model_path']
             )
+
+    @pytest.fixture
+    def engine_server(self, sample_init_params):
+        """A server with the artifact lookup, tokenizer download and LLM patched out."""
+        server = VLLMModelServer(**sample_init_params, warmup_prompts=[])
+        model_artifact = Mock(uri='store://artifacts/test/test_vllm_server', target_path='s3://models/test')
+        with patch.object(VLLMModelServer, 'get_model_artifact', return_value=model_artifact), \
+                patch.object(VLLMModelServer, '_download_tokenizer', return_value='/tmp/tokenizer'), \
+                patch('functions.vllm_model_server.LLM') as mock_llm:
+            mock_llm.side_effect = lambda **kwargs: Mock(kwargs=kwargs)
+            yield server, mock_llm
+
+    def test_get_engine_reuses_warm_engine(self, engine_server):
+        """Test that the engine is built once and reused for the same key."""
+        server, mock_llm = engine_server
+
+        first = server._get_engine(max_model_len=4096)
+        assert server.engine_warm is False
+
+        second = server._get_engine(max_model_len=4096)
+        assert server.engine_warm is True
+        assert first is second
+        mock_llm.assert_called_once()
+
+    def test_get_engine_rebuilds_when_key_changes(self, engine_server):
+        """Test that a change in engine kwargs tears down and rebuilds the engine."""
+        server, mock_llm = engine_server
+
+        first = server._get_engine(max_model_len=4096)
+        second = server._get_engine(max_model_len=8192)
+
+        assert server.engine_warm is False
+        assert first is not second
+        assert second.kwargs['max_model_len'] == 8192
+        assert mock_llm.call_count == 2
+
+    def test_load_builds_engine_with_engine_kwargs(self, engine_server):
+        """Test that load() builds the engine with the configured engine kwargs."""
+        server, mock_llm = engine_server
+        server.engine_kwargs = {'max_model_len': 2048}
+
+        server.load()
+
+        assert server._llm.kwargs['max_model_len'] == 2048
+        assert server._llm.kwargs['load_format'] == 'runai_streamer'
+
+
+def _fake_output(prompt, text):
+    """Create an object shaped like a vllm RequestOutput."""
+    return SimpleNamespace(prompt=prompt, prompt_token_ids=list(range(len(prompt))), outputs=[SimpleNamespace(
+        text=text, token_ids=list(range(len(text))), finish_reason='stop')])
+
+
+class _FakeLLM:
+    """A picklable engine stepping requests like vllm's LLMEngine, recording each generated batch."""
+
+    def __init__(self, transform=str.upper):
+        self.transform = transform
+        self.batches = []
+        self.params = []
+        self._pending = []
+
+    @property
+    def llm_engine(self):
+        return self
+
+    def get_tokenizer(self):
+        return lambda prompts, add_special_tokens: {'input_ids': [[0] * len(prompt) for prompt in prompts]}
+
+    def add_request(self, request_id, prompt, params):
+        self.params.append(params)
+        self._pending.append((request_id, prompt))
+
+    def has_unfinished_requests(self):
+        return bool(self._pending)
+
+    def step(self):
+        pending, self._pending = self._pending, []
+        self.batches.append([prompt for _, prompt in pending])
+        outputs = []
+        for request_id, prompt in pending:
+            output = _fake_output(prompt, self.transform(prompt))
+            output.request_id, output.finished = request_id, True
+            outputs.append(output)
+        return outputs
+
+
+@pytest.fixture
+def fake_sampling_params():
+    """Build sampling parameters without vllm installed."""
+    with patch('functions.vllm_model_server.SamplingParams',
+               side_effect=lambda **kwargs: SimpleNamespace(**kwargs)) as sampling_params, \
+            patch('functions.vllm_model_server.RequestOutputKind',
+                  SimpleNamespace(CUMULATIVE='cumulative', DELTA='delta', FINAL_ONLY='final_only')):
+        yield sampling_params
+
+
+def _logged_results(context):
+    """Merge the results logged with context.log_results."""
+    results = {}
+    for call in context.log_results.call_args_list:
+        results.update(call.args[0])
+    return results
+
+
+class TestPipelinedStoreModel:
+    """Test suite for the pipelined download and upload of store_model."""
+
+    def test_transfer_uploads_and_deletes_every_file(self, tmp_path):
+        """Test that every file is uploaded and deleted, keeping local disk bounded."""
+        server = VLLMModelServer(context=Mock(), name='m', model_path=str(tmp_path / 'm'), model_name='org/m')
+        files = {f'model-{i}.safetensors': 100 for i in range(6)}
+        uploaded = []
+
+        def download(repo_id, filename, local_dir):
+            os.makedirs(local_dir, exist_ok=True)
+            path = os.path.join(local_dir, filename)
+            with open(path, 'wb') as f:
+                f.write(b'x' * files[filename])
+            return path
+
+        def get_dataitem(url):
+            data_item = Mock()
+            data_item.upload.side_effect = lambda local_file: uploaded.append(url)
+            return data_item
+
+        with patch('functions.vllm_model_server.hf_hub_download', side_effect=download), \
+                patch('functions.vllm_model_server.mlrun.get_dataitem', side_effect=get_dataitem):
+            stats = server._transfer_pipelined(files, 's3://bucket/models/m/', max_concurrent_uploads=2)
+
+        assert sorted(uploaded) == sorted(f's3://bucket/models/m/{name}' for name in files)
+        assert stats['bytes'] == 600
+        assert stats['peak_local_bytes'] <= 200
+        assert os.listdir(tmp_path / 'm') == []
+
+    def test_failed_upload_stops_the_transfer(self, tmp_path):
+        """Test that the first failed upload stops the remaining downloads."""
+        server = VLLMModelServer(context=Mock(), name='m', model_path=str(tmp_path / 'm'), model_name='org/m')
+        files = {f'model-{i}.safetensors': 100 for i in range(20)}
+        downloaded = []
+
+        def download(repo_id, filename, local_dir):
+            os.makedirs(local_dir, exist_ok=True)
+            downloaded.append(filename)
+            path = os.path.join(local_dir, filename)
+            with open(path, 'wb') as f:
+                f.write(b'x' * files[filename])
+            return path
+
+        def get_dataitem(url):
+            data_item = Mock()
+            data_item.upload.side_effect = OSError('access denied')
+            return data_item
+
+        with patch('functions.vllm_model_server.hf_hub_download', side_effect=download), \
+                patch('functions.vllm_model_server.mlrun.get_dataitem', side_effect=get_dataitem), \
+                pytest.raises(OSError, match='access denied'):
+            server._transfer_pipelined(files, 's3://bucket/models/m/', max_concurrent_uploads=2)
+
+        # the downloads stop once a slot is released by the failed upload
+        assert len(downloaded) <= 2
+
+    def test_incremental_transfers_only_changed_files(self, tmp_path):
+        """Test that an incremental store transfers changed files into a new version and copies the rest."""
+        context = Mock(project='test-project')
+        server = VLLMModelServer(context=context, name='m', model_path=str(tmp_path / 'm'), model_name='org/m')
+        previous_manifest = {
+            'config.json': {'size': 10, 'hash': 'git:a'},
+            'tokenizer_config.json': {'size': 20, 'hash': 'git:b'},
+            'model.safetensors': {'size': 1000, 'hash': 'sha256:c'},
+            'old.safetensors': {'size': 500, 'hash': 'sha256:d'},
+        }
+        repo_manifest = {
+            'config.json': {'size': 10, 'hash': 'git:a'},
+            'tokenizer_config.json': {'size': 25, 'hash': 'git:e'},
+            'model.safetensors': {'size': 1000, 'hash': 'sha256:c'},
+        }
+        project = Mock(artifact_path='s3://bucket/models/', name='test-project')
+        project.get_artifact.return_value = Mock(target_path='s3://bucket/models/m/')
+        data_items = {}
+
+        order = []
+        project.log_artifact.side_effect = lambda **kwargs: order.append('log_artifact') or Mock(uri='store://m')
+
+        def get_dataitem(url):
+            data_item = data_items.setdefault(url, Mock())
+            data_item.delete.side_effect = lambda: order.append('delete')
+            if url.endswith('model_manifest.json'):
+                data_item.get.return_value = json.dumps(previous_manifest)
+            return data_item
+
+        with patch('functions.vllm_model_server.mlrun.get_or_create_project', return_value=project), \
+                patch('functions.vllm_model_server.mlrun.get_dataitem', side_effect=get_dataitem), \
+                patch('functions.vllm_model_server._copy_artifact_file') as copy_file, \
+                patch.object(VLLMModelServer, '_list_repo_manifest', return_value=repo_manifest), \
+                patch.object(VLLMModelServer, '_transfer_pipelined',
+                             return_value={'bytes': 25, 'seconds': 1.0, 'peak_local_bytes': 25}) as transfer:
+            server.store_model(incremental=True)
+
+        files, target_path, _ = transfer.call_args.args
+        assert files == {'tokenizer_config.json': 25}
+        assert target_path.startswith('s3://bucket/models/m/') and target_path != 's3://bucket/models/m/'
+        assert sorted(call.args for call in copy_file.call_args_list) == [
+            (f's3://bucket/models/m/{name}', f'{target_path}{name}') for name in ('config.json', 'model.safetensors')]
+        # the previous version is neither written to nor deleted from
+        assert 'delete' not in order
+        assert not any(url.startswith('s3://bucket/models/m/') and data_item.put.called
+                       and not url.startswith(target_path) for url, data_item in data_items.items())
+        written = json.loads(data_items[f'{target_path}model_manifest.json'].put.call_args.args[0])
+        assert written == repo_manifest
+        assert project.log_artifact.call_args.kwargs['target_path'] == target_path
+
+    def test_copy_artifact_file_within_store(self, tmp_path):
+        """Test that a file is copied within the artifact store."""
+        (tmp_path / 'v1').mkdir()
+        (tmp_path / 'v1' / 'model.safetensors').write_bytes(b'weights')
+
+        _copy_artifact_file(str(tmp_path / 'v1' / 'model.safetensors'), str(tmp_path / 'v2' / 'model.safetensors'))
+
+        assert (tmp_path / 'v2' / 'model.safetensors').read_bytes() == b'weights'
+        assert (tmp_path / 'v1' / 'model.safetensors').exists()
+
+    def test_failed_incremental_transfer_keeps_previous_version(self, tmp_path):
+        """Test that a failed transfer neither deletes files nor rewrites the manifest."""
+        context = Mock(project='test-project')
+        server = VLLMModelServer(context=context, name='m', model_path=str(tmp_path / 'm'), model_name='org/m')
+        previous_manifest = {
+            'model.safetensors': {'size': 1000, 'hash': 'sha256:c'},
+            'old.safetensors': {'size': 500, 'hash': 'sha256:d'},
+        }
+        project = Mock(artifact_path='s3://bucket/models/', name='test-project')
+        project.get_artifact.return_value = Mock(target_path='s3://bucket/models/m/')
+        data_items = {}
+
+        def get_dataitem(url):
+            data_item = data_items.setdefault(url, Mock())
+            if url.endswith('model_manifest.json'):
+                data_item.get.return_value = json.dumps(previous_manifest)
+            return data_item
+
+        with patch('functions.vllm_model_server.mlrun.get_or_create_project', return_value=project), \
+                patch('functions.vllm_model_server.mlrun.get_dataitem', side_effect=get_dataitem), \
+                patch.object(VLLMModelServer, '_list_repo_manifest',
+                             return_value={'model.safetensors': {'size': 1000, 'hash': 'sha256:e'}}), \
+                patch.object(VLLMModelServer, '_transfer_pipelined', side_effect=RuntimeError('network')):
+            with pytest.raises(RuntimeError):
+                server.store_model(incremental=True)
+
+        assert 's3://bucket/models/m/old.safetensors' not in data_items
+        data_items['s3://bucket/models/m/model_manifest.json'].put.assert_not_called()
+        project.log_artifact.assert_not_called()
+
+
+class TestSelectModelFiles:
+    """Test suite for the weight format policy of store_model."""
+
+    @pytest.fixture
+    def repo_files(self):
+        """Files of a repository publishing several weight formats."""
+        return {
+            'config.json': 1,
+            'generation_config.json': 1,
+            'tokenizer.json': 10,
+            'tokenizer_config.json': 1,
+            'tokenizer.model': 5,
+            'model-00001-of-00002.safetensors': 1000,
+            'model-00002-of-00002.safetensors': 1000,
+            'model.safetensors.index.json': 2,
+            'pytorch_model.bin': 2000,
+            'pytorch_model.bin.index.json': 2,
+            'model.gguf': 1500,
+            'onnx/model.onnx': 2000,
+            'onnx/config.json': 1,
+            'README.md': 3,
+        }
+
+    def test_safetensors_only(self, repo_files):
+        """Test that only safetensors weights and the support files are selected."""
+        selected = _select_model_files(repo_files, 'safetensors')
+
+        assert set(selected) == {
+            'config.json', 'generation_config.json', 'tokenizer.json', 'tokenizer_config.json',
+            'tokenizer.model', 'model-00001-of-00002.safetensors', 'model-00002-of-00002.safetensors',
+            'model.safetensors.index.json',
+        }
+
+    def test_auto_prefers_safetensors(self, repo_files):
+        """Test that auto picks safetensors when the repository has them."""
+        assert _select_model_files(repo_files, 'auto') == _select_model_files(repo_files, 'safetensors')
+
+    def test_auto_falls_back_to_bin(self, repo_files):
+        """Test that auto picks bin weights when there are no safetensors."""
+        files = {name: size for name, size in repo_files.items() if 'safetensors' not in name}
+
+        selected = _select_model_files(files, 'auto')
+
+        assert 'pytorch_model.bin' in selected
+        assert 'pytorch_model.bin.index.json' in selected
+        assert 'model.gguf' not in selected
+
+    def test_unknown_format_is_rejected(self, repo_files):
+        """Test that an unsupported weight format is rejected."""
+        with pytest.raises(ValueError):
+            _select_model_files(repo_files, 'gguf')
+
+
+class TestRequestMicroBatcher:
+    """Test suite for the real-time serving micro-batcher."""
+
+    def test_concurrent_requests_share_a_batch(self):
+        """Test that concurrent requests are dispatched as one generate call."""
+        batches = []
+
+        def run_batch(prompts, sampling_params):
+            batches.append(list(prompts))
+            return [_fake_output(prompt, prompt.upper()) for prompt in prompts]
+
+        batcher = RequestMicroBatcher(run_batch, max_batch_size=8, max_wait_ms=200)
+        pending = [batcher.submit(f'p{i}', None) for i in range(3)]
+        results = [request.future.result(timeout=5) for request in pending]
+
+        assert batches == [['p0', 'p1', 'p2']]
+        assert [result['output'].outputs[0].text for result in results] == ['P0', 'P1', 'P2']
+        assert all(result['batch_size'] == 3 for result in results)
+        assert all(result['queue_wait_ms'] >= 0 for result in results)
+
+    def test_batch_size_is_bounded(self):
+        """Test that a batch never exceeds max_batch_size."""
+        release = threading.Event()
+        batches = []
+
+        def run_batch(prompts, sampling_params):
+            release.wait(timeout=5)
+            batches.append(len(prompts))
+            return [_fake_output(prompt, prompt) for prompt in prompts]
+
+        batcher = RequestMicroBatcher(run_batch, max_batch_size=2, max_wait_ms=50)
+        pending = [batcher.submit(f'p{i}', None) for i in range(5)]
+        release.set()
+        for request in pending:
+            request.future.result(timeout=5)
+
+        assert max(batches) <= 2
+        assert sum(batches) == 5
+
+    def test_errors_reach_every_caller(self):
+        """Test that a failing batch fails the future of every request in it."""
+        batcher = RequestMicroBatcher(Mock(side_effect=RuntimeError('engine died')), max_wait_ms=1)
+
+        with pytest.raises(RuntimeError):
+            batcher.submit('p', None).future.result(timeout=5)
+
+    def test_short_or_invalid_results_fail_the_batch(self):
+        """Test that a batch with missing outputs fails its requests and later batches still run."""
+        results = iter([
+            lambda prompts: [_fake_output(prompts[0], 'only one')],
+            lambda prompts: None,
+            lambda prompts: [_fake_output(prompt, prompt) for prompt in prompts],
+        ])
+        batcher = RequestMicroBatcher(
+            lambda prompts, sampling_params: next(results)(prompts), max_batch_size=2, max_wait_ms=200)
+
+        first = [batcher.submit(f'p{i}', None) for i in range(2)]
+        for request in first:
+            with pytest.raises(RuntimeError, match='outputs'):
+                request.future.result(timeout=5)
+        with pytest.raises(TypeError):
+            batcher.submit('q', None).future.result(timeout=5)
+
+        assert batcher.submit('r', None).future.result(timeout=5)['output'].prompt == 'r'
+
+    def test_close_dispatches_queued_requests_and_stops(self):
+        """Test that closing the batcher lets the queued requests finish and stops the dispatch thread."""
+        batcher = RequestMicroBatcher(
+            lambda prompts, sampling_params: [_fake_output(prompt, prompt) for prompt in prompts],
+            max_wait_ms=100)
+        pending = batcher.submit('p', None)
+
+        batcher.close()
+
+        assert pending.future.result(timeout=5)['output'].prompt == 'p'
+        batcher._thread.join(timeout=5)
+        assert not batcher._thread.is_alive()
+        with pytest.raises(RuntimeError, match='closed'):
+            batcher.submit('q', None)
+
+    def test_batch_slots_follow_priority_weights(self):
+        """Test that the slots of a batch are shared between the waiting classes by weight."""
+        batcher = RequestMicroBatcher(lambda prompts, sampling_params: [], max_batch_size=8,
+                                      priority_weights={'interactive': 3, 'bulk': 1})
+        for priority in ['bulk', 'interactive']:
+            batcher._queues[priority].extend(
+                _PendingRequest(f'{priority} {index}', None, 0, priority=priority) for index in range(8))
+
+        batch = batcher._next_batch()
+
+        assert [request.priority for request in batch].count('interactive') == 6
+        assert [request.prompt for request in batch if request.priority == 'bulk'] == ['bulk 0', 'bulk 1']
+        assert sum(batcher.stats()['bulk']['wait_ms_histogram'].values()) == 2
+
+    def test_full_queue_rejects_with_retry_after(self):
+        """Test that a full priority queue rejects a request at once and other classes still queue."""
+        started, release = threading.Event(), threading.Event()
+
+        def run_batch(prompts, sampling_params):
+            started.set()
+            release.wait(timeout=5)
+            return [_fake_output(prompt, prompt) for prompt in prompts]
+
+        batcher = RequestMicroBatcher(run_batch, max_batch_size=1, max_wait_ms=0, max_queue_size=2,
+                                      priority_weights={'interactive': 4, 'bulk': 1}, default_priority='bulk')
+        first = batcher.submit('a', None)
+        assert started.wait(timeout=5)
+        queued = batcher.submit_many(['b', 'c'], None)
+
+        with pytest.raises(QueueFullError) as error:
+            batcher.submit('d', None)
+        interactive = batcher.submit('e', None, priority='interactive')
+        release.set()
+
+        assert error.value.priority == 'bulk' and error.value.retry_after >= 1
+        assert all(request.future.result(timeout=5) for request in [first, *queued, interactive])
+        stats = batcher.stats()
+        assert (stats['bulk']['submitted'], stats['bulk']['rejected']) == (3, 1)
+        assert stats['interactive']['submitted'] == 1
+
+    def test_server_answers_full_queue_with_429(self, mock_mlrun_context):
+        """Test that the serving path turns a full queue into a 429 response with Retry-After."""
+        mock_mlrun_context.get_param.side_effect = lambda key, default=None: default
+        mock_mlrun_context.Response.side_effect = lambda **kwargs: SimpleNamespace(**kwargs)
+        server = VLLMModelServer(context=mock_mlrun_context, name='s', model_path='/p', model_name='m')
+
+        with patch('mlrun.serving.v2_serving.V2ModelServer.do_event',
+                   side_effect=QueueFullError('bulk', 3)):
+            event = server.do_event(SimpleNamespace(body={'inputs': ['p'], 'priority': 'bulk'}, path='/infer'))
+
+        assert event.body.status_code == 429
+        assert event.body.headers == {'Retry-After': '3'}
+        assert json.loads(event.body.body)['priority'] == 'bulk'
+
+    @pytest.mark.usefixtures('fake_sampling_params')
+    def test_predict_returns_result_per_prompt(self, mock_mlrun_context):
+        """Test that predict returns the text and batching stats of every prompt."""
+        mock_mlrun_context.get_param.side_effect = lambda key, default=None: default
+        server = VLLMModelServer(context=mock_mlrun_context, name='s', model_path='/p', model_name='m',
+                                 warmup_prompts=[])
+        llm = Mock()
+        llm.generate.side_effect = lambda prompts, sampling_params, use_tqdm: [
+            _fake_output(prompt, prompt[::-1]) for prompt in prompts]
+
+        with patch.object(VLLMModelServer, '_get_engine', return_value=llm):
+            server.load()
+            results = server.predict({'inputs': ['abc', 'de'], 'sampling_params': {'max_tokens': 4}})
+
+        assert [result['text'] for result in results] == ['cba', 'ed']
+        assert {'queue_depth', 'batch_size', 'queue_wait_ms', 'priority'} <= set(results[0])
+
+    @pytest.mark.usefixtures('fake_sampling_params')
+    def test_stream_yields_deltas_and_latency(self, mock_mlrun_context):
+        """Test that stream() yields text deltas and a final event with latency stats."""
+        mock_mlrun_context.get_param.side_effect = lambda key, default=None: default
+        server = VLLMModelServer(context=mock_mlrun_context, name='s', model_path='/p', model_name='m',
+                                 warmup_prompts=[])
+        steps = {}
+        engine = Mock()
+
+        def add_request(request_id, prompt, params):
+            steps[request_id] = [prompt[:n] for n in range(1, len(prompt) + 1)]
+
+        def step():
+            outputs = []
+            for request_id, texts in list(steps.items()):
+                text = texts.pop(0)
+                outputs.append(SimpleNamespace(
+                    request_id=request_id,
+                    outputs=[SimpleNamespace(text=text, finish_reason=None if texts else 'stop')]))
+                if not texts:
+                    del steps[request_id]
+            return outputs
+
+        engine.add_request.side_effect = add_request
+        engine.step.side_effect = step
+        engine.has_unfinished_requests.side_effect = lambda: bool(steps)
+        llm = Mock(llm_engine=engine)
+
+        with patch.object(VLLMModelServer, '_get_engine', return_value=llm):
+            events = list(server.stream({'inputs': ['abc', 'xy']}))
+
+        deltas = [event['delta'] for event in events if 'delta' in event]
+        finals = [event for event in events if 'finish_reason' in event]
+        assert deltas == ['a', 'b', 'c', 'x', 'y']
+        assert [final['finish_reason'] for final in finals] == ['stop', 'stop']
+        assert finals[0]['server_ttft_ms'] >= 0
+        assert finals[0]['server_mean_itl_ms'] is not None
+
+    def test_op_events_returns_event_transcript(self, mock_mlrun_context):
+        """Test that the events operation returns the buffered stream events as JSON."""
+        server = VLLMModelServer(context=mock_mlrun_context, name='s', model_path='/p', model_name='m')
+        server.ready = True
+        mock_mlrun_context.Response.side_effect = lambda **kwargs: SimpleNamespace(**kwargs)
+
+        with patch.object(VLLMModelServer, 'stream', return_value=iter([{'index': 0, 'delta': 'hi'}])):
+            response = server.op_events(SimpleNamespace(body={'inputs': ['p']}))
+
+        assert response.content_type == 'application/json'
+        assert json.loads(response.body) == {'events': [{'index': 0, 'delta': 'hi'}]}
+
+
+class TestWarmUp:
+    """Test suite for the background warm-up and readiness gating of the serving path."""
+
+    @pytest.fixture
+    def server(self, mock_mlrun_context):
+        """A server whose engine reverses the prompts."""
+        mock_mlrun_context.get_param.side_effect = lambda key, default=None: default
+        mock_mlrun_context.Response.side_effect = lambda **kwargs: SimpleNamespace(**kwargs)
+        server = VLLMModelServer(context=mock_mlrun_context, name='s', model_path='/p', model_name='m',
+                                 warmup_prompts=['a', 'bc'], max_batch_size=4)
+        llm = Mock()
+        llm.generate.side_effect = lambda prompts, sampling_params, use_tqdm: [
+            _fake_output(prompt, prompt[::-1]) for prompt in prompts]
+        with patch.object(VLLMModelServer, '_get_engine', return_value=llm), \
+                patch('functions.vllm_model_server.SamplingParams', side_effect=lambda **kwargs: kwargs):
+            yield server, llm
+
+    def test_load_runs_warmup_prompts(self, server):
+        """Test that load() runs a single request and a full batch before it returns."""
+        server, llm = server
+
+        server.load()
+
+        prompts = [call.args[0] for call in llm.generate.call_args_list]
+        assert prompts[0] == ['a']
+        assert sum(len(batch) for batch in prompts[1:]) == 4
+        assert server.warmup_stats['num_prompts'] == 5
+        assert server.warmup_stats['first_request_ms'] >= 0
+        assert 'warmup_total_seconds' in server.metrics
+
+    def test_load_is_idempotent(self, server):
+        """Test that a request racing the background load does not warm up twice."""
+        server, llm = server
+
+        server.load()
+        calls = llm.generate.call_count
+        server.load()
+
+        assert llm.generate.call_count == calls
+
+    def test_op_warmup_reports_readiness(self, server):
+        """Test that the warmup operation returns 503 until the server is warm."""
+        server, _ = server
+
+        assert server.op_warmup(SimpleNamespace(body=None)).status_code == 503
+
+        server._load_and_update_state()
+
+        response = server.op_warmup(SimpleNamespace(body=None))
+        assert response.status_code == 200
+        assert json.loads(response.body)['num_prompts'] == 5
+
+    def test_op_events_rejects_cold_server(self, server):
+        """Test that event transcripts are rejected with a retry hint before the server is warm."""
+        server, _ = server
+
+        response = server.op_events(SimpleNamespace(body={'inputs': ['p']}))
+
+        assert response.status_code == 503
+        assert 'Retry-After' in response.headers
+
+    @pytest.mark.parametrize('background, expected_mode', [(True, 'async'), (False, 'sync')])
+    def test_post_init_loads_in_background(self, mock_mlrun_context, background, expected_mode):
+        """Test that post_init loads in a background thread unless background warm-up is disabled."""
+        mock_mlrun_context.get_param.side_effect = lambda key, default=None: default
+        server = VLLMModelServer(context=mock_mlrun_context, name='s', model_path='/p', model_name='m',
+                                 background_warmup=background)
+
+        with patch('mlrun.serving.v2_serving.V2ModelServer.post_init') as parent_post_init:
+            server.post_init(mode='sync')
+
+        assert parent_post_init.call_args.kwargs['mode'] == expected_mode
+
+
+class _FakeRoute:
+    """A serving graph route step holding a model server that loads and unloads on request."""
+
+    def __init__(self, name, memory_gb):
+        self.class_args = {}
+        self.async_object = Mock(ready=False)
+        self.async_object.engine_memory_bytes.return_value = int(memory_gb * 1024 ** 3)
+        self.async_object.load.side_effect = lambda: setattr(self.async_object, 'loaded', True)
+        self.async_object.unload.side_effect = lambda: setattr(self.async_object, 'ready', False)
+        self.name = name
+
+    def run(self, event):
+        return SimpleNamespace(body={'model': self.name, 'ready': self.async_object.ready})
+
+
+class TestModelRouter:
+    """Test suite for the multi-model router and its memory-budgeted engine pool."""
+
+    @staticmethod
+    def _infer(router, model):
+        event = SimpleNamespace(body={'inputs': ['p']}, path=f'/v2/models/{model}/infer', method='POST')
+        return router._handle_event(event).body
+
+    @pytest.fixture
+    def router(self, mock_mlrun_context):
+        """A router over models of 6, 4, 12 and 4 GB with a 10 GB budget."""
+        routes = {name: _FakeRoute(name, memory_gb) for name, memory_gb in
+                  [('a', 6), ('b', 4), ('c', 12), ('d', 4)]}
+        return VLLMModelRouter(context=mock_mlrun_context, name='router', routes=routes, memory_budget_gb=10)
+
+    def test_routes_defer_loading_to_the_router(self, router):
+        """Test that the routes are configured to load on their first request."""
+        assert all(route.class_args['load_on_demand'] for route in router.routes.values())
+
+    def test_models_load_on_demand_and_count_hits(self, router):
+        """Test that a model is loaded on its first request and hit afterwards."""
+        assert self._infer(router, 'a') == {'model': 'a', 'ready': True}
+        self._infer(router, 'a')
+
+        stats = router.engine_pool_stats()
+        assert (stats['loads'], stats['hits'], stats['evictions']) == (1, 1, 0)
+        assert stats['loaded_models'] == ['a']
+        router.routes['a'].async_object.load.assert_called_once()
+
+    def test_least_recently_used_model_is_evicted(self, router):
+        """Test that loading a model beyond the budget unloads the least recently used engine."""
+        for model in ['a', 'b', 'a', 'd']:
+            self._infer(router, model)
+
+        router.routes['b'].async_object.unload.assert_called_once()
+        router.routes['a'].async_object.unload.assert_not_called()
+        stats = router.engine_pool_stats()
+        assert stats['loaded_models'] == ['a', 'd']
+        assert stats['models']['b']['evictions'] == 1 and stats['memory_used_bytes'] == 10 * 1024 ** 3
+
+    def test_model_over_budget_is_refused(self, router):
+        """Test that a model larger than the whole budget is refused without evicting the loaded ones."""
+        self._infer(router, 'a')
+
+        with pytest.raises(ValueError, match='memory budget'):
+            self._infer(router, 'c')
+
+        assert router.engine_pool_stats()['loaded_models'] == ['a']
+        router.routes['a'].async_object.unload.assert_not_called()
+
+    def test_model_list_reports_the_pool(self, router):
+        """Test that the model list and the router metadata include the engine pool stats."""
+        self._infer(router, 'b')
+
+        body = router._handle_event(SimpleNamespace(body=None, path='/v2/models/', method='GET')).body
+
+        assert body['models'] == ['a', 'b', 'c', 'd']
+        assert body['engine_pool']['memory_used_bytes'] == 4 * 1024 ** 3
+        assert router.get_metadata()['engine_pool']['loads'] == 1
+
+    @pytest.mark.parametrize('path, body, method', [
+        ('/v2/models/a', {'inputs': ['p']}, 'POST'),
+        ('/v2/models/a', {'inputs': ['p'], 'operation': 'infer'}, 'POST'),
+        ('/v2/models/a/generate', {'inputs': ['p']}, 'POST'),
+    ])
+    def test_inference_without_infer_suffix_loads(self, router, path, body, method):
+        """Test that a request resolved to an engine operation loads the model, like do_event resolves it."""
+        router._handle_event(SimpleNamespace(body=body, path=path, method=method))
+
+        router.routes['a'].async_object.load.assert_called_once()
+        assert router.engine_pool_stats()['loaded_models'] == ['a']
+
+    @pytest.mark.parametrize('path, method', [
+        ('/v2/models/a', 'GET'),
+        ('/v2/models/a/ready', 'GET'),
+        ('/v2/models/a/warmup', 'POST'),
+    ])
+    def test_passive_operations_do_not_load(self, router, path, method):
+        """Test that the model metadata, readiness and warm-up requests leave the engine unloaded."""
+        router._handle_event(SimpleNamespace(body=None, path=path, method=method))
+
+        router.routes['a'].async_object.load.assert_not_called()
+        assert router.engine_pool_stats()['loaded_models'] == []
+
+    def test_server_skips_load_on_demand(self, mock_mlrun_context):
+        """Test that a route loaded by the router runs post_init without loading its engine."""
+        mock_mlrun_context.get_param.side_effect = lambda key, default=None: default
+        server = VLLMModelServer(context=mock_mlrun_context, name='s', model_path='/p', model_name='m',
+                                 load_on_demand=True)
+
+        with patch.object(VLLMModelServer, 'load') as load, \
+                patch.object(VLLMModelServer, '_initialize_model_logger') as initialize_model_logger:
+            server.post_init(mode='sync', endpoint_type=mlrun.common.schemas.EndpointType.NODE_EP)
+
+        load.assert_not_called()
+        initialize_model_logger.assert_called_once()
+        assert not server.ready
+
+
+class TestStreamingInference:
+    """Test suite for the chunked, streaming offline inference mode."""
+
+    def test_writer_appends_parquet_chunks(self, tmp_path):
+        """Test that the writer appends every chunk to one Parquet file."""
+        writer = InferenceResultWriter(path=str(tmp_path / 'out.parquet'))
+        writer.write([{'prompt': 'a', 'response': '1'}])
+        writer.write([{'prompt': 'b', 'response': '2'}, {'prompt': 'c', 'response': ''}])
+        writer.close()
+
+        table = pq.read_table(writer.path)
+        assert writer.num_rows == 3
+        assert table.column('prompt').to_pylist() == ['a', 'b', 'c']
+
+    def test_writer_appends_jsonl_chunks(self, tmp_path):
+        """Test that the writer appends every chunk to one JSONL file."""
+        writer = InferenceResultWriter(path=str(tmp_path / 'out.jsonl'), output_format='jsonl')
+        writer.write([{'prompt': 'a', 'response': '1'}])
+        writer.write([{'prompt': 'b', 'response': '2'}])
+        writer.close()
+
+        with open(writer.path) as f:
+            assert len(f.readlines()) == 2
+
+    def test_outputs_to_table_enriches_rows(self):
+        """Test that the output table keeps finish reasons, token counts, timings and extra samples."""
+        output = _fake_output('hello', 'abc')
+        output.outputs.append(SimpleNamespace(text='de', token_ids=[1, 2], finish_reason='length'))
+        output.metrics = SimpleNamespace(arrival_time=1.0, first_token_time=1.1, finished_time=1.5)
+
+        table = _outputs_to_table([output, _fake_output('x', '')])
+
+        assert table.schema == OUTPUT_SCHEMA
+        rows = table.to_pylist()
+        assert rows[0]['finish_reason'] == 'stop'
+        assert (rows[0]['prompt_tokens'], rows[0]['generated_tokens']) == (5, 3)
+        assert rows[0]['latency_ms'] == pytest.approx(500.0)
+        assert rows[0]['samples'] == [{'text': 'de', 'finish_reason': 'length', 'generated_tokens': 2}]
+        assert rows[1]['latency_ms'] is None and rows[1]['samples'] == []
+
+    def test_writer_compresses_parquet(self, tmp_path):
+        """Test that enriched tables are written as compressed Parquet."""
+        writer = InferenceResultWriter(path=str(tmp_path / 'out.parquet'))
+        writer.write(_outputs_to_table([_fake_output('a', '1')]))
+        writer.close()
+
+        metadata = pq.ParquetFile(writer.path).metadata
+        assert metadata.row_group(0).column(0).compression == 'ZSTD'
+        assert pq.read_table(writer.path, columns=['generated_tokens']).column(0).to_pylist() == [1]
+
+    def test_writer_rejects_unknown_format(self, tmp_path):
+        """Test that an unsupported output format is rejected."""
+        with pytest.raises(ValueError):
+            InferenceResultWriter(path=str(tmp_path / 'out.csv'), output_format='csv')
+
+    def test_handler_streams_chunks_to_dataset(self, mock_mlrun_context):
+        """Test that the handler runs chunks and logs only summary counters."""
+        prompts = [f'prompt {i}' for i in range(5)]
+        logged = {}
+
+        def log_dataset(key, df, local_path, format):
+            logged['table'] = pq.read_table(local_path)
+
+        mock_mlrun_context.log_dataset.side_effect = log_dataset
+
+        def offline_inference(self, prompts, sampling_params, **kwargs):
+            return [_fake_output(prompt, prompt.upper()) for prompt in prompts]
+
+        with patch.object(VLLMModelServer, 'offline_inference', offline_inference):
+            offline_inference_handler(
+                context=mock_mlrun_context,
+                model_name='test_model',
+                prompts=prompts,
+                sampling_params={'temperature': 0},
+                chunk_size=2)
+
+        assert logged['table'].num_rows == 5
+        results = _logged_results(mock_mlrun_context)
+        assert results['num_chunks'] == 3
+        assert results['num_responses'] == 5
+        assert results['stage_generate_items'] == results['stage_write_items'] == 3
+        assert results['pipeline_bottleneck'] in ('prefetch', 'generate', 'write')
+        mock_mlrun_context.log_result.assert_not_called()
+
+    @pytest.mark.parametrize('log_outputs_result', [True, False])
+    def test_outputs_result_is_optional(self, mock_mlrun_context, log_outputs_result):
+        """Test that the legacy outputs run result can be turned off, keeping the outputs_table dataset."""
+        def offline_inference(self, prompts, sampling_params, **kwargs):
+            return [_fake_output(prompt, prompt.upper()) for prompt in prompts]
+
+        with patch.object(VLLMModelServer, 'offline_inference', offline_inference):
+            offline_inference_handler(
+                context=mock_mlrun_context,
+                model_name='test_model',
+                prompts=['a', 'b'],
+                log_outputs_result=log_outputs_result)
+
+        result_keys = [call.kwargs['key'] for call in mock_mlrun_context.log_result.call_args_list]
+        assert ('outputs' in result_keys) == log_outputs_result
+        assert mock_mlrun_context.log_dataset.call_args.kwargs['key'] == 'outputs_table'
+
+    def test_handler_logs_jsonl_as_plain_artifact(self, mock_mlrun_context):
+        """Test that JSONL results are not logged as a dataset, which does not support JSONL."""
+        logged = {}
+
+        def log_artifact(key, local_path=None, format=None, **kwargs):
+            if key == 'outputs':
+                with open(local_path) as f:
+                    logged['lines'] = f.readlines()
+                logged['format'] = format
+
+        mock_mlrun_context.log_artifact.side_effect = log_artifact
+
+        def offline_inference(self, prompts, sampling_params, **kwargs):
+            return [_fake_output(prompt, prompt) for prompt in prompts]
+
+        with patch.object(VLLMModelServer, 'offline_inference', offline_inference):
+            offline_inference_handler(
+                context=mock_mlrun_context,
+                model_name='test_model',
+                prompts=['a', 'b', 'c'],
+                chunk_size=2,
+                output_format='jsonl')
+
+        mock_mlrun_context.log_dataset.assert_not_called()
+        assert logged['format'] == 'jsonl'
+        assert len(logged['lines']) == 3
+
+    @pytest.fixture(params=['parquet', 'csv', 'jsonl', 'json', 'json-object'])
+    def prompts_file(self, request, tmp_path):
+        """Write ten prompts with an extra column in each supported format."""
+        rows = [{'id': i, 'prompt': f'prompt {i}'} for i in range(10)]
+        path = tmp_path / f"prompts.{request.param.split('-')[0]}"
+        if request.param == 'parquet':
+            pq.write_table(pa.Table.from_pylist(rows), path, row_group_size=3)
+        elif request.param == 'csv':
+            with open(path, 'w') as f:
+                f.write('id,prompt\n' + ''.join(f"{row['id']},{row['prompt']}\n" for row in rows))
+        elif request.param == 'json':
+            with open(path, 'w') as f:
+                json.dump(rows, f, indent=2)
+        elif request.param == 'json-object':
+            with open(path, 'w') as f:
+                json.dump({'prompts': [row['prompt'] for row in rows]}, f)
+        else:
+            with open(path, 'w') as f:
+                f.write(''.join(json.dumps(row) + '\n' for row in rows))
+        return str(path)
+
+    def test_iter_dataset_prompts_batches(self, prompts_file):
+        """Test that prompts are read in fixed size batches from every format."""
+        batches = list(_iter_dataset_prompts(prompts_file, 'prompt', batch_size=4))
+
+        assert [len(batch) for batch in batches] == [4, 4, 2]
+        assert batches[0][0] == 'prompt 0'
+        assert batches[-1][-1] == 'prompt 9'
+
+    def test_iter_dataset_prompts_rejects_unknown_format(self, tmp_path):
+        """Test that an unsupported dataset format is rejected."""
+        with pytest.raises(ValueError):
+            list(_iter_dataset_prompts(str(tmp_path / 'prompts.xlsx'), 'prompt', batch_size=4))
+
+    def test_handler_reads_prompts_dataset(self, mock_mlrun_context, prompts_file):
+        """Test that the handler streams the prompts of a dataset input."""
+        prompts_dataset = Mock(url=prompts_file)
+        prompts_dataset.local.return_value = prompts_file
+        seen = []
+
+        def offline_inference(self, prompts, sampling_params, **kwargs):
+            seen.append(len(prompts))
+            return [_fake_output(prompt, prompt) for prompt in prompts]
+
+        with patch.object(VLLMModelServer, 'offline_inference', offline_inference):
+            offline_inference_handler(
+                context=mock_mlrun_context,
+                model_name='test_model',
+                prompts_dataset=prompts_dataset,
+                chunk_size=6)
+
+        assert seen == [6, 4]
+        prompts_dataset.remove_local.assert_called_once()
+
+    def test_handler_requires_one_prompt_source(self, mock_mlrun_context):
+        """Test that exactly one of prompts and prompts_dataset is required."""
+        with pytest.raises(ValueError):
+            offline_inference_handler(context=mock_mlrun_context, model_name='test_model')
+
+
+class TestPipelinedExecutor:
+    """Test suite for the overlapping prefetch, generate and write stages of streaming inference."""
+
+    def _sleep(self, seconds, transform=lambda item: item):
+        def stage(item):
+            time.sleep(seconds)
+            return transform(item)
+        return stage
+
+    def test_stages_overlap_and_keep_order(self):
+        """Test that the stages run concurrently, items are written in order and every stage is timed."""
+        written = []
+        executor = PipelinedExecutor(queue_size=1)
+
+        start = time.perf_counter()
+        executor.run(
+            iter(range(8)),
+            prefetch=self._sleep(0.02),
+            generate=self._sleep(0.05, lambda item: item * 10),
+            write=self._sleep(0.02, written.append))
+        elapsed = time.perf_counter() - start
+
+        assert written == [item * 10 for item in range(8)]
+        # serially the run takes 8 * 0.09s, pipelined it is bound by the generate stage
+        assert elapsed < 8 * 0.09 * 0.8
+        summary = executor.summary()
+        assert summary['pipeline_bottleneck'] == 'generate'
+        assert summary['stage_generate_busy_seconds'] >= 8 * 0.05
+        assert summary['stage_write_idle_seconds'] > summary['stage_generate_idle_seconds']
+        assert all(summary[f'stage_{name}_items'] == 8 for name in ('prefetch', 'generate', 'write'))
+
+    def test_queues_are_bounded(self):
+        """Test that a slow writer holds back the prefetch stage instead of buffering every item."""
+        prefetched = []
+        max_ahead = []
+        written = []
+
+        def write(item):
+            max_ahead.append(len(prefetched) - len(written))
+            time.sleep(0.02)
+            written.append(item)
+
+        PipelinedExecutor(queue_size=1).run(
+            iter(range(10)), prefetch=lambda item: prefetched.append(item) or item, generate=lambda item: item,
+            write=write)
+
+        assert written == list(range(10))
+        # prefetch, generate and write hold one item each plus one item per queue
+        assert max(max_ahead) <= 2 * 1 + 3
+
+    @pytest.mark.parametrize('failing_stage', ['prefetch', 'generate'])
+    def test_error_is_raised_after_earlier_items_are_written(self, failing_stage):
+        """Test that a prefetch or generate error is raised once the items before it are written."""
+        written = []
+
+        def fail_at_three(item):
+            if item == 3:
+                raise RuntimeError('node reclaimed')
+            return item
+
+        stages = {'prefetch': lambda item: item, 'generate': lambda item: item, failing_stage: fail_at_three}
+        with pytest.raises(RuntimeError, match='node reclaimed'):
+            PipelinedExecutor(queue_size=2).run(iter(range(6)), write=written.append, **stages)
+
+        assert written == [0, 1, 2]
+
+    def test_write_error_stops_the_pipeline(self):
+        """Test that a failing writer stops the prefetch and generate stages and its error is raised."""
+        generated = []
+
+        def write(item):
+            raise OSError('artifact store unavailable')
+
+        with pytest.raises(OSError, match='artifact store'):
+            PipelinedExecutor(queue_size=1).run(
+                iter(range(100)), prefetch=lambda item: item, generate=lambda item: generated.append(item) or item,
+                write=write)
+
+        assert len(generated) < 100
+
+
+class TestInferenceCheckpoint:
+    """Test suite for checkpointed, resumable offline inference."""
+
+    def _run(self, context, checkpoint_path, prompts, fail_at=None, sampling_params=None, model_uid='v1'):
+        """Run the handler with a fake engine that optionally fails at a prompt."""
+        generated = []
+
+        def offline_inference(self, prompts, sampling_params, **kwargs):
+            if fail_at in prompts:
+                raise RuntimeError('node reclaimed')
+            generated.extend(prompts)
+            return [_fake_output(prompt, prompt.upper()) for prompt in prompts]
+
+        model_artifact = SimpleNamespace(
+            uri='store://models/test_model', metadata=SimpleNamespace(uid=model_uid, tree=None, hash=None))
+        with patch.object(VLLMModelServer, 'offline_inference', offline_inference), \
+                patch.object(VLLMModelServer, 'get_model_artifact', return_value=model_artifact):
+            offline_inference_handler(
+                context=context,
+                model_name='test_model',
+                prompts=prompts,
+                sampling_params=sampling_params or {'temperature': 0},
+                chunk_size=2,
+                run_key='nightly',
+                checkpoint_path=checkpoint_path)
+        return generated
+
+    def test_rerun_resumes_from_checkpoint(self, mock_mlrun_context, tmp_path):
+        """Test that a rerun with the same run key skips the completed chunks."""
+        checkpoint_path = str(tmp_path / 'checkpoints' / 'nightly')
+        prompts = [f'prompt {i}' for i in range(7)]
+
+        with pytest.raises(RuntimeError):
+            self._run(mock_mlrun_context, checkpoint_path, prompts, fail_at='prompt 4')
+
+        with open(os.path.join(checkpoint_path, 'checkpoint.json')) as f:
+            assert json.load(f)['completed_chunks'] == 2
+        part = pq.read_table(os.path.join(checkpoint_path, 'part-000001.parquet'))
+        assert part.schema == OUTPUT_SCHEMA
+        assert part.column('response').to_pylist() == ['PROMPT 2', 'PROMPT 3']
+
+        rows = {}
+        mock_mlrun_context.log_dataset.side_effect = \
+            lambda key, df, local_path, format: rows.update(table=pq.read_table(local_path))
+        generated = self._run(mock_mlrun_context, checkpoint_path, prompts)
+
+        assert generated == prompts[4:]
+        assert rows['table'].column('prompt').to_pylist() == prompts
+        results = _logged_results(mock_mlrun_context)
+        assert results['num_recovered'] == 4
+        assert results['num_generated'] == 3
+
+    @pytest.mark.parametrize('change', ['prompts', 'sampling_params', 'model'])
+    def test_rerun_with_other_inputs_is_refused(self, mock_mlrun_context, tmp_path, change):
+        """Test that a rerun with other prompts, sampling parameters or model does not reuse stale chunks."""
+        checkpoint_path = str(tmp_path / 'checkpoints' / 'nightly')
+        prompts = [f'prompt {i}' for i in range(7)]
+        with pytest.raises(RuntimeError):
+            self._run(mock_mlrun_context, checkpoint_path, prompts, fail_at='prompt 4')
+
+        kwargs = {
+            'prompts': {'prompts': [f'other {i}' for i in range(7)]},
+            'sampling_params': {'sampling_params': {'temperature': 0.5}},
+            'model': {'model_uid': 'v2'},
+        }[change]
+        with pytest.raises(ValueError, match='checkpoint'):
+            self._run(mock_mlrun_context, checkpoint_path, **{'prompts': prompts, **kwargs})
+
+
+@pytest.mark.usefixtures('fake_sampling_params')
+class TestResponseCache:
+    """Test suite for the offline inference response cache."""
+
+    @pytest.fixture
+    def sample_server_params(self):
+        """Initialization parameters for the server."""
+        return {
+            'context': Mock(),
+            'name': 'test_vllm_server',
+            'model_path': '/path/to/model',
+            'model_name': 'test_model',
+        }
+
+    @pytest.fixture
+    def cached_server(self, sample_server_params, tmp_path):
+        """A server with a response cache and a fake engine echoing the prompts."""
+        server = VLLMModelServer(**sample_server_params)
+        server.response_cache = ResponseCache(path=str(tmp_path / 'responses.sqlite'))
+        llm = _FakeLLM()
+        model_artifact = Mock(uri='store://artifacts/test/model', metadata=Mock(uid='uid-1'))
+        with patch.object(VLLMModelServer, 'get_model_artifact', return_value=model_artifact), \
+                patch.object(VLLMModelServer, '_get_engine', return_value=llm) as get_engine:
+            yield server, llm, get_engine
+        server.response_cache.close()
+
+    def test_duplicates_generated_once(self, cached_server):
+        """Test that duplicate prompts are generated once and fanned out in order."""
+        server, llm, _ = cached_server
+
+        outputs = server.offline_inference(['a', 'b', 'a'], {'temperature': 0})
+
+        assert [output.outputs[0].text for output in outputs] == ['A', 'B', 'A']
+        assert llm.batches == [['a', 'b']]
+        assert server.response_cache.misses == 2
+
+    def test_cache_hits_skip_engine(self, cached_server):
+        """Test that a fully cached batch does not touch the engine."""
+        server, llm, get_engine = cached_server
+        server.offline_inference(['a', 'b'], {'temperature': 0})
+        get_engine.reset_mock()
+
+        outputs = server.offline_inference(['b', 'a'], {'temperature': 0})
+
+        assert [output.prompt for output in outputs] == ['b', 'a']
+        get_engine.assert_not_called()
+        assert server.response_cache.hits == 2
+
+    def test_sampling_params_are_part_of_the_key(self, cached_server):
+        """Test that other sampling parameters miss the cache."""
+        server, llm, _ = cached_server
+        server.offline_inference(['a'], {'temperature': 0})
+
+        server.offline_inference(['a'], {'temperature': 0, 'max_tokens': 5})
+
+        assert len(llm.batches) == 2
+
+    def test_non_deterministic_sampling_bypasses_cache(self, cached_server):
+        """Test that random sampling without a seed bypasses the cache."""
+        server, llm, _ = cached_server
+
+        server.offline_inference(['a', 'a'], {'temperature': 0.8})
+        server.offline_inference(['a', 'a'], {'temperature': 0.8})
+
+        assert llm.batches[-1] == ['a', 'a']
+        assert server.response_cache.hits == 0
+        assert server.response_cache.misses == 0
+
+    def test_seeded_sampling_uses_cache(self, cached_server):
+        """Test that seeded random sampling is cached."""
+        server, llm, _ = cached_server
+
+        server.offline_inference(['a'], {'temperature': 0.8, 'seed': 7})
+        server.offline_inference(['a'], {'temperature': 0.8, 'seed': 7})
+
+        assert len(llm.batches) == 1
+
+    def test_cache_file_holds_plain_documents(self, tmp_path):
+        """Test that outputs are stored as JSON documents and rebuilt by a later cache instance."""
+        path = str(tmp_path / 'responses.sqlite')
+        cache = ResponseCache(path=path)
+        cache.put_many({'k': _fake_output('prompt', 'text')})
+        cache.sync()
+        cache.close()
+
+        with sqlite3.connect(path) as connection:
+            (document,) = connection.execute('SELECT output FROM response_documents').fetchone()
+        assert json.loads(document)['outputs'][0]['text'] == 'text'
+
+        cache = ResponseCache(path=path)
+        output = cache.get_many(['k'])['k']
+        cache.close()
+        assert output.prompt == 'prompt'
+        assert output.prompt_token_ids == list(range(6))
+        assert (output.outputs[0].text, output.outputs[0].finish_reason) == ('text', 'stop')
+        assert output.outputs[0].token_ids == list(range(4))
+
+
+class TestMetadataCache:
+    """Test suite for the per-process project and artifact metadata cache."""
+
+    def test_ttl_and_invalidate(self):
+        """Test that values are reused within the ttl and refilled after invalidation."""
+        cache = MetadataCache(ttl=60)
+        fill = Mock(side_effect=[1, 2])
+
+        assert cache.get_or_fill(('k',), fill) == 1
+        assert cache.get_or_fill(('k',), fill) == 1
+        cache.invalidate(('k',))
+        assert cache.get_or_fill(('k',), fill) == 2
+        assert (cache.hits, cache.misses) == (1, 2)
+
+    def test_failed_lookups_are_not_cached(self):
+        """Test that a failing fill is retried on the next lookup."""
+        cache = MetadataCache(ttl=60)
+        fill = Mock(side_effect=[mlrun.errors.MLRunNotFoundError('missing'), 'artifact'])
+
+        with pytest.raises(mlrun.errors.MLRunNotFoundError):
+            cache.get_or_fill(('k',), fill)
+        assert cache.get_or_fill(('k',), fill) == 'artifact'
+
+    def test_repeated_lookups_skip_the_api(self):
+        """Test that model artifact lookups reuse the project and artifact until logged."""
+        context = Mock(project='test-project')
+        context.get_param.side_effect = lambda key, default=None: default
+        server = VLLMModelServer(context=context, name='model', model_path='/tmp/model',
+                                 model_name='org/model')
+        project = Mock(name='project')
+        with patch('mlrun.get_or_create_project', return_value=project) as get_project:
+            server.get_model_artifact()
+            server.get_model_artifact()
+            assert get_project.call_count == 1
+            assert project.get_artifact.call_count == 1
+
+            server._invalidate_model_artifact()
+            server.get_model_artifact()
+            assert get_project.call_count == 1
+            assert project.get_artifact.call_count == 2
+
+
+class _CrashingLLM(_FakeLLM):
+    """A fake engine whose process dies while generating, like an out of memory kill."""
+
+    def step(self):
+        os._exit(3)
+
+
+def _fake_worker_engine(engine_args):
+    """Build a fake worker engine, failing or crashing when asked to."""
+    if engine_args.get('fail'):
+        raise ValueError('no device')
+    if engine_args.get('exit_on_build'):
+        os._exit(4)
+    if engine_args.get('child_process'):
+        # like the V1 engine core, the engine starts a process of its own
+        child = multiprocessing.get_context('fork').Process(target=time.sleep, args=(0,))
+        child.start()
+        child.join()
+    return _CrashingLLM() if engine_args.get('crash') else _FakeLLM()
+
+
+@pytest.mark.usefixtures('fake_sampling_params')
+class TestEngineWorkerPool:
+    """Test suite for the data-parallel engine worker pool."""
+
+    def test_generate_merges_in_order(self):
+        """Test that shards run across the workers and the outputs keep the prompt order."""
+        pool = EngineWorkerPool(num_workers=2, engine_args={}, worker_envs=[{}, {}],
+                                engine_factory=_fake_worker_engine, start_method='fork')
+        try:
+            prompts = [f'prompt {index}' * (index % 5 + 1) for index in range(40)]
+            outputs, stats = pool.generate(prompts, sampling_params=None, shard_size=3)
+        finally:
+            pool.close()
+
+        assert [output.outputs[0].text for output in outputs] == [prompt.upper() for prompt in prompts]
+        assert sorted(stats) == [0, 1]
+        assert sum(worker['prompts'] for worker in stats.values()) == 40
+        assert all('generated_tokens_per_second' in worker for worker in stats.values())
+
+    def test_failed_worker_fails_the_pool(self):
+        """Test that an engine that fails to build raises in the parent."""
+        with pytest.raises(RuntimeError, match='no device'):
+            EngineWorkerPool(num_workers=1, engine_args={'fail': True}, worker_envs=[{}],
+                             engine_factory=_fake_worker_engine, start_method='fork')
+
+    def test_dead_worker_fails_the_pool(self):
+        """Test that a worker process dying while generating fails the call instead of hanging."""
+        pool = EngineWorkerPool(num_workers=2, engine_args={'crash': True}, worker_envs=[{}, {}],
+                                engine_factory=_fake_worker_engine, start_method='fork')
+        pool.RESULT_POLL_SECONDS = 0.1
+
+        with pytest.raises(RuntimeError, match='exited with code 3'):
+            pool.generate(['a', 'b'], sampling_params=None, shard_size=1)
+        assert not any(process.is_alive() for process in pool._processes)
+
+    def test_worker_dying_on_start_fails_the_pool(self):
+        """Test that a worker process dying while building its engine fails the pool."""
+        with patch.object(EngineWorkerPool, 'RESULT_POLL_SECONDS', 0.1), \
+                pytest.raises(RuntimeError, match='exited with code 4'):
+            EngineWorkerPool(num_workers=1, engine_args={'exit_on_build': True}, worker_envs=[{}],
+                             engine_factory=_fake_worker_engine, start_method='fork')
+
+    def test_engine_may_start_child_processes(self):
+        """Test that the workers are not daemonic, so an engine can start its own processes."""
+        pool = EngineWorkerPool(num_workers=1, engine_args={'child_process': True}, worker_envs=[{}],
+                                engine_factory=_fake_worker_engine, start_method='fork')
+        try:
+            outputs, _ = pool.generate(['a'], sampling_params=None)
+        finally:
+            pool.close()
+
+        assert outputs[0].outputs[0].text == 'A'
+        assert not any(process.daemon or process.is_alive() for process in pool._processes)
+        pool.close()
+
+    @pytest.mark.usefixtures('fake_sampling_params')
+    def test_server_uses_pool_when_data_parallel(self):
+        """Test that offline_inference runs on the worker pool and records per-worker throughput."""
+        context = Mock(project='test-project')
+        context.get_param.side_effect = lambda key, default=None: default
+        server = VLLMModelServer(context=context, name='model', model_path='/tmp/model',
+                                 model_name='org/model')
+        server.data_parallel_size = 2
+        pool = Mock(num_workers=2)
+        pool.generate.return_value = ([_fake_output('p', 'ab')], {
+            0: {'prompts': 1, 'generated_tokens': 2, 'seconds': 1.0,
+                'generated_tokens_per_second': 2.0},
+            1: {'prompts': 0, 'generated_tokens': 0, 'seconds': 0.0,
+                'generated_tokens_per_second': 0.0}})
+
+        with patch.object(server, '_get_worker_pool', return_value=pool):
+            outputs = server.offline_inference(['p'], {'max_tokens': 2})
+
+        assert outputs[0].outputs[0].text == 'ab'
+        assert server.worker_stats[0]['generated_tokens'] == 2
+        assert server.inference_metrics.generated_tokens == 2
+
+
+def _fake_tokenizer(prompts, add_special_tokens=True):
+    """Tokenize on whitespace like a HF tokenizer call."""
+    return {'input_ids': [prompt.split() for prompt in prompts]}
+
+
+class TestTokenPlanning:
+    """Test suite for the tokenizer-only token counting and batch planning."""
+
+    @pytest.fixture
+    def server(self):
+        """Create a server whose tokenizer splits on whitespace."""
+        context = Mock(project='test-project')
+        context.get_param.side_effect = lambda key, default=None: default
+        server = VLLMModelServer(context=context, name='model', model_path='/tmp/model',
+                                 model_name='org/model')
+        server._tokenizer = _fake_tokenizer
+        return server
+
+    def test_count_tokens_keeps_order(self, server):
+        """Test that threaded counting returns the lengths in prompt order."""
+        prompts = ['a ' * (index % 7 + 1) for index in range(50)]
+
+        assert server.count_tokens(prompts, num_threads=4) == [index % 7 + 1 for index in range(50)]
+
+    def test_plan_batches(self, server):
+        """Test the length statistics, histogram and suggested plan."""
+        prompts = ['a'] * 3 + ['a ' * 100]
+
+        plan = server.plan_batches(prompts, max_tokens=200, max_model_len=256, chunk_tokens=1000)
+
+        assert plan['token_lengths'] == [1, 1, 1, 100]
+        assert plan['histogram'] == {'<=1': 3, '<=128': 1}
+        assert plan['plan']['max_model_len'] == 512
+        assert plan['plan']['num_too_long'] == 1
+        assert plan['plan']['chunk_size'] == 4
+        assert plan['plan']['estimated_total_tokens'] == 103 + 800
+
+    def test_handler_logs_plan(self):
+        """Test that the handler logs the plan and the per-prompt lengths without an engine."""
+        context = MagicMock()
+        with patch('functions.vllm_model_server.VLLMModelServer._get_tokenizer',
+                   return_value=_fake_tokenizer), \
+                patch('functions.vllm_model_server.LLM') as llm:
+            token_plan_handler(context, 'model', prompts=['a b', 'c'])
+
+        llm.assert_not_called()
+        assert context.log_results.call_args.args[0]['total_prompt_tokens'] == 3
+        assert context.log_dataset.call_args.kwargs['key'] == 'token_lengths'
+        assert context.log_artifact.call_args.args[0] == 'token_plan'
+
+    def test_handler_streams_dataset_prompts(self, tmp_path):
+        """Test that the dataset prompts are counted chunk by chunk, never as one list."""
+        local_path = tmp_path / 'prompts.jsonl'
+        local_path.write_text(''.join(json.dumps({'prompt': 'a ' * (index % 3 + 1)}) + '\n'
+                                      for index in range(10)))
+        dataset = Mock()
+        dataset.local.return_value = str(local_path)
+        context = MagicMock()
+        counted = []
+
+        def count_tokens(self, prompts, num_threads=4):
+            counted.append(len(prompts))
+            return [len(prompt.split()) for prompt in prompts]
+
+        with patch.object(VLLMModelServer, 'count_tokens', count_tokens), \
+                patch('functions.vllm_model_server.DEFAULT_CHUNK_SIZE', 4):
+            token_plan_handler(context, 'model', prompts_dataset=dataset)
+
+        assert counted == [4, 4, 2]
+        assert context.log_results.call_args.args[0]['num_prompts'] == 10
+        assert context.log_results.call_args.args[0]['total_prompt_tokens'] == 19
+        dataset.remove_local.assert_called_once()
+
+
+@pytest.mark.usefixtures('fake_sampling_params')
+class TestInferenceMetrics:
+    """Test suite for the phase timings and throughput metrics."""
+
+    def test_summary(self):
+        """Test that phases, token counts and latency percentiles are summarized."""
+        metrics = InferenceMetrics()
+        with metrics.phase('generate'):
+            pass
+        with metrics.phase('generate'):
+            pass
+        output = _fake_output('abcd', 'xy')
+        output.metrics = SimpleNamespace(arrival_time=1.0, finished_time=1.5)
+        metrics.record_outputs([output, _fake_output('a', 'xyz')])
+
+        summary = metrics.summary()
+
+        assert metrics.phase_calls['generate'] == 2
+        assert summary['num_requests'] == 2
+        assert summary['prompt_tokens'] == 5
+        assert summary['generated_tokens'] == 5
+        assert summary['generated_tokens_per_second'] > 0
+        assert summary['latency_p50_ms'] == summary['latency_p99_ms'] == 500.0
+
+    def test_handler_logs_metrics(self):
+        """Test that the handler logs the metrics as results and an artifact."""
+        context = MagicMock()
+        with patch('functions.vllm_model_server.VLLMModelServer.offline_inference',
+                   return_value=[_fake_output('p', 'r')]):
+            offline_inference_handler(context, 'model', prompts=['p'])
+
+        logged = _logged_results(context)
+        assert 'num_requests' in logged and 'latency_p50_ms' in logged
+        assert context.log_artifact.call_args.args[0] == 'inference_metrics'
+        assert 'phase_calls' in json.loads(context.log_artifact.call_args.kwargs['body'])
+
+    def test_latency_measured_without_engine_metrics(self):
+        """Test that request latencies are timed even when the engine reports no metrics."""
+        server = VLLMModelServer(context=Mock(), name='s', model_path='/p', model_name='m')
+
+        outputs = server._generate(_FakeLLM(), ['a', 'bc'], sampling_params=None)
+
+        summary = server.inference_metrics.summary()
+        assert summary['latency_p50_ms'] is not None and summary['latency_p99_ms'] >= 0
+        rows = _outputs_to_table(outputs).to_pylist()
+        # the first token is not seen with FINAL_ONLY outputs, only the engine reports it
+        assert all(row['latency_ms'] >= 0 and row['ttft_ms'] is None for row in rows)
+
+    def test_requests_are_added_final_only(self):
+        """Test that the engine returns final outputs only, without modifying the caller's parameters."""
+        server = VLLMModelServer(context=Mock(), name='s', model_path='/p', model_name='m')
+        llm = _FakeLLM()
+        sampling_params = SimpleNamespace(max_tokens=4, output_kind='cumulative')
+
+        server._generate(llm, ['a', 'bc'], sampling_params=sampling_params)
+
+        assert [params.output_kind for params in llm.params] == ['final_only', 'final_only']
+        assert sampling_params.output_kind == 'cumulative'
+
+
+@pytest.mark.usefixtures('fake_sampling_params')
+class TestPromptScheduling:
+    """Test suite for prefix- and length-aware prompt scheduling."""
+
+    def test_schedule_groups_prefixes_and_lengths(self):
+        """Test that prompts are grouped by prefix and bucketed by length."""
+        system = 'S' * 300
+        prompts = [system + 'long question ' * 50, 'other', system + 'q', 'other 2', system + 'r']
+        lengths = [len(prompt) for prompt in prompts]
+
+        order = _schedule_prompts(prompts, lengths)
+
+        assert sorted(order) == list(range(len(prompts)))
+        assert order[:3] == [2, 4, 0]
+        assert _prefix_sharing_ratio(prompts, order) > _prefix_sharing_ratio(prompts, list(range(5)))
+
+    def test_short_shared_prefixes_are_grouped(self):
+        """Test that prompts sharing a system prompt shorter than the whole prefix window are grouped."""
+        system = 'You are a helpful assistant. Answer briefly: '
+        prompts = []
+        for i in range(6):
+            prompts.append(system + f'question {i} ' + 'x' * (i * 40))
+            prompts.append(f'unrelated prompt {i} ' + 'y' * ((5 - i) * 40))
+        lengths = [len(prompt) for prompt in prompts]
+
+        order = _schedule_prompts(prompts, lengths)
+
+        assert sorted(order) == list(range(len(prompts)))
+        assert all(prompts[index].startswith(system) for index in order[:6])
+        assert _prefix_sharing_ratio(prompts, order) > _prefix_sharing_ratio(prompts, list(range(12)))
+        # the prompts without a shared prefix are bucketed by length across the batch
+        buckets = [lengths[index].bit_length() for index in order[6:]]
+        assert buckets == sorted(buckets)
+
+    def test_schedule_is_recorded_in_metrics(self):
+        """Test that the prefix sharing before and after scheduling is reported with the run metrics."""
+        server = VLLMModelServer(context=Mock(), name='s', model_path='/p', model_name='m')
+        server.schedule_prompts = True
+        llm = _FakeLLM()
+        system = 'S' * 40
+        server._generate(llm, [system + 'a', 'x', system + 'b', 'y'], sampling_params=None)
+
+        summary = server.inference_metrics.summary()
+
+        assert summary['scheduled_prompts'] == 4
+        assert summary['prefix_sharing_after'] > summary['prefix_sharing_before']
+
+    def test_generate_restores_original_order(self):
+        """Test that scheduled outputs are returned in the caller's order."""
+        server = VLLMModelServer(context=Mock(), name='s', model_path='/p', model_name='m')
+        server.schedule_prompts = True
+        llm = _FakeLLM()
+        system = 'S' * 300
+        prompts = ['x', system + 'long' * 200, 'y', system + 'a']
+
+        outputs = server._generate(llm, prompts, sampling_params=None)
+
+        assert [output.prompt for output in outputs] == prompts
+        assert llm.batches == [[prompts[3], prompts[1], 'x', 'y']]
+
+
+class TestFetchFiles:
+    """Test suite for the concurrent artifact file fetcher."""
+
+    @staticmethod
+    def _data_item(target_contents, failures=0):
+        """Create a mock data item whose download fails the given number of times."""
+        data_item = Mock()
+        attempts = {'count': 0}
+
+        def download(target_path):
+            attempts['count'] += 1
+            if attempts['count'] <= failures:
+                raise ConnectionError('transient error')
+            with open(target_path, 'w') as f:
+                f.write(target_contents)
+
+        data_item.download.side_effect = download
+        return data_item
+
+    def test_fetches_all_files(self, tmp_path):
+        """Test that every file is downloaded and reported."""
+        data_items = {
+            's3://models/m/tokenizer.json': self._data_item('{}'),
+            's3://models/m/config.json': self._data_item('{"a": 1}'),
+        }
+        files = {url: str(tmp_path / url.rsplit('/', 1)[-1]) for url in data_items}
+
+        with patch('functions.vllm_model_server.mlrun.get_dataitem', side_effect=data_items.get):
+            stats = _fetch_files(files)
+
+        assert set(stats) == set(files)
+        assert stats['s3://models/m/config.json']['bytes'] == 8
+        assert all(stat['attempts'] == 1 for stat in stats.values())
+
+    def test_retries_transient_failures(self, tmp_path):
+        """Test that a failing download is retried with backoff."""
+        data_item = self._data_item('{}', failures=2)
+        files = {'s3://models/m/tokenizer.json': str(tmp_path / 'tokenizer.json')}
+
+        with patch('functions.vllm_model_server.mlrun.get_dataitem', return_value=data_item):
+            stats = _fetch_files(files, retries=2, backoff=0)
+
+        assert stats['s3://models/m/tokenizer.json']['attempts'] == 3
+
+    def test_raises_after_retries(self, tmp_path):
+        """Test that the error is raised once the retries are exhausted."""
+        data_item = self._data_item('{}', failures=5)
+        files = {'s3://models/m/tokenizer.json': str(tmp_path / 'tokenizer.json')}
+
+        with patch('functions.vllm_model_server.mlrun.get_dataitem', return_value=data_item):
+            with pytest.raises(ConnectionError):
+                _fetch_files(files, retries=1, backoff=0)
+
+
+class TestLocalArtifactCache:
+    """Test suite for the LocalArtifactCache class."""
+
+    @staticmethod
+    def _writer(filename, size):
+        """Create a fill callable writing a single file of the given size."""
+        def fill(target_dir):
+            with open(os.path.join(target_dir, filename), 'wb') as f:
+                f.write(b'x' * size)
+        return fill
+
+    def test_get_or_fill_fills_once(self, tmp_path):
+        """Test that a filled entry is returned on later calls without filling again."""
+        cache = LocalArtifactCache(root=str(tmp_path), max_bytes=1024)
+        fill = Mock(side_effect=self._writer('tokenizer.json', 10))
+        key = LocalArtifactCache.entry_key('store://artifacts/p/model', 'uid-1')
+
+        lease, hit = cache.get_or_fill(key, fill)
+        assert hit is False
+        assert os.path.exists(os.path.join(lease.path, 'tokenizer.json'))
+
+        second_lease, hit = cache.get_or_fill(key, fill)
+        assert hit is True
+        assert second_lease.path == lease.path
+        fill.assert_called_once()
+
+    def test_failed_fill_leaves_no_entry(self, tmp_path):
+        """Test that a failing fill does not leave a partial entry behind."""
+        cache = LocalArtifactCache(root=str(tmp_path), max_bytes=1024)
+        key = LocalArtifactCache.entry_key('store://artifacts/p/model', 'uid-1')
+
+        with pytest.raises(RuntimeError):
+            cache.get_or_fill(key, Mock(side_effect=RuntimeError('download failed')))
+
+        assert cache.get(key) is None
+        assert not [name for name in os.listdir(tmp_path) if not name.endswith('.lock')]
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        """Test that the least-recently-used entry is evicted beyond the size cap."""
+        cache = LocalArtifactCache(root=str(tmp_path), max_bytes=250)
+        keys = [LocalArtifactCache.entry_key('model', str(i)) for i in range(3)]
+
+        cache.get_or_fill(keys[0], self._writer('a', 100))[0].release()
+        cache.get_or_fill(keys[1], self._writer('b', 100))[0].release()
+        # mark the first entry as used before the second one
+        os.utime(os.path.join(tmp_path, keys[1]), (0, 0))
+        cache.get_or_fill(keys[2], self._writer('c', 100))[0].release()
+
+        assert cache.get(keys[0]) is not None
+        assert cache.get(keys[1]) is None
+        assert cache.get(keys[2]) is not None
+        # the lock file goes with the evicted entry
+        assert not os.path.exists(os.path.join(tmp_path, f'.{keys[1]}.lock'))
+
+    def test_leased_entry_is_not_evicted(self, tmp_path):
+        """Test that an entry being read in another process is skipped by eviction."""
+        cache = LocalArtifactCache(root=str(tmp_path), max_bytes=150)
+        keys = [LocalArtifactCache.entry_key('model', str(i)) for i in range(2)]
+        cache.get_or_fill(keys[0], self._writer('a', 100))[0].release()
+        os.utime(os.path.join(tmp_path, keys[0]), (0, 0))
+
+        # hold a lease on the least-recently-used entry from another process
+        script = (
+            'import sys, time\n'
+            'from functions.vllm_model_server import LocalArtifactCache\n'
+            f'lease = LocalArtifactCache({str(tmp_path)!r}, 150).lease({keys[0]!r})\n'
+            'print(lease is not None, flush=True)\n'
+            'sys.stdin.read()\n')
+        reader = subprocess.Popen(
+            [sys.executable, '-c', script], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+            env={**os.environ, 'PYTHONPATH': os.path.join(os.path.dirname(__file__), '..', 'src')})
+        try:
+            assert reader.stdout.readline().strip() == 'True'
+            cache.get_or_fill(keys[1], self._writer('b', 100))[0].release()
+            assert os.path.isdir(os.path.join(tmp_path, keys[0]))
+        finally:
+            reader.communicate('')
+
+        # once the reader is done the entry is evicted
+        cache.evict()
+        assert not os.path.isdir(os.path.join(tmp_path, keys[0]))
+
+    def test_entry_larger_than_cap_is_not_stored(self, tmp_path):
+        """Test that an entry larger than the size cap is refused instead of overflowing the cache."""
+        cache = LocalArtifactCache(root=str(tmp_path), max_bytes=50)
+        key = LocalArtifactCache.entry_key('model', 'huge')
+
+        with pytest.raises(ValueError, match='size cap'):
+            cache.get_or_fill(key, self._writer('a', 100))
+
+        assert cache.get(key) is None
+
+
+class TestWeightCache:
+    """Test suite for the node-local model weight cache in front of weight streaming."""
+
+    @pytest.fixture
+    def server(self, mock_mlrun_context, tmp_path):
+        """A server with a 1 GB weight cache whose artifact holds a single weights file."""
+        mock_mlrun_context.get_param.side_effect = lambda key, default=None: default
+        server = VLLMModelServer(context=mock_mlrun_context, name='s', model_path='/p', model_name='m',
+                                 weight_cache_max_gb=1)
+        model_artifact = SimpleNamespace(
+            uri='store://models/p/m', target_path='s3://bucket/m/',
+            metadata=SimpleNamespace(uid='uid-1', tree=None, hash=None))
+
+        def fetch(model_artifact, filenames, target_dir):
+            with open(os.path.join(target_dir, 'model.safetensors'), 'wb') as f:
+                f.write(b'w' * 10)
+
+        with patch('functions.vllm_model_server.WEIGHT_CACHE_DIR', str(tmp_path / 'weights')), \
+                patch.object(VLLMModelServer, '_download_tokenizer', return_value='/tokenizer'), \
+                patch.object(VLLMModelServer, '_artifact_bytes', return_value=10), \
+                patch.object(VLLMModelServer, '_fetch_artifact_files', side_effect=fetch) as fetch_files:
+            yield server, model_artifact, fetch_files
+            for fill in VLLMModelServer._weight_fills.values():
+                fill.join(timeout=5)
+        VLLMModelServer._weight_fills.clear()
+
+    def test_miss_streams_and_fills_in_background(self, server):
+        """Test that a miss streams from the artifact store and the next start loads from the node cache."""
+        server, model_artifact, fetch_files = server
+
+        assert server._engine_args(model_artifact, {})['model'] == 's3://bucket/m/'
+        for fill in VLLMModelServer._weight_fills.values():
+            fill.join(timeout=5)
+        local_path = server._engine_args(model_artifact, {})['model']
+
+        assert os.path.exists(os.path.join(local_path, 'model.safetensors'))
+        fetch_files.assert_called_once()
+        assert fetch_files.call_args.args[1] is None
+
+    def test_fill_thread_is_not_daemonic(self, server):
+        """Test that the fill runs in a non-daemon thread, so the process exit does not cut it short."""
+        server, model_artifact, _ = server
+
+        server._engine_args(model_artifact, {})
+
+        assert not any(fill.daemon for fill in VLLMModelServer._weight_fills.values())
+
+    def test_hit_is_leased_until_shutdown(self, server):
+        """Test that the cached weights an engine loads are not evicted until the engine is shut down."""
+        server, model_artifact, _ = server
+        server._engine_args(model_artifact, {})
+        for fill in VLLMModelServer._weight_fills.values():
+            fill.join(timeout=5)
+        local_path = server._engine_args(model_artifact, {})['model']
+        cache = LocalArtifactCache(root=os.path.dirname(local_path), max_bytes=0)
+
+        cache.evict()
+        assert os.path.isdir(local_path)
+
+        server._shutdown_engine()
+        cache.evict()
+        assert not os.path.isdir(local_path)
+
+    def test_artifact_over_the_cap_is_not_cached(self, server):
+        """Test that an artifact larger than the cache streams without a fill."""
+        server, model_artifact, fetch_files = server
+
+        with patch.object(VLLMModelServer, '_artifact_bytes', return_value=2 * 1024 ** 3):
+            assert server._engine_args(model_artifact, {})['model'] == 's3://bucket/m/'
+
+        assert not VLLMModelServer._weight_fills
+        fetch_files.assert_not_called()
+
+    def test_artifact_bytes_from_manifest(self, mock_mlrun_context):
+        """Test that the artifact size is the sum of the file sizes in its manifest."""
+        server = VLLMModelServer(context=mock_mlrun_context, name='s', model_path='/p', model_name='m')
+        model_artifact = SimpleNamespace(uri='store://models/p/m', target_path='s3://bucket/m/')
+        manifest = {'model.safetensors': {'size': 7, 'sha256': 'a'}, 'config.json': {'size': 3, 'sha256': 'b'}}
+
+        with patch('mlrun.get_dataitem') as get_dataitem:
+            get_dataitem.return_value.get.return_value = json.dumps(manifest)
+            assert server._artifact_bytes(model_artifact) == 10
+
+        get_dataitem.assert_called_once_with(f's3://bucket/m/{MODEL_MANIFEST_FILE}')
+
+    def test_new_version_misses(self, server):
+        """Test that another version of the artifact does not load the cached weights."""
+        server, model_artifact, _ = server
+        server._engine_args(model_artifact, {})
+        for fill in VLLMModelServer._weight_fills.values():
+            fill.join(timeout=5)
+
+        model_artifact.metadata.uid = 'uid-2'
+
+        assert server._engine_args(model_artifact, {})['model'] == 's3://bucket/m/'
+
+    def test_cache_disabled_by_default(self, mock_mlrun_context):
+        """Test that the weights are streamed without a fill when no cache size is configured."""
+        mock_mlrun_context.get_param.side_effect = lambda key, default=None: default
+        server = VLLMModelServer(context=mock_mlrun_context, name='s', model_path='/p', model_name='m')
+        model_artifact = SimpleNamespace(uri='store://models/p/m', target_path='s3://bucket/m/')
+
+        with patch.object(VLLMModelServer, '_download_tokenizer', return_value='/tokenizer'):
+            assert server._engine_args(model_artifact, {})['model'] == 's3://bucket/m/'
+        assert not VLLMModelServer._weight_fills
+
+
+class TestOfflineInferenceBenchmark:
+    """Test suite for the handler overhead benchmark harness."""
+
+    @pytest.fixture(autouse=True)
+    def benchmark(self):
+        """Import the benchmark module from tests/benchmarks."""
+        sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'benchmarks'))
+        try:
+            import bench_offline_inference
+            yield bench_offline_inference
+        finally:
+            sys.path.pop(0)
+
+    @pytest.mark.parametrize('chunk_size', [64, None])
+    def test_handler_runs_on_fakes(self, benchmark, chunk_size):
+        """Test that the handler runs end to end on the fake engine and artifact store."""
+        result = benchmark.run_benchmark(200, chunk_size=chunk_size, output_tokens=4)
+
+        assert result['num_generated'] == 200
+        assert result['mode'] == ('chunked' if chunk_size else 'in_memory')
+        assert result['wall_seconds'] >= result['engine_seconds'] > 0
+        assert ('stage_generate_busy_seconds' in result) == bool(chunk_size)
+
+    def test_fake_engine_latency_scales_with_output_tokens(self, benchmark):
+        """Test that the fake engine takes the per-token latency for every output token of a batch."""
+        llm = benchmark.FakeLLM(per_token_latency=0.005, output_tokens=4)
+
+        outputs = llm.generate(['a b', 'c'], SimpleNamespace(max_tokens=2))
+
+        assert [len(output.outputs[0].token_ids) for output in outputs] == [2, 2]
+        assert llm.engine_seconds >= 0.01
+
+    def test_generate_paths_compared(self, benchmark):
+        """Test that the instrumented engine loop is compared with LLM.generate and the cumulative loop."""
+        result = benchmark.compare_generate_paths(300, output_tokens=8)
+
+        assert result['llm_generate_seconds'] > 0 and result['generate_timed_seconds'] > 0
+        assert result['generate_timed_cumulative_seconds'] > result['generate_timed_seconds']
+
+    def test_compare_flags_regressions(self, benchmark):
+        """Test that only runs slower than their baseline by more than the tolerance are flagged."""
+        baselines = {'chunked_1000': {'overhead_us_per_prompt': 10.0}}
+
+        assert benchmark.compare({'chunked_1000': {'overhead_us_per_prompt': 12.0}}, baselines, 0.25) == []
+        assert len(benchmark.compare({'chunked_1000': {'overhead_us_per_prompt': 13.0}}, baselines, 0.25)) == 1
+
+
+class TestLazyImports:
+    """Test suite for the deferred imports of the heavy inference packages."""
+
+    def test_import_does_not_load_heavy_packages(self):
+        """Test that importing the module in a fresh interpreter leaves vllm, torch and huggingface_hub unloaded."""
+        src_path = os.path.join(os.path.dirname(__file__), '..', 'src')
+        code = ('import json, sys, functions.vllm_model_server; '
+                'print(json.dumps([name for name in ("vllm", "torch", "huggingface_hub") if name in sys.modules]))')
+        result = subprocess.run(
+            [sys.executable, '-c', code], capture_output=True, text=True,
+            env={**os.environ, 'PYTHONPATH': os.pathsep.join([src_path, *sys.path])})
+
+        assert result.returncode == 0, result.stderr
+        assert json.loads(result.stdout.splitlines()[-1]) == []
+
+    def test_import_profile_report_parses_importtime(self):
+        """Test that the -X importtime output is summarized per top level package."""
+        stderr = '\n'.join([
+            'import time: self [us] | cumulative | imported package',
+            'import time:       200 |        300 |   pyarrow.lib',
+            'import time:       100 |       1500 | pyarrow',
+            'import time:       500 |        500 | json',
+            'import time:       400 |       2500 | functions',
+        ])
+        with patch('functions.vllm_model_server.subprocess.run',
+                   return_value=SimpleNamespace(returncode=0, stderr=stderr)):
+            report = import_profile_report('functions.vllm_model_server', top=2)
+
+        assert report['total_seconds'] == 0.0025
+        assert report['packages'] == {'functions': 0.0025, 'pyarrow': 0.0015}
+        assert isinstance(report['lazy_imports'], dict)
 # endregion Unit Tests
 
 # region Integration Tests